@@ -10,6 +10,8 @@ pip install redis
 pip install passlib
 pip install itsdangerous
 pip install flask-httpauth
+apt-get -qqy install python3 python3-pip python3-psycopg2
+pip3 install asyncpg
 su postgres -c 'createuser -dRS vagrant'
 su vagrant -c 'createdb'
 su vagrant -c 'createdb forum'
@@ -0,0 +1,141 @@
+#!/usr/bin/env python
+#
+# cache.py -- standings caches for tournament.py
+#
+# A cache installed with tournament.setCache() serves repeated
+# playerStandings() calls, and the checkBye()/checkMatches() calls they
+# answer, without querying the database. Every tournament has a version that
+# tournament.py bumps once a write that changes its standings has committed,
+# and rows are only served while the version they were read at is current.
+#
+# StandingsCache lives in the process. SharedStandingsCache keeps versions
+# and rows in a redis server, so every process writing to the database
+# invalidates the rows the others read. Writes made without a shared cache
+# aren't seen by either.
+#
+
+import collections
+import json
+import threading
+
+
+
+class StandingsCache(object):
+    """Caches the standings of the most recently read tournaments in the
+    process.
+
+    Args:
+     size: number of tournaments kept, the least recently read go first
+
+    Attributes:
+     hits: reads served from the cache
+     misses: reads that had to query the database
+    """
+
+    def __init__(self, size=1000):
+        self.size = size
+        self.hits = 0
+        self.misses = 0
+        self._lock = threading.Lock()
+        self._epoch = 0
+        self._versions = {}
+        self._rows = collections.OrderedDict()
+
+    def _version(self, t_id):
+        return (self._epoch, self._versions.get(t_id, 0))
+
+    def version(self, t_id):
+        """Returns the current version of a tournament's standings."""
+        with self._lock:
+            return self._version(t_id)
+
+    def get(self, t_id):
+        """Returns the cached standings of a tournament, None if they aren't
+        cached or have changed since."""
+        with self._lock:
+            entry = self._rows.get(t_id)
+            if entry is None or entry[0] != self._version(t_id):
+                self.misses += 1
+                return None
+            del self._rows[t_id]
+            self._rows[t_id] = entry
+            self.hits += 1
+            return entry[1]
+
+    def set(self, t_id, version, rows):
+        """Caches the standings of a tournament read at version, unless they
+        have changed since."""
+        with self._lock:
+            if version != self._version(t_id):
+                return
+            self._rows.pop(t_id, None)
+            self._rows[t_id] = (version, rows)
+            while len(self._rows) > self.size:
+                self._rows.popitem(last=False)
+
+    def invalidate(self, tournaments=None):
+        """Bumps the version of tournaments, of every tournament if None.
+        The standings of all tournaments (t_id None) change with any of
+        them."""
+        with self._lock:
+            if tournaments is None:
+                self._epoch += 1
+                self._versions = {}
+                self._rows.clear()
+                return
+            for t_id in set(tournaments) | set([None]):
+                self._versions[t_id] = self._versions.get(t_id, 0) + 1
+                self._rows.pop(t_id, None)
+
+
+
+class SharedStandingsCache(object):
+    """Caches standings in a redis server shared by several processes.
+
+    Rows are stored under a key that includes the version they were read
+    at, so a bumped version makes them unreachable and they expire.
+
+    Args:
+     client: redis.StrictRedis() or any client with get, mget, set(key,
+             value, ex=seconds) and incr
+     prefix: prefix of every key
+     expire: seconds cached rows are kept
+    """
+
+    def __init__(self, client, prefix='tournament:standings:', expire=3600):
+        self.client = client
+        self.prefix = prefix
+        self.expire = expire
+
+    def _key(self, t_id):
+        return self.prefix + 'version:%s' % ('all' if t_id is None else t_id)
+
+    def version(self, t_id):
+        """Returns the current version of a tournament's standings."""
+        epoch, version = self.client.mget([self.prefix + 'epoch',
+                                           self._key(t_id)])
+        return '%s.%s' % (int(epoch or 0), int(version or 0))
+
+    def _rowsKey(self, t_id, version):
+        return self.prefix + 'rows:%s:%s' % (t_id, version)
+
+    def get(self, t_id):
+        """Returns the cached standings of a tournament, None if they aren't
+        cached or have changed since."""
+        data = self.client.get(self._rowsKey(t_id, self.version(t_id)))
+        if data is None:
+            return None
+        return [tuple(row) for row in json.loads(data)]
+
+    def set(self, t_id, version, rows):
+        """Caches the standings of a tournament read at version."""
+        self.client.set(self._rowsKey(t_id, version), json.dumps(rows),
+                        ex=self.expire)
+
+    def invalidate(self, tournaments=None):
+        """Bumps the version of tournaments, of every tournament if None."""
+        if tournaments is None:
+            self.client.incr(self.prefix + 'epoch')
+            return
+        for t_id in set(tournaments) | set([None]):
+            self.client.incr(self._key(t_id))
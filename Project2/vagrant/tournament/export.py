@@ -0,0 +1,236 @@
+#!/usr/bin/env python
+#
+# export.py -- binary format of exportTournament() and importTournament()
+#
+# A tournament is written as a header followed by sections. Each section
+# carries its own CRC-32, so the data can be written and read as a stream
+# and a damaged or cut off copy is rejected.
+#
+#   header   'TRNX', format version (uint16), reserved (uint16)
+#   section  tag (4 bytes), count (uint32), payload size (uint32), payload,
+#            CRC-32 of tag, count and payload (uint32)
+#
+# Sections, in this order:
+#   NAME  the tournament name as a string, count 0
+#   PLYR  count players: int32 ids, float64 ratings, int32 rated games,
+#         then each name as a string
+#   MTCH  count matches: int32 winners, int32 losers (0 for a bye), uint8
+#         draws. Repeated, with at most MATCH_CHUNK matches each
+#   END.  count is the total number of matches, no payload
+#
+# A string is its UTF-8 byte length (uint32), NULL_LENGTH for NULL, then the
+# UTF-8 bytes. Data of other versions is rejected.
+#
+# Numbers are little-endian. Every array is packed as array.array would
+# hold it, so reading one is a single copy.
+#
+
+import struct
+import sys
+import zlib
+from array import array
+
+
+MAGIC = 'TRNX'
+VERSION = 2
+
+# Length of a NULL string
+NULL_LENGTH = 0xffffffff
+
+# Most matches in one MTCH section
+MATCH_CHUNK = 65536
+
+
+
+def _pack(typecode, values):
+    """Returns values packed as a little-endian array."""
+    packed = array(typecode, values)
+    if sys.byteorder == 'big':
+        packed.byteswap()
+    return packed.tostring()
+
+
+
+def _unpack(typecode, data, offset, count):
+    """Reads count values of a little-endian array from data at offset.
+
+    Returns:
+      A tuple (array, offset after it).
+    """
+    values = array(typecode)
+    end = offset + values.itemsize * count
+    if end > len(data):
+        raise ValueError("Tournament data has a short section.")
+    values.fromstring(data[offset:end])
+    if sys.byteorder == 'big':
+        values.byteswap()
+    return values, end
+
+
+
+def _packString(text):
+    """Returns a string, or None for NULL, packed with its length."""
+    if text is None:
+        return struct.pack('<I', NULL_LENGTH)
+    if isinstance(text, unicode):
+        text = text.encode('utf-8')
+    if len(text) >= NULL_LENGTH:
+        raise ValueError("A name of %d bytes is too long to export."
+                         % len(text))
+    return struct.pack('<I', len(text)) + text
+
+
+
+def _unpackString(data, offset):
+    """Reads a string packed by _packString() from data at offset.
+
+    Returns:
+      A tuple (string or None, offset after it).
+    """
+    if offset + 4 > len(data):
+        raise ValueError("Tournament data has a short section.")
+    size, = struct.unpack('<I', data[offset:offset + 4])
+    offset += 4
+    if size == NULL_LENGTH:
+        return None, offset
+    if offset + size > len(data):
+        raise ValueError("Tournament data has a short section.")
+    return data[offset:offset + size], offset + size
+
+
+
+def _writeSection(stream, tag, count, payload=''):
+    head = struct.pack('<4sI', tag, count)
+    stream.write(struct.pack('<4sII', tag, count, len(payload)))
+    stream.write(payload)
+    stream.write(struct.pack('<I', zlib.crc32(payload, zlib.crc32(head))
+                             & 0xffffffff))
+
+
+
+def _read(stream, size):
+    data = stream.read(size)
+    if len(data) != size:
+        raise ValueError("Tournament data is truncated.")
+    return data
+
+
+
+def _readSection(stream):
+    """Reads one section and checks its CRC.
+
+    Returns:
+      A tuple (tag, count, payload).
+    """
+    head = _read(stream, 12)
+    tag, count, size = struct.unpack('<4sII', head)
+    payload = _read(stream, size)
+    crc, = struct.unpack('<I', _read(stream, 4))
+    if zlib.crc32(payload, zlib.crc32(head[:8])) & 0xffffffff != crc:
+        raise ValueError("Tournament data section %r is corrupt." % tag)
+    return tag, count, payload
+
+
+
+def write(stream, name, players, matches):
+    """Writes a tournament to a file-like object.
+
+    Args:
+     stream: object with a write method
+     name: tournament name
+     players: list of (p_id, name, rating, games) tuples
+     matches: iterable of (winner, loser, draw) tuples, loser None for a
+              bye, read MATCH_CHUNK at a time
+    """
+    stream.write(struct.pack('<4sHH', MAGIC, VERSION, 0))
+    _writeSection(stream, 'NAME', 0, _packString(name))
+
+    _writeSection(stream, 'PLYR', len(players), ''.join(
+        [_pack('i', [player[0] for player in players]),
+         _pack('d', [player[2] for player in players]),
+         _pack('i', [player[3] for player in players])] +
+        [_packString(player[1]) for player in players]))
+
+    total = 0
+    chunk = []
+    for match in matches:
+        chunk.append(match)
+        if len(chunk) == MATCH_CHUNK:
+            _writeMatches(stream, chunk)
+            total += len(chunk)
+            chunk = []
+    if chunk:
+        _writeMatches(stream, chunk)
+        total += len(chunk)
+    _writeSection(stream, 'END.', total)
+
+
+
+def _writeMatches(stream, matches):
+    _writeSection(stream, 'MTCH', len(matches), ''.join([
+        _pack('i', [match[0] for match in matches]),
+        _pack('i', [match[1] or 0 for match in matches]),
+        _pack('B', [1 if match[2] else 0 for match in matches])]))
+
+
+
+def read(stream):
+    """Reads a tournament written by write(), one section at a time.
+
+    Yields:
+      ('name', name), then ('players', ids, names, ratings, games), then
+      ('matches', winners, losers, draws) for each chunk of matches. Names
+      are UTF-8 strings, None for NULL. The ids, ratings, games, winners
+      and losers are arrays, losers are 0 for a bye.
+
+    Raises:
+     ValueError: the data isn't in this format, is of another version, or is
+                 truncated or corrupt
+    """
+    magic, version, reserved = struct.unpack('<4sHH', _read(stream, 8))
+    if magic != MAGIC:
+        raise ValueError("Not tournament data.")
+    if version != VERSION:
+        raise ValueError("Tournament data version %d isn't version %d."
+                         % (version, VERSION))
+
+    tag, count, payload = _readSection(stream)
+    if tag != 'NAME':
+        raise ValueError("Tournament data has no name section.")
+    name, offset = _unpackString(payload, 0)
+    if offset != len(payload):
+        raise ValueError("Tournament data has a malformed name section.")
+    yield ('name', name)
+
+    tag, count, payload = _readSection(stream)
+    if tag != 'PLYR':
+        raise ValueError("Tournament data has no players section.")
+    ids, offset = _unpack('i', payload, 0, count)
+    ratings, offset = _unpack('d', payload, offset, count)
+    games, offset = _unpack('i', payload, offset, count)
+    names = []
+    for i in range(count):
+        name, offset = _unpackString(payload, offset)
+        names.append(name)
+    if offset != len(payload):
+        raise ValueError("Tournament data has a malformed players section.")
+    yield ('players', ids, names, ratings, games)
+
+    total = 0
+    while True:
+        tag, count, payload = _readSection(stream)
+        if tag == 'END.':
+            if count != total:
+                raise ValueError("Tournament data is missing matches.")
+            return
+        if tag != 'MTCH':
+            raise ValueError("Tournament data has an unknown section %r."
+                             % tag)
+        winners, offset = _unpack('i', payload, 0, count)
+        losers, offset = _unpack('i', payload, offset, count)
+        draws, offset = _unpack('B', payload, offset, count)
+        if offset != len(payload):
+            raise ValueError("Tournament data has a malformed matches "
+                             "section.")
+        total += count
+        yield ('matches', winners, losers, draws)
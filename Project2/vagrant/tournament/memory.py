@@ -0,0 +1,640 @@
+#!/usr/bin/env python
+#
+# memory.py -- in-process storage backend for tournament.py
+#
+# Implements the public functions of tournament.py on arrays held in memory
+# instead of PostgreSQL, for simulating whole events and for running
+# tournament_test.py without a database server. Select it with
+# tournament.setBackend(memory.MemoryBackend()) or by setting the
+# TOURNAMENT_BACKEND=memory environment variable.
+#
+
+import io
+from array import array
+from contextlib import contextmanager
+
+import export
+import pairing
+
+
+COLUMNS = ('wins', 'draws', 'matches', 'score', 'omw', 'oms', 'byes')
+
+# Elo parameters, as in ratings_apply() in tournament.sql
+DEFAULT_RATING = 1500
+ELO_K = 32
+
+
+def expected(rating, other):
+    """Returns the chance that a player rated rating beats one rated other."""
+    return 1.0 / (1 + 10 ** ((other - rating) / 400.0))
+
+
+
+class Standings(object):
+    """The standings of one tournament, stored column by column.
+
+    Row i of each column in COLUMNS belongs to player ids[i]. OMW/OMS are
+    kept current as matches are applied, by passing each change in a
+    player's wins and score on to the opponents they have played.
+    """
+
+    def __init__(self):
+        self.ids = array('l')
+        self.row = {}
+        self.played = {}
+        for name in COLUMNS:
+            setattr(self, name, array('l'))
+
+    def __len__(self):
+        return len(self.ids)
+
+    def add(self, p_id):
+        """Adds a player with no matches."""
+        self.row[p_id] = len(self.ids)
+        self.ids.append(p_id)
+        for name in COLUMNS:
+            getattr(self, name).append(0)
+
+    def remove(self, p_id):
+        """Removes a player by moving the last row into their place."""
+        i = self.row.pop(p_id)
+        last = len(self.ids) - 1
+        for column in [self.ids] + [getattr(self, name) for name in COLUMNS]:
+            column[i] = column[last]
+            column.pop()
+        if i != last:
+            self.row[self.ids[i]] = i
+
+    def copy(self):
+        """Returns an independent copy of the standings."""
+        other = Standings()
+        other.ids = self.ids[:]
+        other.row = dict(self.row)
+        other.played = dict((p_id, set(opponents))
+                            for p_id, opponents in self.played.items())
+        for name in COLUMNS:
+            setattr(other, name, getattr(self, name)[:])
+        return other
+
+    def reset(self):
+        """Clears every player's results."""
+        self.played = {}
+        for name in COLUMNS:
+            setattr(self, name, array('l', [0]) * len(self.ids))
+
+    def load(self, results):
+        """Replaces every player's results with those of a list of
+        (winner, loser, draw) matches.
+
+        Gives the same standings as reset() and apply() for each match, but
+        OMW/OMS are summed once at the end instead of passed on to the
+        opponents after every match.
+        """
+        row, played = self.row, {}
+        n = len(self.ids)
+        wins, draws, matches, byes = [0] * n, [0] * n, [0] * n, [0] * n
+        for winner, loser, draw in results:
+            i = row.get(winner)
+            if loser is None:
+                if i is not None:
+                    wins[i] += 1
+                    matches[i] += 1
+                    byes[i] += 1
+                continue
+
+            j = row.get(loser)
+            if i is not None:
+                matches[i] += 1
+                if draw:
+                    draws[i] += 1
+                else:
+                    wins[i] += 1
+            if j is not None:
+                matches[j] += 1
+                if draw:
+                    draws[j] += 1
+            played.setdefault(winner, set()).add(loser)
+            played.setdefault(loser, set()).add(winner)
+
+        score = [3 * w + d for w, d in zip(wins, draws)]
+        omw, oms = [0] * n, [0] * n
+        for p_id, opponents in played.items():
+            i = row.get(p_id)
+            if i is None:
+                continue
+            for opponent in opponents:
+                j = row.get(opponent)
+                if j is not None:
+                    omw[i] += wins[j]
+                    oms[i] += score[j]
+
+        self.played = played
+        for name, column in zip(COLUMNS, (wins, draws, matches, score, omw,
+                                          oms, byes)):
+            setattr(self, name, array('l', column))
+
+    def apply(self, winner, loser=None, draw=False):
+        """Adds a match to the standings of both players.
+
+        Win = 3pts. Loss = 0pts. Draw = 1pt. A bye counts as a win. Players
+        without a row are skipped, like in the standings table.
+        """
+        if loser is None:
+            self._credit(winner, 1, 0, 1)
+            return
+
+        if draw:
+            self._credit(winner, 0, 1, 0)
+            self._credit(loser, 0, 1, 0)
+        else:
+            self._credit(winner, 1, 0, 0)
+            self._credit(loser, 0, 0, 0)
+        self._meet(winner, loser)
+
+    def _credit(self, p_id, wins, draws, byes):
+        """Adds one match to a player's row and their opponents' tiebreaks."""
+        i = self.row.get(p_id)
+        if i is None:
+            return
+
+        points = 3 * wins + draws
+        self.wins[i] += wins
+        self.draws[i] += draws
+        self.matches[i] += 1
+        self.score[i] += points
+        self.byes[i] += byes
+        if points:
+            for opponent in self.played.get(p_id, ()):
+                j = self.row.get(opponent)
+                if j is not None:
+                    self.omw[j] += wins
+                    self.oms[j] += points
+
+    def _meet(self, a, b):
+        """Records that two players have played each other."""
+        opponents = self.played.setdefault(a, set())
+        if b in opponents:
+            return
+        opponents.add(b)
+        self.played.setdefault(b, set()).add(a)
+
+        i, j = self.row.get(a), self.row.get(b)
+        if i is not None and j is not None:
+            self.omw[i] += self.wins[j]
+            self.oms[i] += self.score[j]
+            self.omw[j] += self.wins[i]
+            self.oms[j] += self.score[i]
+
+    def ranked(self):
+        """Returns the row numbers ordered by wins and oms if there is a tie,
+        like v_standings."""
+        wins, oms, ids = self.wins, self.oms, self.ids
+        return sorted(range(len(ids)),
+                      key=lambda i: (-wins[i], -oms[i], -ids[i]))
+
+
+
+class MemoryBackend(object):
+    """Keeps players, tournaments and matches in memory and implements the
+    public functions of tournament.py on them.
+
+    Tournament 0 holds the players that haven't entered a tournament and the
+    matches reported without one, as in the database. Not thread-safe.
+    """
+
+    def __init__(self):
+        self.names = {}
+        self.ratings = {}
+        self.tournaments = {}
+        self.registered = {}
+        self.standings = {0: Standings()}
+        self.matches = {}
+        self.pairings = {}
+        self.archive = {}
+        self.snapshots = {}
+        self.nextPlayer = 1
+        self.nextTournament = 1
+
+    @contextmanager
+    def transaction(self):
+        """Kept for API compatibility, changes take effect immediately and
+        are not rolled back."""
+        yield None
+
+    def _table(self, t_id):
+        """Returns the standings of a tournament, creating them if needed."""
+        table = self.standings.get(t_id or 0)
+        if table is None:
+            table = self.standings[t_id or 0] = Standings()
+        return table
+
+    def deleteMatches(self):
+        self.matches = {}
+        self.pairings = {}
+        self.snapshots = {}
+        for p_id in self.ratings:
+            self.ratings[p_id] = [DEFAULT_RATING, 0]
+        for table in self.standings.values():
+            table.reset()
+
+    def deletePlayers(self):
+        if any(self.registered.values()) or self.matches:
+            raise ValueError("Players are still registered in tournaments or "
+                             "have matches.")
+        self.names = {}
+        self.ratings = {}
+        self.standings = {0: Standings()}
+
+    def deleteTournaments(self):
+        if any(self.registered.values()) or \
+                [m for t, m in self.matches.items() if t]:
+            raise ValueError("Tournaments still have players or matches.")
+        self.tournaments = {}
+        self.pairings = {}
+
+    def deleteTournament(self, t_id):
+        if t_id == 0:
+            raise ValueError("Tournament 0 holds the matches without a "
+                             "tournament.")
+        self.tournaments.pop(t_id, None)
+        self.registered.pop(t_id, None)
+        self.matches.pop(t_id, None)
+        self.pairings.pop(t_id, None)
+        self.snapshots.pop(t_id, None)
+        table = self.standings.pop(t_id, None)
+        if table is None:
+            return
+
+        # Players in no other tournament go back to tournament 0
+        unassigned = self.standings[0]
+        returned = [p_id for p_id in sorted(table.ids)
+                    if not any(p_id in other.row
+                               for other in self.standings.values())]
+        for p_id in returned:
+            unassigned.add(p_id)
+        if returned:
+            self.rebuildStandings(0)
+
+    def archiveTournament(self, t_id):
+        if t_id not in self.tournaments:
+            raise ValueError("Tournament %s does not exist." % t_id)
+        self.archive[t_id] = {
+            'name': self.tournaments[t_id],
+            'matches': self.matches.get(t_id, []),
+            'registered': self.registered.get(t_id, set()),
+            'standings': self.playerStandings(t_id),
+            'pairings': self.pairings.get(t_id),
+            'snapshots': self.snapshots.get(t_id, {}),
+        }
+        self.deleteTournament(t_id)
+
+    def deleteRegisteredPlayers(self):
+        self.registered = {}
+        unassigned = self.standings[0]
+        self.standings = {0: unassigned}
+        for p_id in sorted(self.names):
+            if p_id not in unassigned.row:
+                unassigned.add(p_id)
+        self.rebuildStandings(0)
+
+    def countPlayers(self):
+        return len(self.names)
+
+    def countTournamentPlayers(self, t_id):
+        return len(self.registered.get(t_id, ()))
+
+    def createTournament(self, name):
+        t_id = self.nextTournament
+        self.nextTournament += 1
+        self.tournaments[t_id] = name
+        return t_id
+
+    def registerPlayer(self, name):
+        p_id = self.nextPlayer
+        self.nextPlayer += 1
+        self.names[p_id] = name
+        self.ratings[p_id] = [DEFAULT_RATING, 0]
+        self.standings[0].add(p_id)
+        return p_id
+
+    def registerPlayers(self, names):
+        return [self.registerPlayer(name) for name in names]
+
+    def enterTournament(self, t_id, p_id):
+        if t_id not in self.tournaments or p_id not in self.names:
+            raise ValueError("Tournament %s or player %s does not exist."
+                             % (t_id, p_id))
+        registered = self.registered.setdefault(t_id, set())
+        if p_id in registered:
+            raise ValueError("Player %s is already registered in tournament "
+                             "%s." % (p_id, t_id))
+        registered.add(p_id)
+        if p_id in self.standings[0].row:
+            self.standings[0].remove(p_id)
+        self._table(t_id).add(p_id)
+
+    def enterTournamentBulk(self, t_id, player_ids):
+        entered = []
+        for p_id in player_ids:
+            if p_id not in self.registered.get(t_id, ()):
+                self.enterTournament(t_id, p_id)
+                entered.append(p_id)
+        return entered
+
+    def playerStandings(self, t_id=None):
+        if t_id != None:
+            table = self.standings.get(t_id)
+            if table is None:
+                return []
+            names = self.names
+            return [(t_id, table.ids[i], names[table.ids[i]], table.wins[i],
+                     table.draws[i], table.matches[i], table.score[i],
+                     table.oms[i], table.byes[i]) for i in table.ranked()]
+
+        standings = []
+        for t in sorted(self.standings):
+            table = self.standings[t]
+            standings.extend((table.ids[i], self.names[table.ids[i]],
+                              table.wins[i], table.matches[i])
+                             for i in table.ranked())
+        return standings
+
+    def iterStandings(self, t_id=None, chunk=1000):
+        for row in self.playerStandings(t_id):
+            yield row
+
+    def playerStandingsPage(self, t_id, after=None, limit=50):
+        table = self.standings.get(t_id)
+        if table is None:
+            return []
+        ranked = table.ranked()
+        start = 0
+        if after != None:
+            i = table.row.get(after)
+            if i is None:
+                return []
+            start = ranked.index(i) + 1
+        names = self.names
+        return [(t_id, table.ids[i], names[table.ids[i]], table.wins[i],
+                 table.draws[i], table.matches[i], table.score[i],
+                 table.oms[i], table.byes[i])
+                for i in ranked[start:start + limit]]
+
+    def playerRatings(self, t_id=None):
+        if t_id != None:
+            players = self.standings.get(t_id, Standings()).ids
+        else:
+            players = self.names
+        ratings = [(p_id, self.names[p_id]) + tuple(self.ratings[p_id])
+                   for p_id in players]
+        ratings.sort(key=lambda row: (-row[2], row[0]))
+        return ratings
+
+    def tournamentMatches(self, t_id=None):
+        return list(self.matches.get(t_id or 0, ()))
+
+    def reportMatch(self, winner, loser=None, t_id=None, draw=False,
+                    bye=False):
+        if t_id != None and t_id not in self.tournaments:
+            raise ValueError("Tournament %s does not exist." % t_id)
+        self.matches.setdefault(t_id or 0, []).append(
+            (winner, loser, bool(draw)))
+        self._table(t_id).apply(winner, loser, draw)
+        if loser != None:
+            self._rate(winner, loser, draw)
+
+    def _rate(self, winner, loser, draw):
+        """Updates the Elo ratings of both players of a match."""
+        a, b = self.ratings[winner], self.ratings[loser]
+        change = ELO_K * ((0.5 if draw else 1.0) - expected(a[0], b[0]))
+        a[0] += change
+        b[0] -= change
+        a[1] += 1
+        b[1] += 1
+
+    def reportMatches(self, t_id, results):
+        seen = set()
+        for result in results:
+            for p_id in result[:2]:
+                if p_id in seen:
+                    raise ValueError(
+                        "Player %s appears in more than one result." % p_id)
+                if p_id != None:
+                    seen.add(p_id)
+
+        missing = [p for p in seen if p not in self._table(t_id).row]
+        if missing:
+            raise ValueError("Players %s aren't registered in tournament %s."
+                             % (sorted(missing), t_id))
+
+        rounds = self.pairings.get(t_id)
+        if rounds:
+            pairs = set(frozenset(pair) for pair in rounds[-1] if pair[1])
+            for result in results:
+                if frozenset(result[:2]) not in pairs:
+                    raise ValueError("Players %s and %s weren't paired in "
+                                     "this round." % tuple(result[:2]))
+
+        for result in results:
+            self.reportMatch(result[0], result[1], t_id,
+                             len(result) > 2 and bool(result[2]))
+
+    def rebuildStandings(self, t_id=None):
+        if t_id == None:
+            tournaments = list(self.standings)
+        else:
+            tournaments = [t_id]
+        for t in tournaments:
+            self._table(t).load(self.matches.get(t, ()))
+
+    def checkBye(self, t_id, p_id):
+        # Like the database, None is tournament 0 and a player that isn't
+        # in the tournament hasn't had a bye
+        return self.hasBye(t_id, p_id)
+
+    def hasPlayed(self, t_id, a, b):
+        return b in self._table(t_id).played.get(a, ())
+
+    def hasBye(self, t_id, p_id):
+        table = self._table(t_id)
+        i = table.row.get(p_id)
+        return i is not None and table.byes[i] != 0
+
+    def opponentsOf(self, t_id, p_id):
+        return frozenset(self._table(t_id).played.get(p_id, ()))
+
+    def checkMatches(self, t_id):
+        table = self.standings.get(t_id)
+        if not table:
+            return None
+        return max(table.matches)
+
+    def swissPairings(self, t_id=None, by_rating=False):
+        pairs, bye = self._pairRound(t_id, by_rating)
+
+        names = self.names
+        return [(id1, names[id1], id2, names[id2]) for (id1, id2) in pairs]
+
+    def startRound(self, t_id, by_rating=False):
+        if t_id not in self.tournaments:
+            raise ValueError("Tournament %s does not exist." % t_id)
+
+        pairs, bye = self._pairRound(t_id, by_rating)
+        self.closeRound(t_id)
+        if bye != None:
+            self.reportMatch(bye, None, t_id)
+        self.pairings.setdefault(t_id, []).append(
+            pairs + ([(bye, None)] if bye != None else []))
+
+        names = self.names
+        return [(id1, names[id1], id2, names[id2]) for (id1, id2) in pairs]
+
+    def _pairRound(self, t_id, by_rating):
+        """Pairs the next round like tournament._pairRound().
+
+        Returns:
+          A tuple (pairs, bye), bye is None if nobody sits out.
+        """
+        table = self._table(t_id)
+        if t_id != None:
+            players = [(table.ids[i], table.score[i], table.matches[i])
+                       for i in table.ranked()]
+        else:
+            # Like the database, every player in the standings is paired
+            players = [(row[0], row[2], row[3])
+                       for row in self.playerStandings()]
+
+        seeded = by_rating and not any(p[2] for p in players)
+        if seeded:
+            rank = dict((row[0], i)
+                        for i, row in enumerate(self.playerRatings(t_id)))
+            players.sort(key=lambda p: rank[p[0]])
+
+        played = table.played
+        byes = set(table.ids[i] for i in range(len(table)) if table.byes[i])
+        bye = None
+        if len(players) % 2 != 0:
+            bye = pairing.chooseBye(players, byes)
+            players = [p for p in players if p[0] != bye]
+
+        if seeded:
+            pairs = pairing.pairByRating([p[0] for p in players])
+        else:
+            pairs = pairing.pairPlayers([(p[0], p[1]) for p in players],
+                                        played)
+        return pairs, bye
+
+    def advanceRound(self, t_id):
+        if t_id not in self.tournaments:
+            raise ValueError("Tournament %s does not exist." % t_id)
+
+        self.closeRound(t_id)
+        table = self._table(t_id)
+        order = table.ranked()
+        bye = None
+        if len(order) % 2 != 0:
+            bye = min(order, key=lambda i: (
+                table.byes[i], table.matches[i], table.wins[i], table.oms[i],
+                table.ids[i]))
+            order.remove(bye)
+
+        ids = table.ids
+        pairs = [(ids[order[i]], ids[order[i + 1]])
+                 for i in range(0, len(order), 2)]
+        rounds = self.pairings.setdefault(t_id, [])
+        rounds.append(pairs + ([(ids[bye], None)] if bye is not None else []))
+        if bye is not None:
+            self.reportMatch(ids[bye], None, t_id)
+
+        names = self.names
+        return [(id1, names[id1], id2, names[id2]) for (id1, id2) in pairs]
+
+    def closeRound(self, t_id):
+        round = len(self.pairings.get(t_id, ()))
+        if not round:
+            return None
+        snapshots = self.snapshots.setdefault(t_id, {})
+        if round not in snapshots:
+            snapshots[round] = (self._table(t_id).copy(),
+                                len(self.matches.get(t_id, ())))
+        return round
+
+    def standingsAt(self, t_id, round):
+        snapshot = self.snapshots.get(t_id, {}).get(round)
+        if snapshot is None:
+            return []
+        table, names = snapshot[0], self.names
+        return [(t_id, table.ids[i], names[table.ids[i]], table.wins[i],
+                 table.draws[i], table.matches[i], table.score[i],
+                 table.oms[i], table.byes[i]) for i in table.ranked()]
+
+    def restoreRound(self, t_id, round):
+        snapshots = self.snapshots.get(t_id, {})
+        if round not in snapshots:
+            raise ValueError("Round %s of tournament %s is not closed."
+                             % (round, t_id))
+        table, count = snapshots[round]
+        del self.matches.setdefault(t_id, [])[count:]
+        del self.pairings.setdefault(t_id, [])[round:]
+        for later in [r for r in snapshots if r > round]:
+            del snapshots[later]
+
+        # Players entered since the round closed start over
+        restored = table.copy()
+        for p_id in self._table(t_id).ids:
+            if p_id not in restored.row:
+                restored.add(p_id)
+        self.standings[t_id] = restored
+
+    def exportTournament(self, t_id, stream=None):
+        if t_id not in self.tournaments:
+            raise ValueError("Tournament %s does not exist." % t_id)
+        out = stream
+        if out is None:
+            out = io.BytesIO()
+        export.write(out, self.tournaments[t_id],
+                     sorted(self.playerRatings(t_id)),
+                     self.matches.get(t_id, []))
+        if stream is None:
+            return out.getvalue()
+
+    def importTournament(self, source):
+        if not hasattr(source, 'read'):
+            source = io.BytesIO(source)
+
+        # Everything is read and checked before anything is changed.
+        # export.read() checks that the sections come in the order of the
+        # format, NAME, PLYR then MTCH
+        matches = []
+        for section in export.read(source):
+            if section[0] == 'name':
+                name = section[1]
+            elif section[0] == 'players':
+                ids, names, ratings, games = section[1:]
+                new = range(self.nextPlayer, self.nextPlayer + len(ids))
+                players = dict(zip(ids, new))
+                players[0] = None
+            elif section[0] == 'matches':
+                winners, losers, draws = section[1:]
+                try:
+                    matches.extend(zip([players[p_id] for p_id in winners],
+                                       [players[p_id] for p_id in losers],
+                                       [bool(draw) for draw in draws]))
+                except KeyError:
+                    raise ValueError("A match has a player that isn't in "
+                                     "the tournament.")
+            else:
+                raise ValueError("Unknown tournament data section %r."
+                                 % section[0])
+
+        self.nextPlayer += len(ids)
+        t_id = self.createTournament(name)
+        table = self.standings[t_id] = Standings()
+        for p_id, player, rating, played in zip(new, names, ratings, games):
+            self.names[p_id] = player
+            self.ratings[p_id] = [rating, played]
+            table.add(p_id)
+        self.registered[t_id] = set(new)
+        self.matches[t_id] = matches
+        table.load(matches)
+        return t_id
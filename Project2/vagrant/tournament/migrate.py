@@ -0,0 +1,84 @@
+#!/usr/bin/env python
+#
+# migrate.py -- brings an existing tournament database up to date
+#
+# Applies the files in migrations/ that the database hasn't had yet, in
+# order, each in its own transaction. Every migration records itself in the
+# schema_version table. A database created from tournament.sql before
+# schema_version existed is taken to be at version 1.
+#
+# Usage: python migrate.py [--status]
+#
+
+import os
+import re
+import sys
+
+import tournament
+
+
+MIGRATIONS = os.path.join(os.path.dirname(os.path.abspath(__file__)),
+                          'migrations')
+
+
+def migrations():
+    """Returns the migrations in MIGRATIONS as a sorted list of
+    (version, path) tuples. Files are named <version>_<description>.sql."""
+    found = []
+    for name in os.listdir(MIGRATIONS):
+        match = re.match(r'(\d+)_.*\.sql$', name)
+        if match:
+            found.append((int(match.group(1)), os.path.join(MIGRATIONS, name)))
+    return sorted(found)
+
+
+
+def schemaVersion():
+    """Returns the version of the database schema."""
+    query = "CREATE TABLE IF NOT EXISTS schema_version\
+     (version INTEGER PRIMARY KEY, description TEXT,\
+     applied TIMESTAMP NOT NULL DEFAULT now());\
+     INSERT INTO schema_version (version, description)\
+     VALUES (1, 'tournament.sql') ON CONFLICT DO NOTHING;\
+     SELECT MAX(version) FROM schema_version;"
+    return tournament.commitQuery(query, None, 1)[0]
+
+
+
+def migrate():
+    """Applies the migrations the database hasn't had.
+
+    Returns:
+      The versions applied, in order.
+    """
+    version = schemaVersion()
+    applied = []
+    for number, path in migrations():
+        if number <= version:
+            continue
+        with open(path) as migration:
+            sql = migration.read()
+        with tournament.transaction():
+            tournament.commitQuery(sql)
+        applied.append(number)
+
+    return applied
+
+
+
+def main(argv):
+    if '--status' in argv[1:]:
+        version = schemaVersion()
+        latest = max([number for number, path in migrations()] + [1])
+        print "Schema version %d, latest %d." % (version, latest)
+        return
+
+    applied = migrate()
+    if applied:
+        print "Applied migrations %s." % ", ".join(str(n) for n in applied)
+    else:
+        print "Already up to date."
+
+
+if __name__ == '__main__':
+    main(sys.argv)
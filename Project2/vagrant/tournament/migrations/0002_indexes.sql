@@ -0,0 +1,36 @@
+-- Migration 2: composite indexes for the hot lookups, and room for the
+-- updates of standings and ratings.
+--
+-- Matches are read by tournament (swissPairings, tournamentMatches,
+-- rebuildStandings) and by player within a tournament (the tiebreak
+-- refresh in standings_apply). t_id is NULL for matches reported without a
+-- tournament, so those queries filter on COALESCE(t_id, 0) and the indexes
+-- are built on the same expression. The per player indexes replace the
+-- single column ones on winner and loser.
+CREATE INDEX matches_tournament_idx ON matches ((COALESCE(t_id, 0)), id);
+CREATE INDEX matches_winner_tournament_idx
+    ON matches (winner, (COALESCE(t_id, 0)));
+CREATE INDEX matches_loser_tournament_idx
+    ON matches (loser, (COALESCE(t_id, 0)));
+DROP INDEX matches_winner_idx;
+DROP INDEX matches_loser_idx;
+
+-- registeredPlayers and standings are keyed by (t_id, p_id). Deleting a
+-- player checks these references by p_id alone, as do the pairings, which
+-- had no index on their players at all.
+CREATE INDEX registeredPlayers_player_idx ON registeredPlayers (p_id);
+CREATE INDEX standings_player_idx ON standings (p_id);
+CREATE INDEX pairings_player1_idx ON pairings (player1);
+CREATE INDEX pairings_player2_idx ON pairings (player2);
+
+-- standings and ratings rows are updated after every match. Leaving room
+-- in each page lets those updates stay on the same page (HOT updates),
+-- without new index entries, and be pruned without a VACUUM. At the
+-- default fillfactor of 100 both tables grew to many times their size over
+-- a few rounds. Only pages written from now on leave the room, run
+-- VACUUM FULL standings, ratings; to rewrite the existing ones.
+ALTER TABLE standings SET (fillfactor = 50);
+ALTER TABLE ratings SET (fillfactor = 50);
+
+INSERT INTO schema_version (version, description)
+VALUES (2, 'composite indexes and fillfactor');
@@ -0,0 +1,419 @@
+-- Migration 3: matches and registeredPlayers partitioned by tournament.
+--
+-- Each tournament gets a partition of both tables, created and dropped
+-- with the tournament, so per tournament queries only read their own
+-- partition and a tournament is deleted or archived by dropping or
+-- detaching its partitions instead of deleting rows.
+-- Needs PostgreSQL 11 or later.
+
+
+-- Tournament 0 holds the matches reported without a tournament, which used
+-- to have a NULL t_id. The partition key is part of the primary key, so it
+-- can't be NULL.
+INSERT INTO tournaments (id, name) VALUES (0, 'No tournament')
+ON CONFLICT DO NOTHING;
+
+
+-- Partition Functions
+-- Create and drop the partitions of one tournament.
+CREATE FUNCTION tournament_partitions_create(tournament INTEGER)
+RETURNS VOID AS $$
+BEGIN
+    EXECUTE format('CREATE TABLE IF NOT EXISTS %I PARTITION OF matches '
+                   'FOR VALUES IN (%s)', 'matches_' || tournament, tournament);
+    EXECUTE format('CREATE TABLE IF NOT EXISTS %I PARTITION OF '
+                   'registeredPlayers FOR VALUES IN (%s)',
+                   'registeredplayers_' || tournament, tournament);
+END;
+$$ LANGUAGE plpgsql;
+
+CREATE FUNCTION tournament_partitions_drop(tournament INTEGER)
+RETURNS VOID AS $$
+BEGIN
+    EXECUTE format('DROP TABLE IF EXISTS %I, %I', 'matches_' || tournament,
+                   'registeredplayers_' || tournament);
+END;
+$$ LANGUAGE plpgsql;
+
+
+-- Matches Table, partitioned
+ALTER SEQUENCE matches_id_seq OWNED BY NONE;
+ALTER TABLE matches RENAME TO matches_old;
+ALTER INDEX matches_pkey RENAME TO matches_old_pkey;
+DROP INDEX matches_tournament_idx, matches_winner_tournament_idx,
+           matches_loser_tournament_idx;
+
+CREATE TABLE matches (id INTEGER NOT NULL
+                      DEFAULT nextval('matches_id_seq'),
+                      t_id INTEGER NOT NULL DEFAULT 0
+                      REFERENCES tournaments (id),
+                      winner INTEGER REFERENCES players (id),
+                      loser INTEGER REFERENCES players (id),
+                      draw BOOLEAN NOT NULL DEFAULT FALSE,
+                      bye BOOLEAN NOT NULL DEFAULT FALSE,
+                      PRIMARY KEY (t_id, id))
+PARTITION BY LIST (t_id);
+
+CREATE INDEX matches_winner_tournament_idx ON matches (winner, t_id);
+CREATE INDEX matches_loser_tournament_idx ON matches (loser, t_id);
+
+
+-- Registered Players Table, partitioned
+ALTER TABLE registeredPlayers RENAME TO registeredPlayers_old;
+ALTER INDEX registeredPlayers_pkey RENAME TO registeredPlayers_old_pkey;
+DROP INDEX registeredPlayers_player_idx;
+
+CREATE TABLE registeredPlayers (t_id INTEGER NOT NULL
+                                REFERENCES tournaments (id),
+                                p_id INTEGER NOT NULL
+                                REFERENCES players (id),
+                                PRIMARY KEY (t_id, p_id))
+PARTITION BY LIST (t_id);
+
+CREATE INDEX registeredPlayers_player_idx ON registeredPlayers (p_id);
+
+
+SELECT tournament_partitions_create(id) FROM tournaments;
+
+INSERT INTO matches (id, t_id, winner, loser, draw, bye)
+SELECT id, COALESCE(t_id, 0), winner, loser, draw, bye FROM matches_old;
+INSERT INTO registeredPlayers (t_id, p_id)
+SELECT t_id, p_id FROM registeredPlayers_old;
+
+DROP TABLE matches_old, registeredPlayers_old;
+ALTER SEQUENCE matches_id_seq OWNED BY matches.id;
+
+
+-- Tournament Triggers
+-- A new tournament gets its partitions. Deleting a tournament drops them;
+-- the foreign keys of the partitions are checked first (their triggers sort
+-- before this one), so a tournament with matches or players still can't be
+-- deleted with a plain DELETE, see tournament_delete().
+CREATE FUNCTION tournaments_partitions() RETURNS TRIGGER AS $$
+BEGIN
+    IF TG_OP = 'INSERT' THEN
+        PERFORM tournament_partitions_create(NEW.id);
+    ELSE
+        PERFORM tournament_partitions_drop(OLD.id);
+    END IF;
+    RETURN NULL;
+END;
+$$ LANGUAGE plpgsql;
+
+CREATE TRIGGER tournaments_partitions AFTER INSERT OR DELETE ON tournaments
+FOR EACH ROW EXECUTE PROCEDURE tournaments_partitions();
+
+
+-- The functions that read matches now take the tournament, so they only
+-- read its partition. Every match passed in must belong to it.
+DROP FUNCTION standings_rebuild(INTEGER);
+DROP FUNCTION advance_round(INTEGER);
+DROP FUNCTION standings_apply(INTEGER[]);
+DROP FUNCTION standings_refresh_tiebreaks(INTEGER[]);
+DROP FUNCTION ratings_apply(INTEGER[]);
+
+
+-- Refresh Tiebreaks Function
+-- Recomputes OMW/OMS of the players in the given matches and of everyone
+-- they have played, which are the only rows whose opponents' totals changed.
+-- OMW/OMS is the sum of wins/score of each distinct opponent in the same
+-- tournament.
+CREATE FUNCTION standings_refresh_tiebreaks(tournament INTEGER, ids INTEGER[])
+RETURNS VOID AS $$
+BEGIN
+    WITH touched AS (
+        SELECT winner AS p_id FROM matches
+        WHERE t_id = tournament AND id = ANY(ids)
+        UNION
+        SELECT loser FROM matches
+        WHERE t_id = tournament AND id = ANY(ids) AND loser IS NOT NULL
+    ), affected AS (
+        SELECT p_id FROM touched
+        UNION
+        SELECT matches.loser FROM touched JOIN matches
+        ON matches.winner = touched.p_id AND matches.t_id = tournament
+        WHERE matches.loser IS NOT NULL
+        UNION
+        SELECT matches.winner FROM touched JOIN matches
+        ON matches.loser = touched.p_id AND matches.t_id = tournament
+    ), played AS (
+        -- Union gathers the distinct opponents of each affected player
+        SELECT affected.p_id, matches.loser AS opponent
+        FROM affected JOIN matches
+        ON matches.winner = affected.p_id AND matches.t_id = tournament
+        WHERE matches.loser IS NOT NULL
+        UNION
+        SELECT affected.p_id, matches.winner
+        FROM affected JOIN matches
+        ON matches.loser = affected.p_id AND matches.t_id = tournament
+    ), totals AS (
+        SELECT affected.p_id,
+        COALESCE(SUM(opponent.wins), 0) AS omw,
+        COALESCE(SUM(opponent.score), 0) AS oms
+        FROM affected
+        LEFT JOIN played ON played.p_id = affected.p_id
+        LEFT JOIN standings AS opponent ON opponent.t_id = tournament
+        AND opponent.p_id = played.opponent
+        GROUP BY affected.p_id
+    )
+    UPDATE standings SET omw = totals.omw, oms = totals.oms
+    FROM totals
+    WHERE standings.t_id = tournament AND standings.p_id = totals.p_id;
+END;
+$$ LANGUAGE plpgsql;
+
+
+-- Apply Matches Function
+-- Adds newly inserted matches of a tournament to the standings of both
+-- players, then refreshes the tiebreaks they affect.
+-- Win = 3pts. Loss = 0pts. Draw = 1pt. A bye counts as a win.
+CREATE FUNCTION standings_apply(tournament INTEGER, ids INTEGER[])
+RETURNS VOID AS $$
+BEGIN
+    UPDATE standings
+    SET wins = standings.wins + delta.wins,
+        draws = standings.draws + delta.draws,
+        matches = standings.matches + delta.matches,
+        byes = standings.byes + delta.byes,
+        score = (standings.wins + delta.wins) * 3
+                + standings.draws + delta.draws
+    FROM (
+        SELECT p_id, SUM(wins) AS wins, SUM(draws) AS draws,
+        COUNT(*) AS matches, SUM(byes) AS byes
+        FROM (
+            SELECT winner AS p_id,
+            CASE WHEN draw THEN 0 ELSE 1 END AS wins,
+            CASE WHEN draw THEN 1 ELSE 0 END AS draws,
+            CASE WHEN bye THEN 1 ELSE 0 END AS byes
+            FROM matches WHERE t_id = tournament AND id = ANY(ids)
+            UNION ALL
+            SELECT loser, 0, CASE WHEN draw THEN 1 ELSE 0 END, 0
+            FROM matches
+            WHERE t_id = tournament AND id = ANY(ids) AND loser IS NOT NULL
+        ) AS sides
+        GROUP BY p_id
+    ) AS delta
+    WHERE standings.t_id = tournament AND standings.p_id = delta.p_id;
+
+    PERFORM standings_refresh_tiebreaks(tournament, ids);
+END;
+$$ LANGUAGE plpgsql;
+
+
+-- Apply Ratings Function
+-- Updates the Elo ratings of the players in newly inserted matches of a
+-- tournament, with K = 32. The matches are rated together against the
+-- ratings from before them, so a batch should have at most one match per
+-- player. Byes don't change ratings.
+CREATE FUNCTION ratings_apply(tournament INTEGER, ids INTEGER[])
+RETURNS VOID AS $$
+BEGIN
+    UPDATE ratings
+    SET rating = ratings.rating + delta.change,
+        games = ratings.games + delta.games
+    FROM (
+        SELECT p_id, SUM(32 * (result - 1 / (1 + 10 ^ ((other - own) / 400))))
+        AS change, COUNT(*) AS games
+        FROM (
+            SELECT matches.winner AS p_id, w.rating AS own, l.rating AS other,
+            CASE WHEN draw THEN 0.5 ELSE 1 END::DOUBLE PRECISION AS result
+            FROM matches
+            JOIN ratings AS w ON w.p_id = matches.winner
+            JOIN ratings AS l ON l.p_id = matches.loser
+            WHERE matches.t_id = tournament AND matches.id = ANY(ids)
+            UNION ALL
+            SELECT matches.loser, l.rating, w.rating,
+            CASE WHEN draw THEN 0.5 ELSE 0 END::DOUBLE PRECISION
+            FROM matches
+            JOIN ratings AS w ON w.p_id = matches.winner
+            JOIN ratings AS l ON l.p_id = matches.loser
+            WHERE matches.t_id = tournament AND matches.id = ANY(ids)
+        ) AS sides
+        GROUP BY p_id
+    ) AS delta
+    WHERE ratings.p_id = delta.p_id;
+END;
+$$ LANGUAGE plpgsql;
+
+
+-- Rebuild Standings Function
+-- Recomputes the standings of one tournament (all of them if NULL) from
+-- the matches table. Only needed to repair the table, the functions in
+-- tournament.py keep it current.
+CREATE FUNCTION standings_rebuild(tournament INTEGER) RETURNS VOID AS $$
+DECLARE
+    t INTEGER;
+BEGIN
+    IF tournament IS NULL THEN
+        FOR t IN SELECT id FROM tournaments LOOP
+            PERFORM standings_rebuild(t);
+        END LOOP;
+        RETURN;
+    END IF;
+
+    UPDATE standings
+    SET wins = 0, draws = 0, matches = 0, score = 0, omw = 0, oms = 0,
+        byes = 0
+    WHERE t_id = tournament;
+
+    PERFORM standings_apply(tournament, ARRAY(
+        SELECT id FROM matches WHERE t_id = tournament));
+END;
+$$ LANGUAGE plpgsql;
+
+
+-- Advance Round Function
+-- Pairs the next round of a tournament and records it in one statement.
+-- With an odd number of players the lowest ranked player that hasn't had a
+-- bye (fewest matches first) is given one, which is recorded as a win. The
+-- others are paired with the player adjacent to them in the standings.
+-- Returns the pairs in board order, not including the bye.
+CREATE FUNCTION advance_round(tournament INTEGER)
+RETURNS TABLE (id1 INTEGER, name1 TEXT, id2 INTEGER, name2 TEXT) AS $$
+DECLARE
+    next_round INTEGER;
+    bye_player INTEGER;
+BEGIN
+    -- Locking the tournament makes concurrent calls pair rounds one by one
+    PERFORM 1 FROM tournaments WHERE id = tournament FOR UPDATE;
+    IF NOT FOUND THEN
+        RAISE EXCEPTION 'Tournament % does not exist', tournament;
+    END IF;
+
+    SELECT COALESCE(MAX(round), 0) + 1 INTO next_round
+    FROM pairings WHERE t_id = tournament;
+
+    IF (SELECT count(*) FROM standings WHERE t_id = tournament) % 2 = 1 THEN
+        SELECT p_id INTO bye_player FROM standings WHERE t_id = tournament
+        ORDER BY byes, matches, wins, oms, p_id LIMIT 1;
+    END IF;
+
+    INSERT INTO pairings (t_id, round, board, player1, player2)
+    SELECT tournament, next_round, (rank + 1) / 2, player1, player2
+    FROM (
+        SELECT p_id AS player1, lead(p_id) OVER ranked AS player2,
+        row_number() OVER ranked AS rank
+        FROM standings
+        WHERE t_id = tournament AND p_id IS DISTINCT FROM bye_player
+        WINDOW ranked AS (ORDER BY wins DESC, oms DESC, p_id DESC)
+    ) AS ranked
+    WHERE rank % 2 = 1;
+
+    IF bye_player IS NOT NULL THEN
+        INSERT INTO pairings (t_id, round, player1)
+        VALUES (tournament, next_round, bye_player);
+        INSERT INTO matches (t_id, winner, bye)
+        VALUES (tournament, bye_player, TRUE);
+        PERFORM standings_apply(tournament,
+                                ARRAY[currval('matches_id_seq')::integer]);
+    END IF;
+
+    RETURN QUERY
+    SELECT pairings.player1, p1.name, pairings.player2, p2.name
+    FROM pairings
+    JOIN players AS p1 ON p1.id = pairings.player1
+    JOIN players AS p2 ON p2.id = pairings.player2
+    WHERE pairings.t_id = tournament AND pairings.round = next_round
+    ORDER BY pairings.board;
+END;
+$$ LANGUAGE plpgsql;
+
+
+-- Delete Tournament Function
+-- Deletes a tournament with everything in it. Its matches and registrations
+-- go with their partitions, its pairings and standings are found through
+-- their t_id indexes. Players that were in no other tournament go back to
+-- tournament 0. Ratings keep the results of its matches.
+CREATE FUNCTION tournament_delete(tournament INTEGER) RETURNS VOID AS $$
+DECLARE
+    returned INTEGER;
+BEGIN
+    IF tournament = 0 THEN
+        RAISE EXCEPTION 'Tournament 0 holds the matches without a tournament';
+    END IF;
+
+    PERFORM tournament_partitions_drop(tournament);
+    DELETE FROM pairings WHERE t_id = tournament;
+
+    -- The statement still sees the rows it deletes, hence t_id <> tournament
+    WITH gone AS (
+        DELETE FROM standings WHERE t_id = tournament RETURNING p_id
+    )
+    INSERT INTO standings (t_id, p_id)
+    SELECT 0, gone.p_id FROM gone
+    WHERE NOT EXISTS (SELECT 1 FROM standings
+                      WHERE standings.p_id = gone.p_id
+                      AND standings.t_id <> tournament);
+    GET DIAGNOSTICS returned = ROW_COUNT;
+
+    DELETE FROM tournaments WHERE id = tournament;
+
+    IF returned > 0 THEN
+        PERFORM standings_rebuild(0);
+    END IF;
+END;
+$$ LANGUAGE plpgsql;
+
+
+-- Archive Tournament Function
+-- Moves a tournament out of the live tables into the archive schema:
+--   archive.tournaments             the tournament's id and name
+--   archive.matches_<id>            its matches partition, detached
+--   archive.registeredplayers_<id>  its registrations partition, detached
+--   archive.standings_<id>          its final standings, with names
+--   archive.pairings_<id>           its pairings
+-- The archived tables have no foreign keys, so the players can still be
+-- deleted. Then the tournament is deleted as by tournament_delete().
+CREATE SCHEMA archive;
+
+CREATE TABLE archive.tournaments (id INTEGER PRIMARY KEY,
+                                  name TEXT,
+                                  archived TIMESTAMP NOT NULL DEFAULT now());
+
+CREATE FUNCTION tournament_archive(tournament INTEGER) RETURNS VOID AS $$
+DECLARE
+    fk RECORD;
+BEGIN
+    IF tournament = 0 THEN
+        RAISE EXCEPTION 'Tournament 0 holds the matches without a tournament';
+    END IF;
+
+    INSERT INTO archive.tournaments (id, name)
+    SELECT id, name FROM tournaments WHERE id = tournament;
+    IF NOT FOUND THEN
+        RAISE EXCEPTION 'Tournament % does not exist', tournament;
+    END IF;
+
+    EXECUTE format('ALTER TABLE matches DETACH PARTITION %I',
+                   'matches_' || tournament);
+    EXECUTE format('ALTER TABLE registeredPlayers DETACH PARTITION %I',
+                   'registeredplayers_' || tournament);
+    EXECUTE format('ALTER TABLE %I SET SCHEMA archive',
+                   'matches_' || tournament);
+    EXECUTE format('ALTER TABLE %I SET SCHEMA archive',
+                   'registeredplayers_' || tournament);
+
+    FOR fk IN SELECT conrelid::regclass AS tbl, conname FROM pg_constraint
+              WHERE contype = 'f' AND conrelid IN (
+                  format('archive.%I', 'matches_' || tournament)::regclass,
+                  format('archive.%I',
+                         'registeredplayers_' || tournament)::regclass)
+    LOOP
+        EXECUTE format('ALTER TABLE %s DROP CONSTRAINT %I', fk.tbl,
+                       fk.conname);
+    END LOOP;
+
+    EXECUTE format('CREATE TABLE archive.%I AS '
+                   'SELECT * FROM v_standings WHERE t_id = %s',
+                   'standings_' || tournament, tournament);
+    EXECUTE format('CREATE TABLE archive.%I AS '
+                   'SELECT * FROM pairings WHERE t_id = %s',
+                   'pairings_' || tournament, tournament);
+
+    PERFORM tournament_delete(tournament);
+END;
+$$ LANGUAGE plpgsql;
+
+
+INSERT INTO schema_version (version, description)
+VALUES (3, 'matches and registeredPlayers partitioned by tournament');
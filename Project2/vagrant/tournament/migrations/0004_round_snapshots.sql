@@ -0,0 +1,227 @@
+-- Migration 4: standings snapshots at the end of each round.
+--
+-- round_snapshots keeps a copy of a tournament's standings rows as they
+-- were when each round closed, so past standings are read with one index
+-- lookup instead of replaying the matches, and a tournament can be rolled
+-- back to the end of any round. Rows are only ever added, except by
+-- round_restore(), which removes the snapshots of the rounds it undoes.
+
+
+-- Round Snapshots Table, partitioned like matches
+-- last_match_id is the last match of the tournament when the round closed.
+CREATE TABLE round_snapshots (t_id INTEGER NOT NULL
+                              REFERENCES tournaments (id),
+                              round INTEGER NOT NULL,
+                              p_id INTEGER NOT NULL REFERENCES players (id),
+                              wins INTEGER NOT NULL,
+                              draws INTEGER NOT NULL,
+                              matches INTEGER NOT NULL,
+                              score INTEGER NOT NULL,
+                              omw INTEGER NOT NULL,
+                              oms INTEGER NOT NULL,
+                              byes INTEGER NOT NULL,
+                              last_match_id INTEGER NOT NULL,
+                              PRIMARY KEY (t_id, round, p_id))
+PARTITION BY LIST (t_id);
+
+
+-- Partition Functions
+-- Tournaments get a round_snapshots partition along with the others.
+CREATE OR REPLACE FUNCTION tournament_partitions_create(tournament INTEGER)
+RETURNS VOID AS $$
+BEGIN
+    EXECUTE format('CREATE TABLE IF NOT EXISTS %I PARTITION OF matches '
+                   'FOR VALUES IN (%s)', 'matches_' || tournament, tournament);
+    EXECUTE format('CREATE TABLE IF NOT EXISTS %I PARTITION OF '
+                   'registeredPlayers FOR VALUES IN (%s)',
+                   'registeredplayers_' || tournament, tournament);
+    EXECUTE format('CREATE TABLE IF NOT EXISTS %I PARTITION OF '
+                   'round_snapshots FOR VALUES IN (%s)',
+                   'round_snapshots_' || tournament, tournament);
+END;
+$$ LANGUAGE plpgsql;
+
+CREATE OR REPLACE FUNCTION tournament_partitions_drop(tournament INTEGER)
+RETURNS VOID AS $$
+BEGIN
+    EXECUTE format('DROP TABLE IF EXISTS %I, %I, %I', 'matches_' || tournament,
+                   'registeredplayers_' || tournament,
+                   'round_snapshots_' || tournament);
+END;
+$$ LANGUAGE plpgsql;
+
+SELECT tournament_partitions_create(id) FROM tournaments;
+
+
+-- Close Round Function
+-- Snapshots the standings of a tournament as the end of round closing.
+-- Does nothing if the round is already closed, or if closing is NULL or 0
+-- (no round has been paired yet).
+CREATE FUNCTION round_close(tournament INTEGER, closing INTEGER)
+RETURNS VOID AS $$
+BEGIN
+    IF COALESCE(closing, 0) = 0 OR EXISTS (
+            SELECT 1 FROM round_snapshots
+            WHERE t_id = tournament AND round = closing) THEN
+        RETURN;
+    END IF;
+
+    INSERT INTO round_snapshots (t_id, round, p_id, wins, draws, matches,
+                                 score, omw, oms, byes, last_match_id)
+    SELECT tournament, closing, p_id, wins, draws, matches, score, omw, oms,
+    byes, (SELECT COALESCE(MAX(id), 0) FROM matches WHERE t_id = tournament)
+    FROM standings WHERE t_id = tournament;
+END;
+$$ LANGUAGE plpgsql;
+
+
+-- Restore Round Function
+-- Rolls a tournament back to the end of a closed round: the matches,
+-- pairings and snapshots that came after it are deleted and the standings
+-- are copied back from its snapshot. Players entered since have their
+-- results cleared. Ratings are kept.
+CREATE FUNCTION round_restore(tournament INTEGER, restored INTEGER)
+RETURNS VOID AS $$
+DECLARE
+    last INTEGER;
+BEGIN
+    SELECT last_match_id INTO last FROM round_snapshots
+    WHERE t_id = tournament AND round = restored LIMIT 1;
+    IF NOT FOUND THEN
+        RAISE EXCEPTION 'Round % of tournament % is not closed', restored,
+                        tournament;
+    END IF;
+
+    DELETE FROM matches WHERE t_id = tournament AND id > last;
+    DELETE FROM pairings WHERE t_id = tournament AND round > restored;
+    DELETE FROM round_snapshots WHERE t_id = tournament AND round > restored;
+
+    UPDATE standings
+    SET wins = snapshot.wins, draws = snapshot.draws,
+        matches = snapshot.matches, score = snapshot.score,
+        omw = snapshot.omw, oms = snapshot.oms, byes = snapshot.byes
+    FROM round_snapshots AS snapshot
+    WHERE standings.t_id = tournament AND snapshot.t_id = tournament
+    AND snapshot.round = restored AND snapshot.p_id = standings.p_id;
+
+    UPDATE standings
+    SET wins = 0, draws = 0, matches = 0, score = 0, omw = 0, oms = 0,
+        byes = 0
+    WHERE t_id = tournament AND NOT EXISTS (
+        SELECT 1 FROM round_snapshots AS snapshot
+        WHERE snapshot.t_id = tournament AND snapshot.round = restored
+        AND snapshot.p_id = standings.p_id);
+END;
+$$ LANGUAGE plpgsql;
+
+
+-- Advance Round Function
+-- Closes the last round, then pairs the next round of a tournament and
+-- records it in one statement.
+-- With an odd number of players the lowest ranked player that hasn't had a
+-- bye (fewest matches first) is given one, which is recorded as a win. The
+-- others are paired with the player adjacent to them in the standings,
+-- rematches included.
+-- Returns the pairs in board order, not including the bye.
+CREATE OR REPLACE FUNCTION advance_round(tournament INTEGER)
+RETURNS TABLE (id1 INTEGER, name1 TEXT, id2 INTEGER, name2 TEXT) AS $$
+DECLARE
+    next_round INTEGER;
+    bye_player INTEGER;
+BEGIN
+    -- Locking the tournament makes concurrent calls pair rounds one by one
+    PERFORM 1 FROM tournaments WHERE id = tournament FOR UPDATE;
+    IF NOT FOUND THEN
+        RAISE EXCEPTION 'Tournament % does not exist', tournament;
+    END IF;
+
+    SELECT COALESCE(MAX(round), 0) + 1 INTO next_round
+    FROM pairings WHERE t_id = tournament;
+
+    PERFORM round_close(tournament, next_round - 1);
+
+    IF (SELECT count(*) FROM standings WHERE t_id = tournament) % 2 = 1 THEN
+        SELECT p_id INTO bye_player FROM standings WHERE t_id = tournament
+        ORDER BY byes, matches, wins, oms, p_id LIMIT 1;
+    END IF;
+
+    INSERT INTO pairings (t_id, round, board, player1, player2)
+    SELECT tournament, next_round, (rank + 1) / 2, player1, player2
+    FROM (
+        SELECT p_id AS player1, lead(p_id) OVER ranked AS player2,
+        row_number() OVER ranked AS rank
+        FROM standings
+        WHERE t_id = tournament AND p_id IS DISTINCT FROM bye_player
+        WINDOW ranked AS (ORDER BY wins DESC, oms DESC, p_id DESC)
+    ) AS ranked
+    WHERE rank % 2 = 1;
+
+    IF bye_player IS NOT NULL THEN
+        INSERT INTO pairings (t_id, round, player1)
+        VALUES (tournament, next_round, bye_player);
+        INSERT INTO matches (t_id, winner, bye)
+        VALUES (tournament, bye_player, TRUE);
+        PERFORM standings_apply(tournament,
+                                ARRAY[currval('matches_id_seq')::integer]);
+    END IF;
+
+    RETURN QUERY
+    SELECT pairings.player1, p1.name, pairings.player2, p2.name
+    FROM pairings
+    JOIN players AS p1 ON p1.id = pairings.player1
+    JOIN players AS p2 ON p2.id = pairings.player2
+    WHERE pairings.t_id = tournament AND pairings.round = next_round
+    ORDER BY pairings.board;
+END;
+$$ LANGUAGE plpgsql;
+
+
+-- Archive Tournament Function
+-- As before, with the round_snapshots partition detached into
+-- archive.round_snapshots_<id> as well.
+CREATE OR REPLACE FUNCTION tournament_archive(tournament INTEGER)
+RETURNS VOID AS $$
+DECLARE
+    partitioned TEXT;
+    fk RECORD;
+BEGIN
+    IF tournament = 0 THEN
+        RAISE EXCEPTION 'Tournament 0 holds the matches without a tournament';
+    END IF;
+
+    INSERT INTO archive.tournaments (id, name)
+    SELECT id, name FROM tournaments WHERE id = tournament;
+    IF NOT FOUND THEN
+        RAISE EXCEPTION 'Tournament % does not exist', tournament;
+    END IF;
+
+    FOREACH partitioned IN ARRAY
+            ARRAY['matches', 'registeredplayers', 'round_snapshots'] LOOP
+        EXECUTE format('ALTER TABLE %I DETACH PARTITION %I', partitioned,
+                       partitioned || '_' || tournament);
+        EXECUTE format('ALTER TABLE %I SET SCHEMA archive',
+                       partitioned || '_' || tournament);
+
+        FOR fk IN SELECT conname FROM pg_constraint
+                  WHERE contype = 'f' AND conrelid = format(
+                      'archive.%I', partitioned || '_' || tournament)::regclass
+        LOOP
+            EXECUTE format('ALTER TABLE archive.%I DROP CONSTRAINT %I',
+                           partitioned || '_' || tournament, fk.conname);
+        END LOOP;
+    END LOOP;
+
+    EXECUTE format('CREATE TABLE archive.%I AS '
+                   'SELECT * FROM v_standings WHERE t_id = %s',
+                   'standings_' || tournament, tournament);
+    EXECUTE format('CREATE TABLE archive.%I AS '
+                   'SELECT * FROM pairings WHERE t_id = %s',
+                   'pairings_' || tournament, tournament);
+
+    PERFORM tournament_delete(tournament);
+END;
+$$ LANGUAGE plpgsql;
+
+
+INSERT INTO schema_version (version, description)
+VALUES (4, 'round snapshots');
@@ -0,0 +1,16 @@
+-- Migration 5: an index on the standings in ranking order.
+--
+-- playerStandingsPage() pages a tournament's standings by keyset on
+-- (wins, oms, p_id), highest first, and the primary key (t_id, p_id)
+-- doesn't have that order, so every page filtered and top-N sorted all of
+-- the tournament's standings rows. Scanning this index a page reads only
+-- its own rows, after the last row of the previous one.
+--
+-- wins and oms change with every match, so those updates are no longer
+-- HOT and add an entry to this index each. The fillfactor of migration 2
+-- still keeps the new row versions on the same page.
+CREATE INDEX standings_ranking_idx
+    ON standings (t_id, wins DESC, oms DESC, p_id DESC);
+
+INSERT INTO schema_version (version, description)
+VALUES (5, 'standings ranking index');
@@ -0,0 +1,247 @@
+#!/usr/bin/env python
+#
+# monitor.py -- statement and call timings for tournament.py
+#
+# A Monitor installed with tournament.setMonitor() is told about every SQL
+# statement the module runs and every public function called. It keeps a
+# latency histogram and row count per statement, a latency histogram and
+# query count per function, and logs statements slower than a threshold
+# with their parameters. For the prepared STATEMENTS of tournament.py it
+# counts how often the connection already had them prepared and estimates
+# the time that saved. Nothing is recorded while no monitor is set.
+#
+
+import logging
+import threading
+from contextlib import contextmanager
+from timeit import default_timer
+
+
+# Upper bounds of the histogram buckets, in milliseconds
+BUCKETS_MS = (0.1, 0.25, 0.5, 1, 2.5, 5, 10, 25, 50, 100, 250, 500, 1000,
+              2500, 10000)
+
+
+
+class Histogram(object):
+    """Counts latencies in the buckets of BUCKETS_MS, plus one for anything
+    slower."""
+
+    def __init__(self):
+        self.buckets = [0] * (len(BUCKETS_MS) + 1)
+        self.count = 0
+        self.total = 0.0
+        self.max = 0.0
+
+    def add(self, seconds):
+        ms = 1000 * seconds
+        i = 0
+        while i < len(BUCKETS_MS) and ms > BUCKETS_MS[i]:
+            i += 1
+        self.buckets[i] += 1
+        self.count += 1
+        self.total += ms
+        if ms > self.max:
+            self.max = ms
+
+    def percentile(self, p):
+        """Returns the upper bound of the bucket holding the p-th percentile,
+        in milliseconds, or the maximum for the last bucket."""
+        if not self.count:
+            return None
+        rank = p / 100.0 * self.count
+        seen = 0
+        for i, count in enumerate(self.buckets):
+            seen += count
+            if seen >= rank and count:
+                return BUCKETS_MS[i] if i < len(BUCKETS_MS) else self.max
+        return self.max
+
+    def report(self):
+        return {
+            'count': self.count,
+            'total_ms': self.total,
+            'mean_ms': self.total / self.count if self.count else None,
+            'max_ms': self.max,
+            'p50_ms': self.percentile(50),
+            'p99_ms': self.percentile(99),
+            'buckets': dict(zip([str(b) for b in BUCKETS_MS] + ['inf'],
+                                self.buckets)),
+        }
+
+
+
+class Monitor(object):
+    """Records statement and call timings, see tournament.setMonitor().
+
+    Args:
+     slow: statements taking at least this many seconds are logged with
+           their parameters, None to log nothing
+     log: logger of the slow statements, 'tournament.slow' by default
+
+    Attributes:
+     statements: dict of statement text to {'latency': Histogram,
+                 'rows': rows returned or changed}
+     calls: dict of function name to {'latency': Histogram, 'queries':
+            statements run, including by the functions it called}
+     prepares: dict of prepared statement name to {'hits': executions on a
+               connection that had prepared it, 'misses': executions that
+               had to prepare it first, 'prepare': Histogram of the time
+               preparing took}
+     queries: number of statements run
+    """
+
+    def __init__(self, slow=0.1, log=None):
+        self.slow = slow
+        self.log = log or logging.getLogger('tournament.slow')
+        self._lock = threading.Lock()
+        self._local = threading.local()
+        self._keys = {}
+        self.reset()
+
+    def reset(self):
+        """Forgets everything recorded so far."""
+        with self._lock:
+            self.statements = {}
+            self.calls = {}
+            self.prepares = {}
+            self.queries = 0
+
+    def _stack(self):
+        """Returns the frames of the calls running in this thread, each a
+        list holding the number of statements run so far."""
+        stack = getattr(self._local, 'stack', None)
+        if stack is None:
+            stack = self._local.stack = []
+        return stack
+
+    def _record(self, name, seconds, queries):
+        with self._lock:
+            stats = self.calls.get(name)
+            if stats is None:
+                stats = self.calls[name] = {'latency': Histogram(),
+                                            'queries': 0}
+            stats['latency'].add(seconds)
+            stats['queries'] += queries
+
+    @contextmanager
+    def call(self, name):
+        """Times a call of a public function."""
+        stack = self._stack()
+        frame = [0]
+        stack.append(frame)
+        start = default_timer()
+        try:
+            yield
+        finally:
+            seconds = default_timer() - start
+            stack.pop()
+            self._record(name, seconds, frame[0])
+
+    def iterate(self, name, items):
+        """Yields the items of the iterator returned by a public function,
+        timed as one call of it.
+
+        Only the time spent getting each item counts, with the statements
+        run meanwhile, not what the caller does in between. The call is
+        recorded once the items run out or the generator is closed, which
+        closes items, so the clean-up of one left early counts too.
+        """
+        stack = self._stack()
+        frame = [0]
+        seconds = 0.0
+        try:
+            while True:
+                stack.append(frame)
+                start = default_timer()
+                try:
+                    item = next(items)
+                except StopIteration:
+                    return
+                finally:
+                    seconds += default_timer() - start
+                    stack.pop()
+                yield item
+        finally:
+            close = getattr(items, 'close', None)
+            if close is not None:
+                stack.append(frame)
+                start = default_timer()
+                try:
+                    close()
+                finally:
+                    seconds += default_timer() - start
+                    stack.pop()
+            self._record(name, seconds, frame[0])
+
+    def statement(self, query, args, seconds, rows):
+        """Records a statement that took seconds and returned or changed
+        rows rows (-1 if unknown)."""
+        key = self._keys.get(query)
+        if key is None:
+            key = self._keys[query] = ' '.join(query.split())
+
+        for frame in getattr(self._local, 'stack', ()):
+            frame[0] += 1
+        with self._lock:
+            self.queries += 1
+            stats = self.statements.get(key)
+            if stats is None:
+                stats = self.statements[key] = {'latency': Histogram(),
+                                                'rows': 0}
+            stats['latency'].add(seconds)
+            if rows > 0:
+                stats['rows'] += rows
+
+        if self.slow is not None and seconds >= self.slow:
+            self.log.warning("%.1f ms: %s %r", 1000 * seconds, key, args)
+
+    def prepared(self, name, hit, seconds=None):
+        """Records an execution of a prepared statement, hit if the
+        connection had prepared it already, or else the seconds preparing
+        it took."""
+        with self._lock:
+            stats = self.prepares.get(name)
+            if stats is None:
+                stats = self.prepares[name] = {'hits': 0, 'misses': 0,
+                                               'prepare': Histogram()}
+            if hit:
+                stats['hits'] += 1
+            else:
+                stats['misses'] += 1
+                stats['prepare'].add(seconds)
+
+    def _preparedReport(self, stats):
+        """Returns the hit rate of a prepared statement and the time saved
+        by its hits, estimated as hits times the mean time preparing it
+        took. That is the parsing and analysis each hit skipped, the
+        planning PostgreSQL saves once it settles on a generic plan isn't
+        counted."""
+        hits, prepare = stats['hits'], stats['prepare']
+        executions = hits + stats['misses']
+        mean = prepare.total / prepare.count if prepare.count else None
+        return {
+            'hits': hits,
+            'misses': stats['misses'],
+            'hit_rate': float(hits) / executions if executions else None,
+            'prepare_ms': mean,
+            'saved_ms': hits * mean if mean is not None else None,
+        }
+
+    def report(self):
+        """Returns everything recorded as a dict that can be dumped as
+        JSON."""
+        with self._lock:
+            return {
+                'queries': self.queries,
+                'statements': dict(
+                    (key, dict(stats['latency'].report(), rows=stats['rows']))
+                    for key, stats in self.statements.items()),
+                'calls': dict(
+                    (name, dict(stats['latency'].report(),
+                                queries=stats['queries']))
+                    for name, stats in self.calls.items()),
+                'prepared': dict(
+                    (name, self._preparedReport(stats))
+                    for name, stats in self.prepares.items()),
+            }
@@ -0,0 +1,277 @@
+#!/usr/bin/env python
+#
+# pairing.py -- Swiss pairing engine that avoids rematches
+#
+# Works on plain lists and dicts so it can pair rounds from the database,
+# from memory, or from a simulation alike.
+#
+
+
+def buildHistory(matches):
+    """Builds the opponent index of a tournament from its matches.
+
+    Args:
+     matches: iterable of (winner, loser) tuples, loser is None for a bye
+
+    Returns:
+      A tuple (played, byes)
+        played: dict of player id to the set of ids they have played
+        byes: set of the ids of players that have had a bye
+    """
+    played = {}
+    byes = set()
+    for winner, loser in matches:
+        if loser is None:
+            byes.add(winner)
+            continue
+        played.setdefault(winner, set()).add(loser)
+        played.setdefault(loser, set()).add(winner)
+
+    return played, byes
+
+
+
+def chooseBye(players, byes):
+    """Picks the player that sits out the round when the count is odd.
+
+    That is the lowest ranked player that hasn't had a bye, preferring
+    players that have played the fewest matches. If everyone has had a bye
+    the lowest ranked player with the fewest matches is picked.
+
+    Args:
+     players: list of (p_id, score, matches) tuples in standings order
+     byes: set of the ids of players that have had a bye
+
+    Returns:
+      The id of the player given the bye.
+    """
+    best = None
+    for rank in range(len(players) - 1, -1, -1):
+        p_id, score, matches = players[rank]
+        key = (p_id in byes, matches)
+        if best is None or key < best[0]:
+            best = (key, p_id)
+            if key == (False, 0):
+                break
+
+    return best[1]
+
+
+
+def _pairGroup(pool, played):
+    """Greedily pairs each player with the closest ranked player they
+    haven't played yet.
+
+    Returns:
+      A tuple (pairs, leftover), leftover lists the players that couldn't
+      be paired in rank order.
+    """
+    pairs = []
+    leftover = []
+    taken = set()
+    none = ()
+
+    for i in range(len(pool)):
+        a = pool[i]
+        if a in taken:
+            continue
+        opponents = played.get(a, none)
+        j = i + 1
+        while j < len(pool):
+            b = pool[j]
+            if b not in taken and b not in opponents:
+                taken.add(a)
+                taken.add(b)
+                pairs.append((a, b))
+                break
+            j += 1
+        else:
+            leftover.append(a)
+
+    return pairs, leftover
+
+
+
+def _neighbours(v, n, opponents):
+    """Yields the players v hasn't played, closest ranked first."""
+    for d in range(1, n):
+        if v - d >= 0 and v - d not in opponents:
+            yield v - d
+        if v + d < n and v + d not in opponents:
+            yield v + d
+        if v - d < 0 and v + d >= n:
+            break
+
+
+
+def _augment(root, mate, blocked):
+    """Looks for an augmenting path from the unpaired player root, Edmonds'
+    blossom algorithm, and flips the pairs along it.
+
+    Players are indexes in standings order. Paths are grown towards the
+    closest ranked players first, so the pairs that change are mostly near
+    root.
+
+    Returns:
+      True if root was paired, False if no augmenting path exists.
+    """
+    n = len(mate)
+    parent = [-1] * n
+    base = list(range(n))
+    used = [False] * n
+    used[root] = True
+    queue = [root]
+
+    def commonBase(a, b):
+        seen = set()
+        while True:
+            a = base[a]
+            seen.add(a)
+            if mate[a] == -1:
+                break
+            a = parent[mate[a]]
+        while True:
+            b = base[b]
+            if b in seen:
+                return b
+            b = parent[mate[b]]
+
+    def markPath(v, b, child, blossom):
+        while base[v] != b:
+            blossom[base[v]] = blossom[base[mate[v]]] = True
+            parent[v] = child
+            child = mate[v]
+            v = parent[mate[v]]
+
+    head = 0
+    while head < len(queue):
+        v = queue[head]
+        head += 1
+        for to in _neighbours(v, n, blocked[v]):
+            if base[v] == base[to] or mate[v] == to:
+                continue
+            if to == root or (mate[to] != -1 and parent[mate[to]] != -1):
+                b = commonBase(v, to)
+                blossom = [False] * n
+                markPath(v, b, to, blossom)
+                markPath(to, b, v, blossom)
+                for i in range(n):
+                    if blossom[base[i]]:
+                        base[i] = b
+                        if not used[i]:
+                            used[i] = True
+                            queue.append(i)
+            elif parent[to] == -1:
+                parent[to] = v
+                if mate[to] == -1:
+                    while to != -1:
+                        v = parent[to]
+                        after = mate[v]
+                        mate[to], mate[v] = v, to
+                        to = after
+                    return True
+                used[mate[to]] = True
+                queue.append(mate[to])
+
+    return False
+
+
+
+def _repair(ranked, pairs, leftover, played):
+    """Pairs the players left over at the bottom of the standings.
+
+    The greedy pairs are kept as a starting matching and each leftover
+    player is paired through an augmenting path, which reshuffles only the
+    pairs along it. That finds a round without rematches whenever one
+    exists. Players still unpaired after that have all played each other
+    and are paired in rank order, the fewest rematches possible.
+
+    Returns:
+      A list of (id1, id2) tuples, in standings order.
+    """
+    index = dict((p_id, i) for i, p_id in enumerate(ranked))
+    none = ()
+    blocked = [set(index[o] for o in played.get(p_id, none) if o in index)
+               for p_id in ranked]
+    mate = [-1] * len(ranked)
+    for a, b in pairs:
+        mate[index[a]], mate[index[b]] = index[b], index[a]
+
+    unpaired = []
+    for p_id in leftover:
+        v = index[p_id]
+        if mate[v] == -1 and not _augment(v, mate, blocked):
+            unpaired.append(v)
+    unpaired = sorted(v for v in unpaired if mate[v] == -1)
+    for i in range(0, len(unpaired), 2):
+        mate[unpaired[i]], mate[unpaired[i + 1]] = unpaired[i + 1], unpaired[i]
+
+    return [(ranked[v], ranked[mate[v]]) for v in range(len(ranked))
+            if v < mate[v]]
+
+
+
+def pairPlayers(players, played):
+    """Pairs a round, avoiding rematches.
+
+    Players are bucketed into groups of equal score. Each group, along with
+    the players that floated down from the group above, is paired greedily
+    by rank, and players without a partner float down to the next group.
+    Whoever is left at the bottom is paired by augmenting paths, see
+    _repair(), so a rematch is only paired when no round without one
+    exists.
+
+    Each player has met at most one opponent per round, so a partner is
+    almost always found within a few places and the greedy pass pairs a
+    round in close to linear time. The search only runs for the few
+    players it leaves over.
+
+    Args:
+     players: list of (p_id, score) tuples in standings order, the number of
+              players must be even
+     played: dict of player id to the set of ids they have played, as
+             returned by buildHistory()
+
+    Returns:
+      A list of (id1, id2) tuples, in standings order.
+    """
+    if len(players) % 2 != 0:
+        raise ValueError("pairPlayers needs an even number of players.")
+
+    pairs = []
+    floaters = []
+    start = 0
+    while start < len(players):
+        end = start + 1
+        while end < len(players) and players[end][1] == players[start][1]:
+            end += 1
+        pool = floaters + [p_id for p_id, score in players[start:end]]
+        paired, floaters = _pairGroup(pool, played)
+        pairs.extend(paired)
+        start = end
+
+    if floaters:
+        pairs = _repair([p_id for p_id, score in players], pairs, floaters,
+                        played)
+
+    return pairs
+
+
+
+def pairByRating(players):
+    """Pairs a first round by rating, the top half of the field against the
+    bottom half: the best rated player meets the best of the bottom half,
+    and so on.
+
+    Args:
+     players: list of player ids, highest rated first, the number of players
+              must be even
+
+    Returns:
+      A list of (id1, id2) tuples, in board order.
+    """
+    if len(players) % 2 != 0:
+        raise ValueError("pairByRating needs an even number of players.")
+
+    half = len(players) // 2
+    return list(zip(players[:half], players[half:]))
@@ -0,0 +1,69 @@
+#!/usr/bin/env python
+#
+# pairing_benchmark.py -- times pairing.pairPlayers() against player count
+#
+# Plays out synthetic tournaments in memory, pairing every round with the
+# engine, and prints the time taken to pair each round.
+#
+# Usage: python pairing_benchmark.py [rounds] [players ...]
+#
+
+import random
+import sys
+import time
+
+import pairing
+
+
+def playTournament(numPlayers, rounds, rng):
+    """Pairs and plays a tournament, timing the pairing of each round.
+
+    Returns:
+      A tuple (times, rematches), seconds taken to pair each round and the
+      number of rematches paired over the whole tournament.
+    """
+    score = dict((p_id, 0) for p_id in range(numPlayers))
+    matches = []
+    times = []
+    rematches = 0
+
+    for round in range(rounds):
+        start = time.time()
+        played, byes = pairing.buildHistory(matches)
+        ranked = sorted(score, key=lambda p_id: (-score[p_id], p_id))
+        players = [(p_id, score[p_id]) for p_id in ranked]
+        if len(players) % 2 != 0:
+            bye = pairing.chooseBye([(p, s, round) for p, s in players], byes)
+            players = [p for p in players if p[0] != bye]
+            matches.append((bye, None))
+            score[bye] += 3
+        pairs = pairing.pairPlayers(players, played)
+        times.append(time.time() - start)
+
+        for id1, id2 in pairs:
+            if id2 in played.get(id1, ()):
+                rematches += 1
+            winner, loser = (id1, id2) if rng.random() < 0.5 else (id2, id1)
+            matches.append((winner, loser))
+            score[winner] += 3
+
+    return times, rematches
+
+
+
+def main(argv):
+    rounds = int(argv[1]) if len(argv) > 1 else 15
+    sizes = [int(n) for n in argv[2:]] or [64, 1000, 10000, 50000]
+    rng = random.Random(2016)
+
+    print "%8s %8s %12s %12s %10s" % ("players", "rounds", "mean ms",
+                                      "max ms", "rematches")
+    for numPlayers in sizes:
+        times, rematches = playTournament(numPlayers, rounds, rng)
+        print "%8d %8d %12.2f %12.2f %10d" % (
+            numPlayers, rounds, 1000 * sum(times) / len(times),
+            1000 * max(times), rematches)
+
+
+if __name__ == '__main__':
+    main(sys.argv)
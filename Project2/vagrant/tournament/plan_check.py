@@ -0,0 +1,213 @@
+#!/usr/bin/env python
+#
+# plan_check.py -- checks the query plans of the hot queries
+#
+# Seeds a dataset through the public functions of tournament.py, then runs
+# EXPLAIN (ANALYZE, BUFFERS) on each statement of queries.py that is run on
+# every round. A query fails if its plan sequentially scans a table of more than
+# --min-rows rows, which means an index is missing or no longer used. The
+# plans of statements inside database functions can't be seen from here, so
+# calls of those fail if they touch more than a budget of buffers instead.
+#
+# Each query is run once to warm up, then explained, in a transaction that
+# is rolled back.
+#
+# Usage: python plan_check.py [--players N] [--tournaments N] [--rounds N]
+#                            [--min-rows N] [--verbose]
+#
+# WARNING: deletes every player, match and tournament in the database.
+#
+
+import argparse
+import json
+import random
+import sys
+
+import queries
+import tournament
+
+
+# (name, statement of queries.py, arguments, buffer budget or None)
+# Arguments are keys of the seeded dataset, see seed().
+CHECKS = [
+    ('playerStandings', 'standings', ['t_id'], None),
+    ('checkMatches', 'check_matches', ['t_id'], None),
+    ('playerStandingsPage', 'standings_page', ['t_id', 'p_id', 'limit'], None),
+    ('standingsAt', 'standings_at', ['t_id', 'closed'], None),
+    ('countTournamentPlayers', 'tournament_players_count', ['t_id'], None),
+    ('playerRatings', 'ratings', ['t_id'], None),
+    ('opponent index', 'match_history', ['t_id'], None),
+    ('async hasPlayed', 'match_played', ['t_id', 'p_id', 'opponent'], None),
+    ('async hasBye', 'match_bye', ['t_id', 'p_id'], None),
+    ('async opponentsOf', 'match_opponents', ['t_id', 'p_id'], None),
+    ('tournamentMatches', 'tournament_matches', ['t_id'], None),
+    ('reportMatches round check', 'round_pairs', ['t_id'], None),
+    ('reportMatch standings and ratings', 'matches_apply', ['t_id', 'match'],
+     500),
+    ('reportMatches standings and ratings', 'matches_apply',
+     ['t_id', 'round'], 'round'),
+]
+
+# Buffers a batch may touch per match, for budgets given as a dataset key
+BUFFERS_PER_MATCH = 250
+
+
+class _Rollback(Exception):
+    """Raised to roll back the transaction a check runs in."""
+
+
+
+def seed(players, tournaments, rounds, rng):
+    """Registers players, spreads them over tournaments and plays rounds.
+
+    Everything already in the database is deleted first.
+
+    Returns:
+      A dict of the values the checks take their arguments from:
+        t_id: the last tournament
+        p_id: a player in it
+        opponent: another player in it
+        match: a list of the id of one of its matches
+        round: the ids of the matches of its last round
+        closed: the number of its last closed round
+        limit: the size of a standings page
+    """
+    tournament.deleteMatches()
+    tournament.deleteRegisteredPlayers()
+    tournament.deleteTournaments()
+    tournament.deletePlayers()
+
+    ids = tournament.registerPlayers(["Player %d" % i for i in range(players)])
+    size = players // tournaments
+    for i in range(tournaments):
+        t_id = tournament.createTournament("Plan Check %d" % i)
+        tournament.enterTournamentBulk(t_id, ids[i * size:(i + 1) * size])
+        for round in range(rounds):
+            pairs = tournament.advanceRound(t_id)
+            tournament.reportMatches(t_id, [
+                (id1, id2, rng.random() < 0.1) if rng.random() < 0.5
+                else (id2, id1) for (id1, name1, id2, name2) in pairs])
+
+    query = "SELECT id FROM matches WHERE t_id = (%s) AND NOT bye\
+     ORDER BY id DESC LIMIT (%s);"
+    last = [row[0] for row in
+            tournament.selectQuery(query, [t_id, size // 2], 2)]
+    tournament.commitQuery("VACUUM ANALYZE;")
+    return {'t_id': t_id, 'p_id': ids[-1], 'opponent': ids[-2],
+            'match': last[:1], 'round': last, 'closed': rounds - 1,
+            'limit': 50}
+
+
+
+def scans(plan):
+    """Yields every node of a JSON plan."""
+    yield plan
+    for child in plan.get('Plans', ()):
+        for node in scans(child):
+            yield node
+
+
+
+def explain(statement, args):
+    """Runs EXPLAIN (ANALYZE, BUFFERS) on a statement of queries.py after
+    running it once, so the plans of the functions it calls are cached, and
+    rolls both back.
+
+    The statement is prepared and executed by name, as tournament.py runs
+    it.
+
+    Returns:
+      The JSON plan of the statement.
+    """
+    query = "EXECUTE plan_check(%s);" % ', '.join(['%s'] * len(args))
+    try:
+        with tournament.transaction():
+            tournament.commitQuery("PREPARE plan_check AS %s;"
+                                   % queries.STATEMENTS[statement])
+            query = "EXPLAIN (ANALYZE, BUFFERS, FORMAT JSON) " + query
+            tournament.commitQuery("SAVEPOINT warm_up;")
+            tournament.selectQuery(query, args, 2)
+            tournament.commitQuery("ROLLBACK TO SAVEPOINT warm_up;")
+            rows = tournament.selectQuery(query, args, 2)
+            tournament.commitQuery("DEALLOCATE plan_check;")
+            raise _Rollback()
+    except _Rollback:
+        pass
+    plan = rows[0][0]
+    if not isinstance(plan, list):
+        plan = json.loads(plan)
+    return plan[0]
+
+
+
+def check(name, statement, args, budget, sizes, minRows):
+    """Explains one statement and returns a list of the problems found."""
+    result = explain(statement, args)
+    plan = result['Plan']
+    problems = []
+
+    # Scanning a whole table to hash join it is fine, scanning it to throw
+    # most rows away, or once per row of another table, isn't
+    for node in scans(plan):
+        if node['Node Type'] != 'Seq Scan':
+            continue
+        table = node['Relation Name']
+        loops = node.get('Actual Loops', 1)
+        removed = node.get('Rows Removed by Filter', 0) * loops
+        if sizes.get(table, 0) > minRows and (removed > minRows or loops > 1):
+            problems.append("sequential scan on %s (%d rows, %d loops, %d "
+                            "filtered out)" % (table, sizes[table], loops,
+                                               removed))
+
+    buffers = plan.get('Shared Hit Blocks', 0) + \
+        plan.get('Shared Read Blocks', 0)
+    if budget is not None and buffers > budget:
+        problems.append("touched %d buffers, budget %d" % (buffers, budget))
+
+    return problems, plan, result.get('Execution Time'), buffers
+
+
+
+def main(argv):
+    parser = argparse.ArgumentParser(
+        description="Checks the query plans of the hot queries.")
+    parser.add_argument('--players', type=int, default=10000)
+    parser.add_argument('--tournaments', type=int, default=40)
+    parser.add_argument('--rounds', type=int, default=5)
+    parser.add_argument('--min-rows', type=int, default=1000,
+                        help="largest table a plan may scan sequentially")
+    parser.add_argument('--verbose', action='store_true',
+                        help="print the plan of every query")
+    args = parser.parse_args(argv[1:])
+
+    data = seed(args.players, args.tournaments, args.rounds,
+                random.Random(2016))
+    query = "SELECT relname, reltuples FROM pg_class\
+     WHERE relkind = 'r' AND relnamespace = 'public'::regnamespace;"
+    sizes = dict((row[0].lower(), row[1])
+                 for row in tournament.selectQuery(query, None, 2))
+
+    failed = []
+    for name, statement, keys, budget in CHECKS:
+        if budget in data:
+            budget = BUFFERS_PER_MATCH * len(data[budget])
+        problems, plan, ms, buffers = check(
+            name, statement, [data[key] for key in keys], budget, sizes,
+            args.min_rows)
+        print "%-5s %-36s %9.2f ms %7d buffers" % (
+            "FAIL" if problems else "ok", name, ms or 0, buffers)
+        for problem in problems:
+            print "      " + problem
+        if args.verbose or problems:
+            print json.dumps(plan, indent=2)
+        if problems:
+            failed.append(name)
+
+    if failed:
+        print "%d of %d queries have a bad plan." % (len(failed), len(CHECKS))
+        sys.exit(1)
+    print "All %d query plans are fine." % len(CHECKS)
+
+
+if __name__ == '__main__':
+    main(sys.argv)
@@ -0,0 +1,165 @@
+#!/usr/bin/env python
+#
+# queries.py -- the SQL run by tournament.py and tournament_async.py
+#
+# Both modules run these statements by name, so the synchronous and the
+# asyncio API can't drift apart. Parameters are $1, $2, ... as PREPARE and
+# asyncpg take them: tournament.py prepares each statement once per pooled
+# connection and executes it by name, asyncpg prepares and caches the
+# statements it is given on each connection by itself.
+#
+
+STATEMENTS = {
+    # Players and tournaments
+    'players_delete': "DELETE FROM players",
+    'tournaments_delete': "DELETE FROM tournaments WHERE id <> 0",
+    'tournament_delete': "SELECT tournament_delete($1)",
+    'tournament_archive': "SELECT tournament_archive($1)",
+    'players_count': "SELECT count(*) FROM players",
+    'tournament_players_count': "SELECT count(*) FROM registeredPlayers\
+     WHERE t_id = $1",
+    'tournament_create': "INSERT INTO tournaments (name) VALUES ($1)\
+     RETURNING id",
+    'tournament_name': "SELECT name FROM tournaments WHERE id = $1",
+    'tournament_lock': "SELECT id FROM tournaments WHERE id = $1 FOR UPDATE",
+    'player_register': "WITH new AS (INSERT INTO players (name) VALUES ($1)\
+     RETURNING id),\
+     s AS (INSERT INTO standings (t_id, p_id) SELECT 0, id FROM new),\
+     r AS (INSERT INTO ratings (p_id) SELECT id FROM new)\
+     SELECT id FROM new",
+    'players_register': "WITH new AS (INSERT INTO players (name)\
+     SELECT unnest($1::text[]) RETURNING id),\
+     s AS (INSERT INTO standings (t_id, p_id) SELECT 0, id FROM new),\
+     r AS (INSERT INTO ratings (p_id) SELECT id FROM new)\
+     SELECT id FROM new ORDER BY id",
+    'player_enter': "WITH new AS (INSERT INTO registeredPlayers (t_id, p_id)\
+     VALUES ($1, $2) RETURNING p_id),\
+     gone AS (DELETE FROM standings USING new\
+     WHERE standings.t_id = 0 AND standings.p_id = new.p_id)\
+     INSERT INTO standings (t_id, p_id) SELECT $1, p_id FROM new",
+    'players_enter': "WITH new AS (INSERT INTO registeredPlayers (t_id, p_id)\
+     SELECT DISTINCT $1::integer, unnest($2::integer[])\
+     ON CONFLICT DO NOTHING RETURNING p_id),\
+     gone AS (DELETE FROM standings USING new\
+     WHERE standings.t_id = 0 AND standings.p_id = new.p_id),\
+     s AS (INSERT INTO standings (t_id, p_id) SELECT $1, p_id FROM new)\
+     SELECT p_id FROM new",
+
+    # Standings and ratings
+    'standings': "SELECT * FROM v_standings WHERE t_id = $1",
+    'standings_all': "SELECT * FROM v_standings",
+    # Not read through v_standings, whose ORDER BY keeps the planner from
+    # reading the page off standings_ranking_idx
+    'standings_first_page': "SELECT standings.t_id, standings.p_id,\
+     players.name, standings.wins, standings.draws, standings.matches,\
+     standings.score, standings.oms, standings.byes\
+     FROM standings JOIN players ON players.id = standings.p_id\
+     WHERE standings.t_id = $1\
+     ORDER BY standings.wins DESC, standings.oms DESC, standings.p_id DESC\
+     LIMIT $2",
+    'standings_page': "SELECT standings.t_id, standings.p_id,\
+     players.name, standings.wins, standings.draws, standings.matches,\
+     standings.score, standings.oms, standings.byes\
+     FROM standings JOIN players ON players.id = standings.p_id\
+     WHERE standings.t_id = $1\
+     AND (standings.wins, standings.oms, standings.p_id) <\
+     (SELECT wins, oms, p_id FROM standings WHERE t_id = $1 AND p_id = $2)\
+     ORDER BY standings.wins DESC, standings.oms DESC, standings.p_id DESC\
+     LIMIT $3",
+    'check_matches': "SELECT max(matches) FROM v_standings WHERE t_id = $1",
+    'player_byes': "SELECT byes FROM standings\
+     WHERE t_id = COALESCE($1, 0) AND p_id = $2",
+    'ratings': "SELECT players.id, players.name, ratings.rating,\
+     ratings.games\
+     FROM standings JOIN players ON players.id = standings.p_id\
+     JOIN ratings ON ratings.p_id = standings.p_id\
+     WHERE standings.t_id = $1\
+     ORDER BY ratings.rating DESC, players.id",
+    'ratings_all': "SELECT players.id, players.name, ratings.rating,\
+     ratings.games\
+     FROM players JOIN ratings ON ratings.p_id = players.id\
+     ORDER BY ratings.rating DESC, players.id",
+    'ratings_import': "UPDATE ratings SET rating = new.rating,\
+     games = new.games FROM unnest($1::integer[],\
+     $2::double precision[], $3::integer[])\
+     AS new (p_id, rating, games) WHERE ratings.p_id = new.p_id",
+    'standings_rebuild': "SELECT standings_rebuild($1)",
+    'standings_lock': "SELECT p_id FROM standings WHERE t_id = $1\
+     FOR UPDATE",
+    'standings_update': "UPDATE standings SET wins = new.wins,\
+     draws = new.draws, matches = new.matches, score = new.score,\
+     omw = new.omw, oms = new.oms, byes = new.byes\
+     FROM unnest($1::integer[], $2::integer[], $3::integer[],\
+     $4::integer[], $5::integer[], $6::integer[], $7::integer[],\
+     $8::integer[]) AS new (p_id, wins, draws, matches, score, omw, oms,\
+     byes)\
+     WHERE standings.t_id = $9 AND standings.p_id = new.p_id",
+
+    # Matches
+    'match_insert': "INSERT INTO matches (t_id, winner, loser, draw, bye)\
+     VALUES ($1, $2, $3, $4, $5)",
+    'match_apply': "SELECT\
+     standings_apply($1, ARRAY[currval('matches_id_seq')::integer]),\
+     ratings_apply($1, ARRAY[currval('matches_id_seq')::integer])",
+    'registered': "SELECT p_id FROM standings\
+     WHERE t_id = COALESCE($1, 0) AND p_id = ANY($2::integer[])",
+    'matches_insert': "INSERT INTO matches (t_id, winner, loser, draw, bye)\
+     SELECT COALESCE($1, 0), winner, loser, draw, loser IS NULL\
+     FROM unnest($2::integer[], $3::integer[], $4::boolean[])\
+     AS results (winner, loser, draw) RETURNING id",
+    'matches_apply': "SELECT standings_apply(COALESCE($1, 0), $2::integer[]),\
+     ratings_apply(COALESCE($1, 0), $2::integer[])",
+    'ratings_apply': "SELECT ratings_apply($1, $2::integer[])",
+    'tournament_matches': "SELECT winner, loser, draw FROM matches\
+     WHERE t_id = COALESCE($1, 0) ORDER BY id",
+    'match_history': "SELECT winner, loser FROM matches\
+     WHERE t_id = COALESCE($1, 0)",
+    'match_played': "SELECT EXISTS (SELECT 1 FROM matches\
+     WHERE t_id = COALESCE($1, 0) AND ((winner = $2 AND loser = $3)\
+     OR (winner = $3 AND loser = $2)))",
+    'match_opponents': "SELECT loser FROM matches\
+     WHERE t_id = COALESCE($1, 0) AND winner = $2 AND loser IS NOT NULL\
+     UNION SELECT winner FROM matches\
+     WHERE t_id = COALESCE($1, 0) AND loser = $2",
+    'match_bye': "SELECT EXISTS (SELECT 1 FROM matches\
+     WHERE t_id = COALESCE($1, 0) AND winner = $2 AND loser IS NULL)",
+
+    # Rounds
+    'round_pairs': "SELECT player1, player2 FROM pairings\
+     WHERE t_id = $1 AND player2 IS NOT NULL AND round =\
+     (SELECT MAX(round) FROM pairings WHERE t_id = $1)",
+    'advance_round': "SELECT * FROM advance_round($1)",
+    'round_last': "SELECT MAX(round) FROM pairings WHERE t_id = $1",
+    'round_close': "SELECT round_close($1, $2)",
+    'round_close_last': "SELECT round_close($1, (SELECT MAX(round)\
+     FROM pairings WHERE t_id = $1))",
+    'pairings_insert': "INSERT INTO pairings\
+     (t_id, round, board, player1, player2)\
+     SELECT $1, COALESCE((SELECT MAX(round) FROM pairings\
+     WHERE t_id = $1), 0) + 1, board, player1, player2\
+     FROM unnest($2::integer[], $3::integer[], $4::integer[])\
+     AS pairs (board, player1, player2)",
+    'standings_at': "SELECT snapshot.t_id, snapshot.p_id, players.name,\
+     snapshot.wins, snapshot.draws, snapshot.matches, snapshot.score,\
+     snapshot.oms, snapshot.byes\
+     FROM round_snapshots AS snapshot\
+     JOIN players ON players.id = snapshot.p_id\
+     WHERE snapshot.t_id = $1 AND snapshot.round = $2\
+     ORDER BY snapshot.wins DESC, snapshot.oms DESC, snapshot.p_id DESC",
+    'round_restore': "SELECT round_restore($1, $2)",
+}
+
+# Several commands without parameters, sent as one simple query, which
+# PostgreSQL runs as one transaction
+SCRIPTS = {
+    # Truncating matches empties every tournament's partition at once
+    'matches_delete': "TRUNCATE pairings, matches, round_snapshots;\
+     UPDATE ratings SET rating = DEFAULT, games = DEFAULT;\
+     SELECT standings_rebuild(NULL);",
+    # Players go back to the standings rows of players without a tournament
+    'registrations_delete': "TRUNCATE registeredPlayers;\
+     DELETE FROM standings WHERE t_id <> 0;\
+     INSERT INTO standings (t_id, p_id) SELECT 0, id FROM players\
+     WHERE id NOT IN (SELECT p_id FROM standings);\
+     SELECT standings_rebuild(0);",
+}
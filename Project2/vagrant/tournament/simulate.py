@@ -0,0 +1,178 @@
+#!/usr/bin/env python
+#
+# simulate.py -- Monte Carlo forecast of a tournament's final standings
+#
+# Copies the current standings of a tournament into memory once, then plays
+# out the remaining rounds many times with the same pairing rules as
+# swissPairings() and a rating based win model. The samples are spread over
+# a pool of worker processes.
+#
+# Usage: python simulate.py t_id rounds [samples] [top]
+#
+
+import multiprocessing
+import random
+import sys
+
+import memory
+import pairing
+import tournament
+
+
+CHUNK = 100
+
+
+def snapshot(t_id):
+    """Copies the standings of a tournament into memory.
+
+    Args:
+     t_id: tournament id
+
+    Returns:
+      A tuple (names, table)
+        names: dict of player id to name
+        table: memory.Standings of the tournament, with every match applied
+    """
+    table = memory.Standings()
+    names = {}
+    for row in tournament.playerStandings(t_id):
+        table.add(row[1])
+        names[row[1]] = row[2]
+    for winner, loser, draw in tournament.tournamentMatches(t_id):
+        table.apply(winner, loser, draw)
+
+    return names, table
+
+
+
+def playRound(table, ratings, draw, rng):
+    """Pairs and plays one round like swissPairings(), in place."""
+    ids = table.ids
+    players = [(ids[i], table.score[i], table.matches[i])
+               for i in table.ranked()]
+
+    if len(players) % 2 != 0:
+        byes = set(ids[i] for i in range(len(table)) if table.byes[i])
+        bye = pairing.chooseBye(players, byes)
+        players = [p for p in players if p[0] != bye]
+        table.apply(bye)
+
+    pairs = pairing.pairPlayers([(p[0], p[1]) for p in players], table.played)
+    for id1, id2 in pairs:
+        if draw and rng.random() < draw:
+            table.apply(id1, id2, True)
+        elif rng.random() < memory.expected(
+                ratings.get(id1, memory.DEFAULT_RATING),
+                ratings.get(id2, memory.DEFAULT_RATING)):
+            table.apply(id1, id2)
+        else:
+            table.apply(id2, id1)
+
+
+
+def simulateChunk(args):
+    """Plays out a chunk of samples.
+
+    Args:
+     args: tuple (table, ratings, rounds, draw, top, samples, seed)
+
+    Returns:
+      A tuple (tops, ranks), the number of top finishes and the sum of the
+      final ranks of each player, in the order of table.ids.
+    """
+    table, ratings, rounds, draw, top, samples, seed = args
+    rng = random.Random(seed)
+    tops = [0] * len(table)
+    ranks = [0] * len(table)
+
+    for sample in range(samples):
+        played = table.copy()
+        for round in range(rounds):
+            playRound(played, ratings, draw, rng)
+        row = table.row
+        for rank, i in enumerate(played.ranked()):
+            j = row[played.ids[i]]
+            ranks[j] += rank + 1
+            if rank < top:
+                tops[j] += 1
+
+    return tops, ranks
+
+
+
+def simulate(t_id, rounds, samples=1000, top=8, ratings=None, draw=0.0,
+             processes=None, seed=0, table=None):
+    """Forecasts the final standings of a tournament.
+
+    The remaining rounds are played out samples times. The samples are split
+    into chunks of CHUNK with their own seed, so results only depend on seed
+    and not on the number of processes.
+
+    Args:
+     t_id: tournament id
+     rounds: number of rounds left to play
+     samples: number of times the rest of the tournament is played out
+     top: a player finishing in the first top places counts as a top finish
+     ratings: dict of player id to rating, the current playerRatings() if
+              None. Players without one are rated memory.DEFAULT_RATING
+     draw: chance that a match ends in a draw
+     processes: size of the process pool, the number of CPUs if None and
+                no pool if 1
+     seed: seed of the random number generators
+     table: standings to start from instead of a snapshot() of t_id
+
+    Returns:
+      A list of tuples (p_id, name, top_chance, mean_rank), sorted by
+      top_chance.
+    """
+    if table is None:
+        names, table = snapshot(t_id)
+    else:
+        names = dict((p_id, None) for p_id in table.ids)
+    if ratings is None:
+        ratings = dict((row[0], row[2])
+                       for row in tournament.playerRatings(t_id))
+
+    chunks = []
+    for start in range(0, samples, CHUNK):
+        chunks.append((table, ratings, rounds, draw, top,
+                       min(CHUNK, samples - start), seed * 1000003 + start))
+
+    if processes == 1:
+        results = map(simulateChunk, chunks)
+    else:
+        pool = multiprocessing.Pool(processes)
+        try:
+            results = pool.map(simulateChunk, chunks)
+        finally:
+            pool.close()
+            pool.join()
+
+    tops = [0] * len(table)
+    ranks = [0] * len(table)
+    for chunkTops, chunkRanks in results:
+        for j in range(len(table)):
+            tops[j] += chunkTops[j]
+            ranks[j] += chunkRanks[j]
+
+    forecast = [(p_id, names[p_id], float(tops[j]) / samples,
+                 float(ranks[j]) / samples)
+                for j, p_id in enumerate(table.ids)]
+    forecast.sort(key=lambda row: (-row[2], row[3]))
+    return forecast
+
+
+
+def main(argv):
+    t_id = int(argv[1])
+    rounds = int(argv[2])
+    samples = int(argv[3]) if len(argv) > 3 else 1000
+    top = int(argv[4]) if len(argv) > 4 else 8
+
+    print "%6s %-30s %8s %10s" % ("id", "name", "top %d" % top, "mean rank")
+    for p_id, name, chance, rank in simulate(t_id, rounds, samples, top):
+        print "%6d %-30s %7.1f%% %10.2f" % (p_id, name, 100 * chance, rank)
+
+
+if __name__ == '__main__':
+    main(sys.argv)
@@ -0,0 +1,88 @@
+#!/usr/bin/env python
+#
+# tiebreak.py -- computes a tournament's standings with NumPy array operations
+#
+# Loads the matches of a tournament once into arrays and derives every
+# player's wins, draws, score and OMW/OMS tiebreaks in a few vectorized
+# steps, instead of a query per player.
+#
+
+import numpy
+
+
+COLUMNS = ('wins', 'draws', 'matches', 'score', 'omw', 'oms', 'byes')
+
+
+def computeStandings(player_ids, winners, losers, draws):
+    """Computes the standings of a tournament from its matches.
+
+    Players that aren't in player_ids are ignored, as are their results.
+    Win = 3pts. Loss = 0pts. Draw = 1pt. A bye counts as a win.
+
+    OMW/OMS are the sum of wins/score of each distinct opponent, computed as
+    a sparse opponent matrix multiplied by the wins/score vector.
+
+    Args:
+     player_ids: ids of the players in the tournament
+     winners: winner id of each match
+     losers: loser id of each match, None for a bye
+     draws: whether each match was a draw
+
+    Returns:
+      A dict of column name to an array with one entry per player, in the
+      order of player_ids. The columns are given by COLUMNS.
+    """
+    ids = numpy.asarray(player_ids, dtype=numpy.int64)
+    n = len(ids)
+    order = numpy.argsort(ids)
+    draw = numpy.asarray(draws, dtype=bool)
+    bye = numpy.array([loser is None for loser in losers], dtype=bool)
+    w = _index(ids, order, numpy.asarray(winners, dtype=numpy.int64))
+    l = _index(ids, order, numpy.array(
+        [-1 if loser is None else loser for loser in losers],
+        dtype=numpy.int64))
+
+    def count(index, mask=None):
+        if mask is not None:
+            index = index[mask]
+        return numpy.bincount(index[index >= 0], minlength=n)
+
+    wins = count(w, ~draw)
+    drawn = count(w, draw) + count(l, draw)
+    matches = count(w) + count(l)
+    score = 3 * wins + drawn
+
+    # Distinct (player, opponent) pairs in both directions
+    known = (w >= 0) & (l >= 0)
+    player = numpy.concatenate((w[known], l[known]))
+    opponent = numpy.concatenate((l[known], w[known]))
+    pairs = numpy.unique(player * n + opponent)
+    player, opponent = pairs // n, pairs % n
+
+    return {
+        'wins': wins,
+        'draws': drawn,
+        'matches': matches,
+        'score': score,
+        'omw': _sumBy(player, wins[opponent], n),
+        'oms': _sumBy(player, score[opponent], n),
+        'byes': count(w, bye),
+    }
+
+
+
+def _index(ids, order, values):
+    """Maps player ids to their position in ids, -1 where unknown."""
+    if len(ids) == 0:
+        return numpy.full(len(values), -1, dtype=numpy.int64)
+    found = numpy.searchsorted(ids, values, sorter=order)
+    found = numpy.minimum(found, len(ids) - 1)
+    index = order[found]
+    return numpy.where(ids[index] == values, index, -1)
+
+
+
+def _sumBy(index, weights, n):
+    """Sums weights per index, as integers."""
+    return numpy.bincount(index, weights=weights,
+                          minlength=n).round().astype(numpy.int64)
@@ -3,40 +3,522 @@
 # tournament.py -- implementation of a Swiss-system tournament
 #
 
+import functools
+import inspect
+import io
+import os
+import threading
+from contextlib import contextmanager
+from timeit import default_timer
+
 import psycopg2
+import psycopg2.extensions
+import psycopg2.pool
+
+import export
+import pairing
+import queries
+
+try:
+    import tiebreak
+except ImportError:
+    # NumPy isn't installed, the database computes every standings column
+    tiebreak = None
+
+# Batches of at least this many matches have their tournament's standings
+# recomputed with tiebreak.computeStandings(), see reportMatches()
+TIEBREAK_BATCH = 64
+
+
+# Connection pool settings, see configurePool()
+POOL_MIN = 1
+POOL_MAX = 10
+POOL_DSN = "dbname=tournament"
+POOL_PING = False
+
+_pool = None
+_poolPid = None
+_poolSlots = None
+_poolLock = threading.Lock()
+
+# Holds the cursor of the transaction open in the current thread, if any
+_local = threading.local()
+
+# Storage backend the public functions run on, None for PostgreSQL
+_backend = None
+
+# Records statement and call timings, None when off, see setMonitor()
+_monitor = None
+
+# Serves repeated standings reads, None when off, see setCache()
+_cache = None
+
+# Opponent indexes of the tournaments this process has looked up, by
+# tournament id, see hasPlayed()
+_opponents = {}
+_opponentsLock = threading.Lock()
+
+# Bumped on every change to the indexes, an index built from the database
+# is only kept if no results were recorded while it was read
+_opponentsGeneration = 0
+
+
+
+class _PooledConnection(psycopg2.extensions.connection):
+    """Autocommit connection that remembers the pool it was checked out of
+    and the STATEMENTS it has prepared.
+
+    Autocommit means a single statement costs one round trip, transaction()
+    issues BEGIN/COMMIT itself.
+    """
+    pool = None
+    slots = None
+
+    def __init__(self, *args, **kwargs):
+        super(_PooledConnection, self).__init__(*args, **kwargs)
+        self.autocommit = True
+        self.prepared = set()
+
+
+
+def setBackend(backend):
+    """Runs the public functions of this module on another storage backend.
+
+    Args:
+     backend: object implementing the public functions, such as
+              memory.MemoryBackend(), or None to go back to PostgreSQL
+    """
+    global _backend
+    _backend = backend
+
+
+
+def setMonitor(monitor):
+    """Reports every statement and public function call to a monitor.
+
+    Args:
+     monitor: object with call(name), statement(query, args, seconds,
+              rows) and prepared(name, hit, seconds) methods, such as
+              monitor.Monitor(), or None to stop
+    """
+    global _monitor
+    _monitor = monitor
+
+
+
+def setCache(cache):
+    """Serves repeated playerStandings() calls from a cache.
+
+    The public functions that change standings invalidate the tournaments
+    they change once their writes have committed. Reads inside
+    transaction() always query the database.
+
+    Args:
+     cache: object with version, get, set and invalidate methods, such as
+            cache.StandingsCache(), or None to stop caching
+    """
+    global _cache
+    _cache = cache
+
+
+
+def _afterCommit(callback):
+    """Calls callback now, or inside transaction() once it has committed.
+    Nothing is called if it is rolled back."""
+    committed = getattr(_local, 'committed', None)
+    if committed is not None:
+        committed.append(callback)
+    else:
+        callback()
+
+
+
+def _invalidate(tournaments):
+    cache = _cache
+    if cache is not None:
+        cache.invalidate(tournaments)
+
+
+
+def _changed(*tournaments):
+    """Invalidates the cached standings of tournaments, of every tournament
+    if none are given. Inside transaction() this waits for the commit."""
+    if _cache is None:
+        return
+    _afterCommit(functools.partial(_invalidate, list(tournaments) or None))
+
+
+
+def _cached(t_id):
+    """Returns the cached standings of a tournament, or None."""
+    if _cache is None or getattr(_local, 'cursor', None) is not None:
+        return None
+    return _cache.get(t_id)
+
+
+
+class _OpponentIndex(object):
+    """Who each player of a tournament has played, who has had a bye and
+    how many matches each has played.
+
+    Args:
+     matches: iterable of (winner, loser) tuples, loser is None for a bye
+
+    Attributes:
+     played: dict of player id to the set of ids they have played, as
+             pairing.pairPlayers() takes it
+     byes: set of the ids of players that have had a bye
+     matches: dict of player id to the number of matches they have played,
+              byes included
+    """
+
+    def __init__(self, matches=()):
+        self.played = {}
+        self.byes = set()
+        self.matches = {}
+        self.add(matches)
+
+    def add(self, matches):
+        """Adds (winner, loser) matches, loser None for a bye."""
+        played, counts = self.played, self.matches
+        for winner, loser in matches:
+            counts[winner] = counts.get(winner, 0) + 1
+            if loser is None:
+                self.byes.add(winner)
+                continue
+            counts[loser] = counts.get(loser, 0) + 1
+            played.setdefault(winner, set()).add(loser)
+            played.setdefault(loser, set()).add(winner)
+
+    def agrees(self, standings):
+        """Returns whether every player of playerStandings(t_id) rows has
+        played as many matches here as in the standings."""
+        counts = self.matches
+        return all(counts.get(row[1], 0) == row[5] for row in standings)
+
+
+
+def _opponentIndex(t_id, standings=None):
+    """Returns the opponent index of a tournament.
+
+    It is built from the tournament's matches on first use and kept up to
+    date by the results reported through this module. Given the
+    tournament's standings, an index that doesn't agree with them, because
+    another process has reported results, is built again. Inside
+    transaction() an index is built from the matches the transaction sees
+    and not kept.
+    """
+    t_id = t_id or 0
+    inside = getattr(_local, 'cursor', None) is not None
+    if not inside:
+        with _opponentsLock:
+            index = _opponents.get(t_id)
+            generation = _opponentsGeneration
+        if index is not None and (standings is None or
+                                  index.agrees(standings)):
+            return index
+
+    index = _OpponentIndex(_preparedQuery([('match_history', [t_id])], 2))
+    if not inside:
+        with _opponentsLock:
+            if _opponentsGeneration == generation:
+                _opponents[t_id] = index
+    return index
+
+
+
+def _recordMatches(t_id, matches):
+    """Adds (winner, loser) matches to the opponent index of a tournament,
+    once they have committed."""
+    def record():
+        global _opponentsGeneration
+        with _opponentsLock:
+            _opponentsGeneration += 1
+            index = _opponents.get(t_id or 0)
+            if index is not None:
+                index.add(matches)
+
+    _afterCommit(record)
+
+
+
+def _forgetOpponents(*tournaments):
+    """Drops the opponent indexes of tournaments, of every tournament if
+    none are given, once the change has committed."""
+    def forget():
+        global _opponentsGeneration
+        with _opponentsLock:
+            _opponentsGeneration += 1
+            if not tournaments:
+                _opponents.clear()
+            for t_id in tournaments:
+                _opponents.pop(t_id or 0, None)
+
+    _afterCommit(forget)
+
+
+
+def _api(function):
+    """Decorator for the public functions, which run on the backend set with
+    setBackend() when there is one, and are timed by the monitor set with
+    setMonitor(). Generators are timed while they are iterated, see
+    monitor.Monitor.iterate()."""
+    name = function.__name__
+
+    if inspect.isgeneratorfunction(function):
+        @functools.wraps(function)
+        def generator(*args, **kwargs):
+            target = function
+            if _backend is not None:
+                target = getattr(_backend, name)
+            items = iter(target(*args, **kwargs))
+            if _monitor is None:
+                return items
+            return _monitor.iterate(name, items)
+
+        return generator
+
+    @functools.wraps(function)
+    def wrapper(*args, **kwargs):
+        target = function
+        if _backend is not None:
+            target = getattr(_backend, name)
+        if _monitor is None:
+            return target(*args, **kwargs)
+        with _monitor.call(name):
+            return target(*args, **kwargs)
+
+    return wrapper
+
 
 
 def connect():
     """Connect to the PostgreSQL database. Returns a database connection."""
-    return psycopg2.connect("dbname=tournament")
+    return psycopg2.connect(POOL_DSN)
 
 
 
-def commitQuery(query,args=None,fetch=0):
-    """Used to execute INSERT/DELETE queries that require commit 
+def configurePool(minconn=1, maxconn=10, dsn="dbname=tournament", ping=False):
+    """Configures the connection pool behind commitQuery/selectQuery.
+
+    The current pool, if any, is closed. A new one is created on the next
+    query.
+
+    Args:
+     minconn: connections opened up front and kept open between queries,
+              connections returned beyond that are closed
+     maxconn: most connections handed out at once, callers wait for a free
+              one beyond that
+     dsn: connection string passed to psycopg2
+     ping: run "SELECT 1" on checkout to catch connections the server has
+           dropped, at the cost of one extra round trip
+    """
+    global POOL_MIN, POOL_MAX, POOL_DSN, POOL_PING
+
+    if minconn < 0 or maxconn < 1 or minconn > maxconn:
+        raise ValueError("Need 0 <= minconn <= maxconn and maxconn >= 1.")
+
+    closePool()
+    POOL_MIN, POOL_MAX, POOL_DSN, POOL_PING = minconn, maxconn, dsn, ping
+
+
+
+def closePool():
+    """Closes every connection held by the pool."""
+    global _pool
+
+    with _poolLock:
+        if _pool is not None and _poolPid == os.getpid():
+            _pool.closeall()
+        _pool = None
+
+
+
+def _getPool():
+    """Returns the pool, creating it on first use.
+
+    A pool inherited through fork() is abandoned rather than closed, closing
+    it would end the parent's sessions.
+    """
+    global _pool, _poolPid, _poolSlots
+
+    if _pool is not None and _poolPid == os.getpid():
+        return _pool
+
+    with _poolLock:
+        if _pool is None or _poolPid != os.getpid():
+            _pool = psycopg2.pool.ThreadedConnectionPool(
+                POOL_MIN, POOL_MAX, POOL_DSN,
+                connection_factory=_PooledConnection)
+            _poolSlots = threading.BoundedSemaphore(POOL_MAX)
+            _poolPid = os.getpid()
+    return _pool
+
+
+
+def _healthy(db, ping=False):
+    """Checks that a connection is open and not inside a transaction."""
+    if db.closed or db.get_transaction_status() != \
+       psycopg2.extensions.TRANSACTION_STATUS_IDLE:
+        return False
+
+    if ping:
+        try:
+            db.cursor().execute("SELECT 1;")
+        except psycopg2.Error:
+            return False
+
+    return True
+
+
+
+def _checkout():
+    """Takes a connection from the pool, replacing it if it is broken.
+
+    Blocks while maxconn connections are already checked out.
+    """
+    pool = _getPool()
+    slots = _poolSlots
+    slots.acquire()
+    try:
+        db = pool.getconn()
+        if not _healthy(db, POOL_PING):
+            pool.putconn(db, close=True)
+            db = pool.getconn()
+    except:
+        slots.release()
+        raise
+
+    db.pool, db.slots = pool, slots
+    return db
+
+
+
+def _checkin(db):
+    """Returns a connection to the pool it came from, closing it if broken."""
+    try:
+        db.pool.putconn(db, close=not _healthy(db))
+    except psycopg2.pool.PoolError:
+        # The pool was closed or replaced while the connection was out
+        db.close()
+    finally:
+        db.slots.release()
+
+
+
+@contextmanager
+def transaction():
+    """Runs a block of queries as one transaction on one pooled connection.
+
+    commitQuery/selectQuery called inside the block use the same
+    connection, so the block commits as a whole or is rolled back if an
+    exception escapes it. Nested blocks join the outermost transaction.
+
+    Example:
+     with transaction():
+         reportMatch(id1, id2, t_id)
+         reportMatch(id3, id4, t_id)
+
+    Yields:
+     the cursor of the transaction
+    """
+    if _backend is not None:
+        with _backend.transaction() as cursor:
+            yield cursor
+        return
+
+    cursor = getattr(_local, 'cursor', None)
+    if cursor is not None:
+        yield cursor
+        return
+
+    db = _checkout()
+    try:
+        cursor = db.cursor()
+        cursor.execute("BEGIN;")
+        _local.cursor = cursor
+        _local.committed = []
+        try:
+            yield cursor
+        except:
+            try:
+                cursor.execute("ROLLBACK;")
+            except psycopg2.Error:
+                pass
+            raise
+        cursor.execute("COMMIT;")
+        committed, _local.committed = _local.committed, None
+        for callback in committed:
+            callback()
+    finally:
+        _local.cursor = None
+        _local.committed = None
+        _checkin(db)
+
+
+
+@contextmanager
+def _cursor():
+    """Yields the cursor of the open transaction, or else an autocommit
+    cursor on a pooled connection."""
+    cursor = getattr(_local, 'cursor', None)
+    if cursor is not None:
+        yield cursor
+        return
+
+    db = _checkout()
+    try:
+        yield db.cursor()
+    finally:
+        _checkin(db)
+
+
+
+def _execute(cursor, query, args=None, fetch=0, label=None):
+    """Executes a query on a cursor and fetches the result.
+
+    Every statement the module runs goes through here.
 
     Args:
+     cursor: cursor to execute on
      query: SQL query that you want to execute.
      args: list of arguments
      fetch: 0 - no fetch, 1 - fetchone(), 2 - fetchall()
+     label: text the monitor records the statement as, the query if None
     """
-    temp = None
-    db = connect()
-    cursor = db.cursor()
-    if args == None:
-        cursor.execute(query)
-    else:
-        cursor.execute(query, tuple(args))
+    monitor = _monitor
+    if monitor is not None:
+        start = default_timer()
+    try:
+        if args == None:
+            cursor.execute(query)
+        else:
+            cursor.execute(query, tuple(args))
+    finally:
+        if monitor is not None:
+            monitor.statement(label or query, args,
+                              default_timer() - start, cursor.rowcount)
+
+    if fetch == 1:
+        return cursor.fetchone()
+    if fetch == 2:
+        return cursor.fetchall()
+    return None
 
-    if fetch != 0:
-        if fetch == 1:
-            temp = cursor.fetchone()
-        if fetch == 2:
-            temp = cursor.fetchall()
-    db.commit()
-    db.close()
 
-    return temp
+
+def commitQuery(query,args=None,fetch=0):
+    """Used to execute INSERT/DELETE queries that require commit 
+
+    The query commits on its own unless it runs inside transaction().
+
+    Args:
+     query: SQL query that you want to execute.
+     args: list of arguments
+     fetch: 0 - no fetch, 1 - fetchone(), 2 - fetchall()
+    """
+    with _cursor() as cursor:
+        return _execute(cursor, query, args, fetch)
     
 
 
@@ -47,86 +529,168 @@ def selectQuery(query,args=None,fetch=0):
      args: list of arguments
      fetch: 0 - no fetch, 1 - fetchone(), 2 - fetchall()
     """
-    temp = None
-    db = connect()
-    cursor = db.cursor()
-    if args == None:
-        cursor.execute(query)
-    else:
-        cursor.execute(query, tuple(args))
+    with _cursor() as cursor:
+        return _execute(cursor, query, args, fetch)
+
+
+
+# Every statement is prepared once per pooled connection and then executed
+# by name, so PostgreSQL parses it once rather than on every call. The SQL
+# is shared with tournament_async.py, see queries.py.
+STATEMENTS = queries.STATEMENTS
+
+
+
+def _executePrepared(cursor, calls, fetch=0):
+    """Executes STATEMENTS by name, all in one round trip.
+
+    Those the cursor's connection hasn't prepared yet are prepared first.
+    A prepared statement lasts as long as its connection, even if the
+    transaction it was prepared in is rolled back.
+
+    Args:
+     cursor: cursor to execute on
+     calls: list of (name, args) tuples, name a key of STATEMENTS
+     fetch: 0 - no fetch, 1 - fetchone(), 2 - fetchall(), of the last call
+    """
+    monitor = _monitor
+    prepared = cursor.connection.prepared
+    for name, args in calls:
+        seconds = None
+        if name not in prepared:
+            start = default_timer()
+            cursor.execute("PREPARE tournament_%s AS %s;"
+                           % (name, STATEMENTS[name]))
+            seconds = default_timer() - start
+            prepared.add(name)
+        if monitor is not None:
+            monitor.prepared(name, seconds is None, seconds)
+
+    query = ' '.join("EXECUTE tournament_%s(%s);"
+                     % (name, ', '.join(['%s'] * len(args))) if args
+                     else "EXECUTE tournament_%s;" % name
+                     for name, args in calls)
+    label = '; '.join(STATEMENTS[name] for name, args in calls) + ';'
+    return _execute(cursor, query, [arg for name, args in calls
+                                    for arg in args], fetch, label)
+
 
-    if fetch != 0:
-        if fetch == 1:
-            temp = cursor.fetchone()
-        if fetch == 2:
-            temp = cursor.fetchall()
-    db.close()
 
-    return temp
+def _preparedQuery(calls, fetch=0):
+    """Runs _executePrepared() like commitQuery() runs _execute()."""
+    with _cursor() as cursor:
+        return _executePrepared(cursor, calls, fetch)
 
 
 
+@_api
 def deleteMatches():
     """Remove all the match records from the database."""
 
-    query = "DELETE from matches;";
-    commitQuery(query)
+    commitQuery(queries.SCRIPTS['matches_delete'])
+    _changed()
+    _forgetOpponents()
 
 
 
+@_api
 def deletePlayers():
     """Remove all the player records from the database."""
 
-    query = "DELETE from players;";
-    commitQuery(query)
+    _preparedQuery([('players_delete', [])])
+    _changed()
+    _forgetOpponents()
 
 
 
+@_api
 def deleteTournaments():
     """Remove all the tournaments from the database. """
 
-    query = "DELETE FROM tournaments RETURNING id;"
-    commitQuery(query)
+    # Tournament 0 holds the matches reported without a tournament
+    _preparedQuery([('tournaments_delete', [])])
+    _changed()
+    _forgetOpponents()
+
+
+
+@_api
+def deleteTournament(t_id):
+    """Deletes one tournament with its matches, registrations, pairings and
+    standings.
+
+    Its matches and registrations are partitions of their own, which are
+    dropped instead of deleted row by row, see tournament_delete() in
+    migrations/0003_partitions.sql. Players that were in no other tournament
+    go back to the players without a tournament. Ratings are kept.
+
+    Args:
+     t_id: tournament id
+    """
+
+    _preparedQuery([('tournament_delete', [t_id])])
+    _changed()
+    _forgetOpponents(t_id)
+
+
 
+@_api
+def archiveTournament(t_id):
+    """Moves a finished tournament out of the live tables.
 
+    Its matches and registrations partitions are detached into the archive
+    schema along with a copy of its final standings and pairings, then the
+    tournament is deleted as by deleteTournament().
+
+    Args:
+     t_id: tournament id
+    """
 
+    _preparedQuery([('tournament_archive', [t_id])])
+    _changed()
+    _forgetOpponents(t_id)
+
+
+
+@_api
 def deleteRegisteredPlayers():
     """Remove all the registered tournament players. """
 
-    query = "DELETE FROM registeredPlayers;"
-    commitQuery(query)
+    commitQuery(queries.SCRIPTS['registrations_delete'])
+    _changed()
 
 
 
+@_api
 def countPlayers():
     """Returns the number of players currently registered."""
 
-    query = "SELECT count(*) FROM players;";
-    return selectQuery(query, None, 1)[0]
+    return _preparedQuery([('players_count', [])], 1)[0]
 
 
 
+@_api
 def countTournamentPlayers(t_id):
     """Returns the number of players registered in a tournament. """
 
-    query = "SELECT count(*) FROM registeredPlayers WHERE t_id = (%s);";
-    return selectQuery(query, [t_id], 1)[0]
+    return _preparedQuery([('tournament_players_count', [t_id])], 1)[0]
 
 
 
+@_api
 def createTournament(name):
     """Creates a tournament.
     Args:
         name: tournament name
     """
 
-    query = "INSERT INTO tournaments (name) VALUES (%s) RETURNING id;"
-    t_id = commitQuery(query,[name],1)[0]
+    t_id = _preparedQuery([('tournament_create', [name])], 1)[0]
 
     return t_id
 
 
 
+@_api
 def registerPlayer(name):
     """Adds a player to the tournament database.
   
@@ -137,13 +701,32 @@ def registerPlayer(name):
       name: the player's full name (need not be unique).
     """
 
-    query = "INSERT INTO players (name) VALUES (%s) RETURNING id;"
-    p_id = commitQuery(query,[name],1)[0]
+    p_id = _preparedQuery([('player_register', [name])], 1)[0]
+    _changed(0)
 
     return p_id
 
 
 
+@_api
+def registerPlayers(names):
+    """Adds many players to the tournament database with one statement.
+
+    Args:
+      names: list of the players' full names
+
+    Returns:
+      The new players' ids, in the same order as names.
+    """
+
+    rows = _preparedQuery([('players_register', [list(names)])], 2)
+    _changed(0)
+
+    return [row[0] for row in rows]
+
+
+
+@_api
 def enterTournament(t_id, p_id):
     """Adds a player and tournament to database.
 
@@ -152,11 +735,33 @@ def enterTournament(t_id, p_id):
      p_id: player id that is being registered
     """
 
-    query = "INSERT INTO registeredPlayers (t_id,p_id) VALUES (%s,%s);"
-    commitQuery(query, [t_id,p_id], 0)
+    _preparedQuery([('player_enter', [t_id, p_id])])
+    _changed(t_id, 0)
+
+
 
+@_api
+def enterTournamentBulk(t_id, player_ids):
+    """Adds many players to a tournament with one statement.
 
+    Players that are already registered in the tournament are skipped.
 
+    Args:
+     t_id: tournament id of the tournament which players are registered to.
+     player_ids: ids of the players being registered
+
+    Returns:
+      The ids of the players that were newly registered.
+    """
+
+    rows = _preparedQuery([('players_enter', [t_id, list(player_ids)])], 2)
+    _changed(t_id, 0)
+
+    return [row[0] for row in rows]
+
+
+
+@_api
 def playerStandings(t_id=None):
     """Returns a list of the players and their win records, sorted by wins.
 
@@ -178,12 +783,20 @@ def playerStandings(t_id=None):
         byes: if the player has had a bye 
     """
 
+    cache = _cache
+    if getattr(_local, 'cursor', None) is not None:
+        # Reads inside a transaction may see writes that are rolled back
+        cache = None
+    if cache is not None:
+        cached = cache.get(t_id)
+        if cached is not None:
+            return list(cached)
+        version = cache.version(t_id)
+
     if t_id != None:
-        query = "SELECT * FROM v_standings WHERE t_id = (%s)";
-        rows = selectQuery(query,[t_id],2)
+        rows = _preparedQuery([('standings', [t_id])], 2)
     else:
-        query = "SELECT * FROM v_standings;"
-        rows = selectQuery(query, None, 2)
+        rows = _preparedQuery([('standings_all', [])], 2)
 
     standings = []
 
@@ -193,10 +806,136 @@ def playerStandings(t_id=None):
         for row in rows:
             standings.append((row[1],row[2],row[3],row[5]))
 
+    if cache is not None:
+        cache.set(t_id, version, tuple(standings))
     return standings
 
 
 
+@_api
+def iterStandings(t_id=None, chunk=1000):
+    """Yields the rows of playerStandings(t_id) one at a time.
+
+    The rows are fetched chunk at a time from a server-side cursor, so only
+    one chunk is held in memory. The cursor runs in a transaction of its own
+    on a pooled connection, which stays checked out until the last row is
+    read or the generator is closed.
+
+    Args:
+     t_id: tournament id, None for every player
+     chunk: rows fetched per round trip
+    """
+
+    db = _checkout()
+    try:
+        cursor = db.cursor()
+        _execute(cursor, "BEGIN;")
+        try:
+            # A cursor can't be declared for a prepared statement, the
+            # query is sent with its argument in place of $1
+            if t_id != None:
+                query = "DECLARE standings NO SCROLL CURSOR FOR " + \
+                    STATEMENTS['standings'].replace('$1', '%s')
+                _execute(cursor, query, [t_id])
+            else:
+                query = "DECLARE standings NO SCROLL CURSOR FOR " + \
+                    STATEMENTS['standings_all']
+                _execute(cursor, query)
+
+            query = "FETCH FORWARD %s FROM standings;"
+            while True:
+                rows = _execute(cursor, query, [chunk], 2)
+                for row in rows:
+                    if t_id != None:
+                        yield row
+                    else:
+                        yield (row[1],row[2],row[3],row[5])
+                if len(rows) < chunk:
+                    break
+        finally:
+            # Only read, closing the transaction closes the cursor
+            try:
+                _execute(cursor, "ROLLBACK;")
+            except psycopg2.Error:
+                pass
+    finally:
+        _checkin(db)
+
+
+
+@_api
+def playerStandingsPage(t_id, after=None, limit=50):
+    """Returns one page of a tournament's standings, in playerStandings()
+    order.
+
+    Pages are found by keyset: the next page starts after the ranking of
+    the last player of the previous one. The standings_ranking_idx index
+    (migrations/0005_standings_order.sql) is in that order, so a page reads
+    its limit rows from the index after that ranking, however deep it is,
+    without sorting the tournament.
+
+    Args:
+     t_id: tournament id
+     after: id of the last player of the previous page, None for the first
+     limit: most rows returned
+
+    Returns:
+      A list of tuples like those of playerStandings(t_id), empty after the
+      last page or if after isn't in the tournament.
+    """
+
+    if after == None:
+        return _preparedQuery([('standings_first_page', [t_id, limit])], 2)
+
+    return _preparedQuery([('standings_page', [t_id, after, limit])], 2)
+
+
+
+@_api
+def playerRatings(t_id=None):
+    """Returns the Elo ratings of the players, highest first.
+
+    Ratings are kept across tournaments and updated as matches are reported,
+    see ratings_apply() in tournament.sql. Everyone starts at 1500.
+
+    Args:
+     t_id: tournament id, every player if None
+
+    Returns:
+      A list of tuples (p_id, name, rating, games)
+        p_id: the player's unique id
+        name: the player's full name
+        rating: the player's rating
+        games: the number of rated matches the player has played, byes
+               aren't rated
+    """
+
+    if t_id != None:
+        rows = _preparedQuery([('ratings', [t_id])], 2)
+    else:
+        rows = _preparedQuery([('ratings_all', [])], 2)
+
+    return [tuple(row) for row in rows]
+
+
+
+@_api
+def tournamentMatches(t_id=None):
+    """Returns the matches of a tournament in the order they were reported.
+
+    Args:
+     t_id: tournament id, None for the matches reported without one
+
+    Returns:
+      A list of tuples (winner, loser, draw), loser is None for a bye.
+    """
+
+    return [tuple(row) for row in
+            _preparedQuery([('tournament_matches', [t_id])], 2)]
+
+
+
+@_api
 def reportMatch(winner, loser=None, t_id = None, draw=False, bye=False):
     """Records the outcome of a single match between two players.
 
@@ -207,12 +946,141 @@ def reportMatch(winner, loser=None, t_id = None, draw=False, bye=False):
     if loser == None:
         bye = True
 
-    query = "INSERT INTO matches (t_id, winner, loser, draw, bye)\
-     VALUES (%s,%s,%s,%s,%s);"
-    commitQuery(query,[t_id,winner,loser,draw,bye],0)
+    # Statements sent together run as one transaction, so the standings and
+    # ratings are updated with the match in a single round trip.
+    # Matches without a tournament are in tournament 0
+    if t_id == None:
+        t_id = 0
+    _preparedQuery([('match_insert', [t_id, winner, loser, draw, bye]),
+                    ('match_apply', [t_id])], 0)
+    _changed(t_id)
+    _recordMatches(t_id, [(winner, loser)])
+
+
+
+@_api
+def reportMatches(t_id, results):
+    """Records the outcome of a whole round of matches at once.
+
+    The matches are inserted with one statement and the standings and
+    ratings are updated once for the batch, all in a single transaction. Nothing is
+    recorded if any result is rejected.
+
+    A batch of TIEBREAK_BATCH matches or more in a tournament changes the
+    OMW/OMS of most of the field, so when NumPy is installed the whole
+    tournament's standings are recomputed with tiebreak.computeStandings()
+    instead of refreshing each opponent's tiebreaks in the database.
+
+    Args:
+     t_id: tournament id
+     results: list of (winner, loser) or (winner, loser, draw) tuples,
+              loser is None for a bye
+
+    Raises:
+     ValueError: a player appears in more than one result or isn't
+                 registered in the tournament, or advanceRound() or
+                 startRound() has recorded the round and the two players
+                 weren't paired together
+    """
+    winners, losers, draws = [], [], []
+    seen = set()
+    for result in results:
+        winner, loser = result[0], result[1]
+        for p_id in (winner, loser):
+            if p_id in seen:
+                raise ValueError(
+                    "Player %s appears in more than one result." % p_id)
+            if p_id != None:
+                seen.add(p_id)
+        winners.append(winner)
+        losers.append(loser)
+        draws.append(len(result) > 2 and bool(result[2]))
+
+    if not winners:
+        return
+
+    with transaction():
+        rows = _preparedQuery([('registered', [t_id, list(seen)])], 2)
+        missing = seen - set(row[0] for row in rows)
+        if missing:
+            raise ValueError("Players %s aren't registered in tournament %s."
+                             % (sorted(missing), t_id))
+
+        # Once advanceRound or startRound has recorded the round, results
+        # must follow it
+        rows = _preparedQuery([('round_pairs', [t_id])], 2)
+        if rows:
+            pairs = set(frozenset(row) for row in rows)
+            for winner, loser in zip(winners, losers):
+                if frozenset([winner, loser]) not in pairs:
+                    raise ValueError("Players %s and %s weren't paired in "
+                                     "this round." % (winner, loser))
+
+        rows = _preparedQuery([('matches_insert',
+                                [t_id, winners, losers, draws])], 2)
+        ids = [row[0] for row in rows]
+        if tiebreak != None and t_id != None and len(ids) >= TIEBREAK_BATCH:
+            _preparedQuery([('ratings_apply', [t_id, ids])], 0)
+            _computeStandings(t_id)
+        else:
+            _preparedQuery([('matches_apply', [t_id, ids])], 0)
+        _changed(t_id or 0)
+        _recordMatches(t_id, list(zip(winners, losers)))
+
+
+
+@_api
+def rebuildStandings(t_id=None):
+    """Recomputes the standings table from the matches table.
+
+    The standings are updated as matches are reported, this is only needed
+    after the matches table was changed by hand.
+
+    A single tournament is rebuilt by loading its matches once and computing
+    every column with tiebreak.computeStandings(), when NumPy is installed,
+    as reportMatches() does for large rounds.
+
+    Args:
+     t_id: tournament to rebuild, every tournament if None
+    """
+
+    if t_id == None or tiebreak == None:
+        _preparedQuery([('standings_rebuild', [t_id])])
+        if t_id == None:
+            _changed()
+            _forgetOpponents()
+        else:
+            _changed(t_id)
+            _forgetOpponents(t_id)
+        return
+
+    with transaction():
+        _computeStandings(t_id)
+        _changed(t_id)
+        _forgetOpponents(t_id)
+
 
 
+def _computeStandings(t_id):
+    """Rewrites a tournament's standings rows from its matches with
+    tiebreak.computeStandings(). Joins the caller's transaction, if any."""
 
+    with transaction():
+        rows = _preparedQuery([('standings_lock', [t_id])], 2)
+        players = [row[0] for row in rows]
+
+        rows = _preparedQuery([('tournament_matches', [t_id])], 2)
+        columns = tiebreak.computeStandings(players, [row[0] for row in rows],
+                                            [row[1] for row in rows],
+                                            [row[2] for row in rows])
+
+        _preparedQuery([('standings_update', [players] +
+                         [columns[name].tolist() for name in tiebreak.COLUMNS]
+                         + [t_id])])
+
+
+
+@_api
 def checkBye(t_id, p_id):
     """Check if a player has a bye from standings 
 
@@ -221,41 +1089,110 @@ def checkBye(t_id, p_id):
      p_id: player id
     """
 
-    query = "SELECT byes FROM v_standings WHERE id = (%s) AND t_id = (%s);"
-    row = selectQuery(query,[p_id,t_id],1)[0]
+    for row in _cached(t_id) or ():
+        if row[1] == p_id:
+            return row[8] != 0
 
-    if row == 0:
-        return False
-
-    return True
+    # Otherwise from the opponent index, see hasBye()
+    index = _opponentIndex(t_id)
+    with _opponentsLock:
+        return p_id in index.byes
 
 
+@_api
 def checkMatches(t_id):
     """Return max matches played by everyone in standings 
     
     Args:
      t_id: tournament id 
     """
-    query = "SELECT max(matches) FROM v_standings WHERE t_id = (%s);"
-    row = selectQuery(query,[t_id],1)[0]
+    cached = _cached(t_id)
+    if cached is not None:
+        return max([row[5] for row in cached] or [None])
+
+    row = _preparedQuery([('check_matches', [t_id])], 1)[0]
 
 
     return row
+
+
+
+@_api
+def hasPlayed(t_id, a, b):
+    """Returns whether two players have played each other in a tournament.
+
+    Answered from the tournament's opponent index. That is read from its
+    matches on first use and then kept up to date by the results reported
+    through this module, so results reported by another process aren't
+    seen until swissPairings() finds the index out of date and reads it
+    again.
+
+    Args:
+     t_id: tournament id, None for the matches reported without one
+     a: player id
+     b: player id
+    """
+    index = _opponentIndex(t_id)
+    with _opponentsLock:
+        return b in index.played.get(a, ())
+
+
+
+@_api
+def hasBye(t_id, p_id):
+    """Returns whether a player has had a bye in a tournament, from the
+    opponent index like hasPlayed().
+
+    Args:
+     t_id: tournament id, None for the matches reported without one
+     p_id: player id
+    """
+    index = _opponentIndex(t_id)
+    with _opponentsLock:
+        return p_id in index.byes
+
+
+
+@_api
+def opponentsOf(t_id, p_id):
+    """Returns the players someone has played in a tournament, from the
+    opponent index like hasPlayed().
+
+    Args:
+     t_id: tournament id, None for the matches reported without one
+     p_id: player id
+
+    Returns:
+      A frozenset of player ids, byes not included.
+    """
+    index = _opponentIndex(t_id)
+    with _opponentsLock:
+        return frozenset(index.played.get(p_id, ()))
  
 
  
-def swissPairings(t_id = None):
+@_api
+def swissPairings(t_id = None, by_rating=False):
     """Returns a list of pairs of players for the next round of a match.
   
-    Assuming that there are an even number of players registered, each player
-    appears exactly once in the pairings.  Each player is paired with another
-    player with an equal or nearly-equal win record, that is, a player adjacent
-    to him or her in the standings.
-
-    If there is an odd number of players a player will be assigned a bye. Then
-    players are paired depending on their wins. To allow every player to have
-    the same number of matches a player is popped off the list for pairing 
-    cosideration.
+    Each player is paired with another player with an equal or
+    nearly-equal score that they haven't played yet, see
+    pairing.pairPlayers(). A rematch only happens when no pairing of the
+    round without one exists.
+
+    With by_rating, a first round is seeded by the players' ratings instead:
+    the top half of the field plays the bottom half, see
+    pairing.pairByRating(). Later rounds are paired as usual.
+
+    If there is an odd number of players a player sits out the round with
+    a bye. That is the lowest ranked player that hasn't had a bye yet,
+    preferring players with the fewest matches. Seeded by rating that is
+    the lowest rated player. The bye isn't in the pairs returned.
+
+    Nothing is written, so a round can be previewed any number of times.
+    startRound() pairs the round the same way and records it, with the bye
+    as a win, and reportMatches() checks results against the last round
+    recorded.
   
     Returns:
       A list of tuples, each of which contains (id1, name1, id2, name2)
@@ -264,48 +1201,277 @@ def swissPairings(t_id = None):
         id2: the second player's unique id
         name2: the second player's name
     """
+    pairs, bye, names = _pairRound(t_id, by_rating)
+
+    return [(id1, names[id1], id2, names[id2]) for (id1, id2) in pairs]
+
+
+
+@_api
+def startRound(t_id, by_rating=False):
+    """Pairs the next round of a tournament like swissPairings() and records
+    it, like advanceRound() does.
+
+    The tournament is locked, so concurrent calls pair rounds one by one.
+    The round is paired from the standings inside the same transaction
+    that closes the previous round, records the bye as a win and saves the
+    pairs in the pairings table, so reportMatches() can check results
+    against them.
+
+    Args:
+     t_id: tournament id
+     by_rating: seed a first round by rating, see swissPairings()
+
+    Returns:
+      A list of tuples (id1, name1, id2, name2), one per pair, in standings
+      order. The bye is not included, it is already recorded as a match.
+
+    Raises:
+     ValueError: the tournament doesn't exist
+    """
+    with transaction():
+        if not _preparedQuery([('tournament_lock', [t_id])], 2):
+            raise ValueError("Tournament %s does not exist." % t_id)
+
+        pairs, bye, names = _pairRound(t_id, by_rating)
+
+        boards = list(range(1, len(pairs) + 1))
+        firsts = [id1 for (id1, id2) in pairs]
+        seconds = [id2 for (id1, id2) in pairs]
+        if bye != None:
+            # The bye has no board or opponent, as advance_round() records
+            # it
+            boards.append(None)
+            firsts.append(bye)
+            seconds.append(None)
+
+        _preparedQuery([('round_close_last', [t_id])])
+
+        if bye != None:
+            reportMatch(bye, None, t_id)
+
+        _preparedQuery([('pairings_insert', [t_id, boards, firsts, seconds])])
+
+    return [(id1, names[id1], id2, names[id2]) for (id1, id2) in pairs]
+
+
+
+def _pairRound(t_id, by_rating):
+    """Pairs the next round with the pairing engine, see swissPairings().
+
+    Returns:
+      A tuple (pairs, bye, names)
+        pairs: list of (id1, id2) tuples, in standings order
+        bye: id of the player that sits out the round, None if nobody does
+        names: dict of player id to name
+    """
     rows = playerStandings(t_id)
-    temp = []
+
+    # (p_id, name, score, matches), rows without a tournament only have wins
+    if t_id != None:
+        players = [(row[1], row[2], row[6], row[5]) for row in rows]
+    else:
+        players = [(row[0], row[1], row[2], row[3]) for row in rows]
+
+    seeded = by_rating and not any(p[3] for p in players)
+    if seeded:
+        rank = dict((row[0], i) for i, row in enumerate(playerRatings(t_id)))
+        players.sort(key=lambda p: rank[p[0]])
+
+    # The opponent index is read again if the standings show results it
+    # hasn't seen
     if t_id != None:
-        numPlayers = countTournamentPlayers(t_id)
+        index = _opponentIndex(t_id, rows)
     else:
-        numPlayers = countPlayers()
+        index = _opponentIndex(t_id)
+    played, byes = index.played, index.byes
 
-    matchNum = checkMatches(t_id)
+    bye = None
+    if len(players)%2 != 0:
+        bye = pairing.chooseBye([(p[0], p[2], p[3]) for p in players], byes)
+        players = [p for p in players if p[0] != bye]
+
+    names = dict((p[0], p[1]) for p in players)
+    if seeded:
+        pairs = pairing.pairByRating([p[0] for p in players])
+    else:
+        pairs = pairing.pairPlayers([(p[0], p[2]) for p in players], played)
 
+    return pairs, bye, names
 
-    """ Checks if there are odd number of players. A bye is given to a player
-        that doesn't have a bye yet. It also gives a bye to the player with the
-        least amount of matches to keep matches even per player.
+
+
+@_api
+def advanceRound(t_id):
+    """Pairs the next round of a tournament and records it.
+
+    The bye, the pairings and the round number are all decided and saved by
+    the advance_round() database function, in a single round trip. With an
+    odd number of players the lowest ranked player that hasn't had a bye yet
+    is given one, which counts as a win. Everyone else is paired with the
+    player adjacent to them in the standings, even a player they have
+    already played. Use startRound() for a round without rematches.
+
+    Args:
+     t_id: tournament id
+
+    Returns:
+      A list of tuples (id1, name1, id2, name2), one per pair, in standings
+      order. The bye is not included, it is already recorded as a match.
     """
-    if numPlayers%2 != 0:
-        for i in range(numPlayers-1, 0, -1):
-            if checkBye(rows[i][0], rows[i][1]) == False \
-            and rows[i][5] < matchNum:
-                reportMatch(rows[i][1], None ,rows[i][0])
-                break
-    
-    """ Update the standings accounting for the given bye. """
-    rows = playerStandings(t_id)
 
-    """ Pop off a player from the standings that hasn't had a bye yet. To
-        ensure that every player has equal amount of matches played, the 
-        player removed from the list isn't a player that has less matches
-        than every other player.
+    pairs = _preparedQuery([('advance_round', [t_id])], 2)
+    _changed(t_id)
+    _forgetOpponents(t_id)
+    return pairs
+
+
+
+@_api
+def closeRound(t_id):
+    """Snapshots the standings of a tournament as the end of its last round.
+
+    Pairing a round closes the one before it, this is only needed after the
+    results of the final round are in. Closing a closed round does nothing.
+
+    Args:
+     t_id: tournament id
+
+    Returns:
+      The number of the round closed, None if no round has been paired.
     """
-    if numPlayers%2 != 0:
-        for i in range(0, numPlayers-1, 1):
-            if checkBye(rows[i][0], rows[i][1]) == False \
-            and rows[i][5] >= matchNum:
-                rows.pop(i)
-                numPlayers = numPlayers-1
-                break   
 
-    if t_id != None:
-        temp = [(rows[i][1],rows[i][2],rows[i+1][1],rows[i+1][2])for \
-         i in range(0,numPlayers-1,2)]
-    else:
-        temp = [(rows[i][0],rows[i][1],rows[i+1][0],rows[i+1][1])for \
-         i in range(0,numPlayers-1,2)]    
+    round = _preparedQuery([('round_last', [t_id])], 1)[0]
+    if round != None:
+        _preparedQuery([('round_close', [t_id, round])])
+    return round
+
+
+
+@_api
+def standingsAt(t_id, round):
+    """Returns the standings of a tournament as they were at the end of a
+    round, read from its snapshot.
+
+    Args:
+     t_id: tournament id
+     round: round number, starting at 1
+
+    Returns:
+      A list of tuples like those of playerStandings(t_id), empty if the
+      round hasn't been closed.
+    """
+
+    return _preparedQuery([('standings_at', [t_id, round])], 2)
+
+
+
+@_api
+def restoreRound(t_id, round):
+    """Rolls a tournament back to the end of a closed round.
+
+    The matches and pairings of later rounds are deleted and the standings
+    are restored from the round's snapshot. Ratings are kept.
+
+    Args:
+     t_id: tournament id
+     round: round number of a closed round
+    """
+
+    _preparedQuery([('round_restore', [t_id, round])])
+    _changed(t_id)
+    _forgetOpponents(t_id)
+
+
+
+@_api
+def exportTournament(t_id, stream=None):
+    """Writes a tournament's players, ratings and matches in the binary
+    format of export.py.
+
+    Everything is read in one repeatable read transaction, so the export is
+    consistent while results keep coming in.
+
+    Args:
+     t_id: tournament id
+     stream: file-like object to write to, None to return the data
+
+    Returns:
+      The exported data if no stream was given.
+    """
+    out = stream
+    if out is None:
+        out = io.BytesIO()
+
+    outermost = getattr(_local, 'cursor', None) is None
+    with transaction():
+        if outermost:
+            commitQuery("SET TRANSACTION ISOLATION LEVEL REPEATABLE READ;")
+        row = _preparedQuery([('tournament_name', [t_id])], 1)
+        if row == None:
+            raise ValueError("Tournament %s does not exist." % t_id)
+        players = sorted(playerRatings(t_id))
+        export.write(out, row[0], players, tournamentMatches(t_id))
+
+    if stream is None:
+        return out.getvalue()
+
+
+
+@_api
+def importTournament(source):
+    """Creates a tournament from data written by exportTournament().
+
+    Its players are registered as new players, with the ratings they had,
+    and its matches are inserted in bulk, all in one transaction.
+
+    Args:
+     source: the exported data, or a file-like object to read it from
+
+    Returns:
+      The id of the new tournament.
+
+    Raises:
+     ValueError: the data is corrupt, or a match has a player that isn't
+                 in the tournament
+    """
+    if not hasattr(source, 'read'):
+        source = io.BytesIO(source)
+
+    # export.read() checks that the sections come in the order of the
+    # format, NAME, PLYR then MTCH
+    with transaction():
+        for section in export.read(source):
+            if section[0] == 'name':
+                t_id = createTournament(section[1])
+            elif section[0] == 'players':
+                ids, names, ratings, games = section[1:]
+                new = registerPlayers(names)
+                players = dict(zip(ids, new))
+                players[0] = None
+                _preparedQuery([('ratings_import',
+                                 [new, list(ratings), list(games)])])
+                enterTournamentBulk(t_id, new)
+            elif section[0] == 'matches':
+                winners, losers, draws = section[1:]
+                try:
+                    winners = [players[p_id] for p_id in winners]
+                    losers = [players[p_id] for p_id in losers]
+                except KeyError:
+                    raise ValueError("A match has a player that isn't in "
+                                     "the tournament.")
+                _preparedQuery([('matches_insert',
+                                 [t_id, winners, losers,
+                                  [bool(draw) for draw in draws]])])
+            else:
+                raise ValueError("Unknown tournament data section %r."
+                                 % section[0])
+        rebuildStandings(t_id)
+
+    return t_id
+
+
 
-    return temp
\ No newline at end of file
+if os.environ.get('TOURNAMENT_BACKEND') == 'memory':
+    import memory
+    setBackend(memory.MemoryBackend())
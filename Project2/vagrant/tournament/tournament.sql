@@ -9,6 +9,16 @@ DROP DATABASE tournament;
 CREATE DATABASE tournament;
 \c tournament;
 
+-- Schema Version Table
+-- One row per migration applied, see migrate.py. This file creates
+-- version 1 and then applies everything in migrations/ in order.
+CREATE TABLE schema_version (version INTEGER PRIMARY KEY,
+                             description TEXT,
+                             applied TIMESTAMP NOT NULL DEFAULT now());
+
+INSERT INTO schema_version (version, description)
+VALUES (1, 'tournament.sql');
+
 CREATE TABLE players( id SERIAL PRIMARY KEY, name TEXT);
 
 CREATE TABLE tournaments (id SERIAL PRIMARY KEY, name TEXT);
@@ -17,119 +27,266 @@ CREATE TABLE matches (id SERIAL PRIMARY KEY,
                        t_id INTEGER REFERENCES tournaments (id),
 					   winner INTEGER REFERENCES players (id),
 					   loser INTEGER REFERENCES players (id),
-                       draw BOOLEAN, bye BOOLEAN);
+                       draw BOOLEAN NOT NULL DEFAULT FALSE,
+                       bye BOOLEAN NOT NULL DEFAULT FALSE);
+
+CREATE INDEX matches_winner_idx ON matches (winner);
+CREATE INDEX matches_loser_idx ON matches (loser);
 
 CREATE TABLE registeredPlayers (t_id INTEGER REFERENCES tournaments (id),
-                                p_id INTEGER REFERENCES players (id));
-
-
--- Wins View
--- Creates a view showing wins for each player
--- COALESCE(foo.t_id, 0) is used to make t_id = 0 if t_id is Null 
--- (This is used in v_scores so v_wins.t_id = v_draws.t_id works)
--- (matches.t_id is null OR matches.t_id = foo.t_id)
--- Allows results to be shown even if t_id is null
-CREATE VIEW v_wins AS 
-        SELECT COALESCE(foo.t_id, 0) AS t_id, foo.id, foo.name, 
-        COUNT(matches.winner) AS wins 
-        FROM (SELECT * FROM players LEFT JOIN registeredPlayers 
-        ON players.id = registeredPlayers.p_id) AS foo LEFT JOIN matches 
-    	ON foo.id = matches.winner AND matches.draw != 't' 
-        AND (matches.t_id is null OR matches.t_id = foo.t_id) 
-        GROUP BY foo.t_id, foo.id, foo.name;
-
-
--- Draws View
--- Creates a view showing draws for each player
-CREATE VIEW v_draws AS
-    SELECT COALESCE(foo.t_id, 0) AS t_id, foo.id, foo.name, 
-    COUNT(matches.draw) AS draws
-    FROM (SELECT * FROM players LEFT JOIN registeredPlayers 
-    ON players.id = registeredPlayers.p_id) AS foo LEFT JOIN matches
-    ON (foo.id = matches.winner OR foo.id = matches.loser) 
-    AND matches.draw = 't' AND (matches.t_id is null OR matches.t_id = foo.t_id) 
-    GROUP BY foo.t_id, foo.id, foo.name;
-
-
--- Wins/Draws/Score View
--- Create a view showing wins/draws/score for each player.
--- Win = 3pts. Loss = 0pts. Draw = 1pt.
-CREATE VIEW v_scores AS
-    SELECT v_wins.t_id,v_wins.id,v_wins.name,v_wins.wins,v_draws.draws,
-    (wins*3)+draws AS score 
-    FROM v_wins,v_draws 
-    WHERE v_wins.id = v_draws.id AND v_wins.t_id = v_draws.t_id
-    ORDER BY t_id, score DESC;
-
-
--- Byes View
--- Create a view showing if a player has had a bye
-CREATE VIEW v_byes AS 
-    SELECT COALESCE(foo.t_id, 0) AS t_id, foo.id,foo.name,COUNT(bye) AS byes
-    FROM (SELECT * FROM players LEFT JOIN registeredPlayers 
-    ON players.id = registeredPlayers.p_id) AS foo 
-    LEFT JOIN matches ON (winner=foo.id OR loser=foo.id) 
-    AND matches.bye = 't' AND (matches.t_id is null OR matches.t_id = foo.t_id)
-    GROUP BY foo.t_id, foo.id, foo.name;
-
-
--- Matches View
--- Creates a view showing all matches played by each player
-CREATE VIEW v_matches AS 
-    SELECT COALESCE(foo.t_id, 0) AS t_id,foo.id,foo.name,
-    COUNT(matches) AS matches 
-    FROM (SELECT * FROM players LEFT JOIN registeredPlayers 
-    ON players.id = registeredPlayers.p_id) AS foo 
-    LEFT JOIN matches ON (winner=foo.id OR loser=foo.id) 
-    AND (matches.t_id is null OR matches.t_id = foo.t_id)
-    GROUP BY foo.t_id, foo.id, foo.name;
-
-
--- Opponent Match Wins View
--- Uses the v_scores view along with the matches table unioned 
--- with itself to create a omw view
-CREATE VIEW v_omw AS
-SELECT t_id, id, name, wins, draws, score,  
-    (
-     SELECT SUM(wins) FROM v_scores, 
-        -- Union gathers the players that v_scores.id has played
-        (
-         SELECT winner AS played FROM matches WHERE v_scores.id = matches.loser
-         UNION
-         SELECT loser AS played FROM matches  WHERE v_scores.id = matches.winner
-        ) AS foo
-     WHERE v_scores.id = foo.played
-    ) AS omw
-    --Needs to be from v_scores so v_scores.id can be used inside the union
-FROM v_scores;
-
-
--- Opponent Match Score View
--- Uses the v_scores view along with the matches table unioned 
--- with itself to create a oms view
-CREATE VIEW v_oms AS
-SELECT t_id, id, name, wins, draws, score, 
-    (
-     SELECT SUM(score) FROM v_scores, 
-        -- Union gathers the players that v_scors.id has played
-        (
-         SELECT winner AS played FROM matches WHERE v_scores.id = matches.loser
-         UNION
-         SELECT loser AS played FROM matches  WHERE v_scores.id = matches.winner
-        ) AS foo
-     WHERE v_scores.id = foo.played
-    ) AS oms
-    --Needs to be from v_scores so v_scores.id can be used inside the union
-FROM v_scores;
+                                p_id INTEGER REFERENCES players (id),
+                                PRIMARY KEY (t_id, p_id));
+
+-- Pairings of each round, board is the pair's position in the round.
+-- The player given a bye has a row with no player2 and no board.
+CREATE TABLE pairings (t_id INTEGER REFERENCES tournaments (id),
+                       round INTEGER NOT NULL,
+                       board INTEGER,
+                       player1 INTEGER REFERENCES players (id),
+                       player2 INTEGER REFERENCES players (id));
+
+CREATE INDEX pairings_round_idx ON pairings (t_id, round);
+
+
+-- Standings Table
+-- One row per player per tournament, kept up to date by the tournament.py
+-- functions that write matches and registrations, so reading the standings
+-- never has to look at the matches table.
+-- Players that haven't entered a tournament have a row with t_id = 0, and
+-- matches reported without a tournament are credited to that row.
+CREATE TABLE standings (t_id INTEGER NOT NULL DEFAULT 0,
+                        p_id INTEGER REFERENCES players (id) ON DELETE CASCADE,
+                        wins INTEGER NOT NULL DEFAULT 0,
+                        draws INTEGER NOT NULL DEFAULT 0,
+                        matches INTEGER NOT NULL DEFAULT 0,
+                        score INTEGER NOT NULL DEFAULT 0,
+                        omw INTEGER NOT NULL DEFAULT 0,
+                        oms INTEGER NOT NULL DEFAULT 0,
+                        byes INTEGER NOT NULL DEFAULT 0,
+                        PRIMARY KEY (t_id, p_id));
+
+
+-- Ratings Table
+-- Elo rating of each player across every tournament, updated as matches are
+-- reported so reading a rating never looks at the matches table.
+CREATE TABLE ratings (p_id INTEGER PRIMARY KEY
+                      REFERENCES players (id) ON DELETE CASCADE,
+                      rating DOUBLE PRECISION NOT NULL DEFAULT 1500,
+                      games INTEGER NOT NULL DEFAULT 0);
+
+-- Refresh Tiebreaks Function
+-- Recomputes OMW/OMS of the players in the given matches and of everyone
+-- they have played, which are the only rows whose opponents' totals changed.
+-- OMW/OMS is the sum of wins/score of each distinct opponent in the same
+-- tournament.
+CREATE FUNCTION standings_refresh_tiebreaks(ids INTEGER[]) RETURNS VOID AS $$
+BEGIN
+    WITH touched AS (
+        SELECT COALESCE(t_id, 0) AS t_id, winner AS p_id
+        FROM matches WHERE id = ANY(ids)
+        UNION
+        SELECT COALESCE(t_id, 0), loser
+        FROM matches WHERE id = ANY(ids) AND loser IS NOT NULL
+    ), affected AS (
+        SELECT t_id, p_id FROM touched
+        UNION
+        SELECT touched.t_id, matches.loser FROM touched JOIN matches
+        ON matches.winner = touched.p_id
+        AND COALESCE(matches.t_id, 0) = touched.t_id
+        WHERE matches.loser IS NOT NULL
+        UNION
+        SELECT touched.t_id, matches.winner FROM touched JOIN matches
+        ON matches.loser = touched.p_id
+        AND COALESCE(matches.t_id, 0) = touched.t_id
+    ), played AS (
+        -- Union gathers the distinct opponents of each affected player
+        SELECT affected.t_id, affected.p_id, matches.loser AS opponent
+        FROM affected JOIN matches ON matches.winner = affected.p_id
+        AND COALESCE(matches.t_id, 0) = affected.t_id
+        WHERE matches.loser IS NOT NULL
+        UNION
+        SELECT affected.t_id, affected.p_id, matches.winner
+        FROM affected JOIN matches ON matches.loser = affected.p_id
+        AND COALESCE(matches.t_id, 0) = affected.t_id
+    ), totals AS (
+        SELECT affected.t_id, affected.p_id,
+        COALESCE(SUM(opponent.wins), 0) AS omw,
+        COALESCE(SUM(opponent.score), 0) AS oms
+        FROM affected
+        LEFT JOIN played ON played.t_id = affected.t_id
+        AND played.p_id = affected.p_id
+        LEFT JOIN standings AS opponent ON opponent.t_id = played.t_id
+        AND opponent.p_id = played.opponent
+        GROUP BY affected.t_id, affected.p_id
+    )
+    UPDATE standings SET omw = totals.omw, oms = totals.oms
+    FROM totals
+    WHERE standings.t_id = totals.t_id AND standings.p_id = totals.p_id;
+END;
+$$ LANGUAGE plpgsql;
+
+
+-- Apply Matches Function
+-- Adds newly inserted matches to the standings of both players, then
+-- refreshes the tiebreaks they affect.
+-- Win = 3pts. Loss = 0pts. Draw = 1pt. A bye counts as a win.
+CREATE FUNCTION standings_apply(ids INTEGER[]) RETURNS VOID AS $$
+BEGIN
+    UPDATE standings
+    SET wins = standings.wins + delta.wins,
+        draws = standings.draws + delta.draws,
+        matches = standings.matches + delta.matches,
+        byes = standings.byes + delta.byes,
+        score = (standings.wins + delta.wins) * 3
+                + standings.draws + delta.draws
+    FROM (
+        SELECT t_id, p_id, SUM(wins) AS wins, SUM(draws) AS draws,
+        COUNT(*) AS matches, SUM(byes) AS byes
+        FROM (
+            SELECT COALESCE(t_id, 0) AS t_id, winner AS p_id,
+            CASE WHEN draw THEN 0 ELSE 1 END AS wins,
+            CASE WHEN draw THEN 1 ELSE 0 END AS draws,
+            CASE WHEN bye THEN 1 ELSE 0 END AS byes
+            FROM matches WHERE id = ANY(ids)
+            UNION ALL
+            SELECT COALESCE(t_id, 0), loser, 0,
+            CASE WHEN draw THEN 1 ELSE 0 END, 0
+            FROM matches WHERE id = ANY(ids) AND loser IS NOT NULL
+        ) AS sides
+        GROUP BY t_id, p_id
+    ) AS delta
+    WHERE standings.t_id = delta.t_id AND standings.p_id = delta.p_id;
+
+    PERFORM standings_refresh_tiebreaks(ids);
+END;
+$$ LANGUAGE plpgsql;
+
+
+-- Apply Ratings Function
+-- Updates the Elo ratings of the players in newly inserted matches, with
+-- K = 32. The matches are rated together against the ratings from before
+-- them, so a batch should have at most one match per player. Byes don't
+-- change ratings.
+CREATE FUNCTION ratings_apply(ids INTEGER[]) RETURNS VOID AS $$
+BEGIN
+    UPDATE ratings
+    SET rating = ratings.rating + delta.change,
+        games = ratings.games + delta.games
+    FROM (
+        SELECT p_id, SUM(32 * (result - 1 / (1 + 10 ^ ((other - own) / 400))))
+        AS change, COUNT(*) AS games
+        FROM (
+            SELECT matches.winner AS p_id, w.rating AS own, l.rating AS other,
+            CASE WHEN draw THEN 0.5 ELSE 1 END::DOUBLE PRECISION AS result
+            FROM matches
+            JOIN ratings AS w ON w.p_id = matches.winner
+            JOIN ratings AS l ON l.p_id = matches.loser
+            WHERE matches.id = ANY(ids)
+            UNION ALL
+            SELECT matches.loser, l.rating, w.rating,
+            CASE WHEN draw THEN 0.5 ELSE 0 END::DOUBLE PRECISION
+            FROM matches
+            JOIN ratings AS w ON w.p_id = matches.winner
+            JOIN ratings AS l ON l.p_id = matches.loser
+            WHERE matches.id = ANY(ids)
+        ) AS sides
+        GROUP BY p_id
+    ) AS delta
+    WHERE ratings.p_id = delta.p_id;
+END;
+$$ LANGUAGE plpgsql;
+
+-- Rebuild Standings Function
+-- Recomputes the standings of one tournament (all of them if NULL) from
+-- the matches table. Only needed to repair the table, the functions in
+-- tournament.py keep it current.
+CREATE FUNCTION standings_rebuild(tournament INTEGER) RETURNS VOID AS $$
+BEGIN
+    UPDATE standings
+    SET wins = 0, draws = 0, matches = 0, score = 0, omw = 0, oms = 0,
+        byes = 0
+    WHERE tournament IS NULL OR t_id = tournament;
+
+    PERFORM standings_apply(ARRAY(
+        SELECT id FROM matches
+        WHERE tournament IS NULL OR COALESCE(t_id, 0) = tournament));
+END;
+$$ LANGUAGE plpgsql;
 
 
 -- Player standings ordered by wins and oms if there is a tie
--- Uses v_oms, v_matches, v_byes to create a view that lists matches 
--- won and played for each player
+-- Reads the standings table, reading it costs the same no matter how many
+-- matches have been played.
 CREATE VIEW v_standings AS 
-    SELECT v_oms.t_id, v_oms.id, v_oms.name, v_oms.wins, v_oms.draws,
-     v_matches.matches, v_oms.score, v_oms.oms, v_byes.byes
-    FROM v_oms,v_matches,v_byes WHERE v_oms.id = v_matches.id 
-    AND v_oms.id = v_byes.id AND v_oms.t_id = v_matches.t_id 
-    AND v_oms.t_id = v_byes.t_id 
+    SELECT standings.t_id, standings.p_id AS id, players.name,
+     standings.wins, standings.draws, standings.matches, standings.score,
+     standings.oms, standings.byes
+    FROM standings JOIN players ON players.id = standings.p_id
     ORDER BY t_id, wins DESC, oms DESC, id DESC;
+
+
+-- Advance Round Function
+-- Pairs the next round of a tournament and records it in one statement.
+-- With an odd number of players the lowest ranked player that hasn't had a
+-- bye (fewest matches first) is given one, which is recorded as a win. The
+-- others are paired with the player adjacent to them in the standings,
+-- whether they have played each other or not, so a round can hold rematches.
+-- pairing.py avoids them, see startRound() in tournament.py.
+-- Returns the pairs in board order, not including the bye.
+CREATE FUNCTION advance_round(tournament INTEGER)
+RETURNS TABLE (id1 INTEGER, name1 TEXT, id2 INTEGER, name2 TEXT) AS $$
+DECLARE
+    next_round INTEGER;
+    bye_player INTEGER;
+BEGIN
+    -- Locking the tournament makes concurrent calls pair rounds one by one
+    PERFORM 1 FROM tournaments WHERE id = tournament FOR UPDATE;
+    IF NOT FOUND THEN
+        RAISE EXCEPTION 'Tournament % does not exist', tournament;
+    END IF;
+
+    SELECT COALESCE(MAX(round), 0) + 1 INTO next_round
+    FROM pairings WHERE t_id = tournament;
+
+    IF (SELECT count(*) FROM standings WHERE t_id = tournament) % 2 = 1 THEN
+        SELECT p_id INTO bye_player FROM standings WHERE t_id = tournament
+        ORDER BY byes, matches, wins, oms, p_id LIMIT 1;
+    END IF;
+
+    INSERT INTO pairings (t_id, round, board, player1, player2)
+    SELECT tournament, next_round, (rank + 1) / 2, player1, player2
+    FROM (
+        SELECT p_id AS player1, lead(p_id) OVER ranked AS player2,
+        row_number() OVER ranked AS rank
+        FROM standings
+        WHERE t_id = tournament AND p_id IS DISTINCT FROM bye_player
+        WINDOW ranked AS (ORDER BY wins DESC, oms DESC, p_id DESC)
+    ) AS ranked
+    WHERE rank % 2 = 1;
+
+    IF bye_player IS NOT NULL THEN
+        INSERT INTO pairings (t_id, round, player1)
+        VALUES (tournament, next_round, bye_player);
+        INSERT INTO matches (t_id, winner, bye)
+        VALUES (tournament, bye_player, TRUE);
+        PERFORM standings_apply(ARRAY[currval('matches_id_seq')::integer]);
+    END IF;
+
+    RETURN QUERY
+    SELECT pairings.player1, p1.name, pairings.player2, p2.name
+    FROM pairings
+    JOIN players AS p1 ON p1.id = pairings.player1
+    JOIN players AS p2 ON p2.id = pairings.player2
+    WHERE pairings.t_id = tournament AND pairings.round = next_round
+    ORDER BY pairings.board;
+END;
+$$ LANGUAGE plpgsql;
+
+
+-- Migrations
+-- New migrations are added to migrations/ and included here, so a new
+-- database ends up with the same schema as an upgraded one.
+\ir migrations/0002_indexes.sql
+\ir migrations/0003_partitions.sql
+\ir migrations/0004_round_snapshots.sql
+\ir migrations/0005_standings_order.sql
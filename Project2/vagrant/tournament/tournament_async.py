@@ -0,0 +1,609 @@
+#!/usr/bin/env python3
+#
+# tournament_async.py -- asyncio version of the tournament.py API
+#
+# The public functions of tournament.py as coroutines, with the same names,
+# arguments and results, on an asyncpg connection pool. While one call waits
+# on the database the event loop runs the others, so a single process can
+# serve standings and pairings for many tournaments at once. Uses the same
+# schema, tournament.sql and migrations/, and the same statements,
+# queries.py, which asyncpg prepares once per connection.
+#
+# Needs Python 3.7 or later and asyncpg. The monitor and cache hooks, the
+# opponent index, the NumPy standings, the memory backend and the export
+# functions are only in tournament.py.
+#
+
+import asyncio
+import contextvars
+from contextlib import asynccontextmanager
+
+import asyncpg
+
+import pairing
+from queries import SCRIPTS, STATEMENTS
+
+
+# Connection pool settings, see configurePool()
+POOL_MIN = 1
+POOL_MAX = 10
+POOL_DSN = "postgresql:///tournament"
+
+_pool = None
+_poolLock = None
+
+# Connection of the transaction open in the current task, if any
+_connection = contextvars.ContextVar('connection', default=None)
+
+
+
+async def configurePool(minconn=1, maxconn=10, dsn="postgresql:///tournament"):
+    """Sets up the connection pool shared by every task.
+
+    Replaces the pool if one was already set up.
+
+    Args:
+     minconn: connections opened up front
+     maxconn: most connections open at once, calls beyond that wait
+     dsn: asyncpg connection string
+    """
+    global POOL_MIN, POOL_MAX, POOL_DSN, _pool
+
+    if minconn < 0 or maxconn < 1 or minconn > maxconn:
+        raise ValueError("Need 0 <= minconn <= maxconn and maxconn >= 1.")
+
+    POOL_MIN, POOL_MAX, POOL_DSN = minconn, maxconn, dsn
+    await closePool()
+    _pool = await _createPool()
+
+
+
+async def closePool():
+    """Closes every connection in the pool."""
+    global _pool
+    pool, _pool = _pool, None
+    if pool is not None:
+        await pool.close()
+
+
+
+async def _reset(db):
+    """Readies a connection given back to the pool.
+
+    The functions here leave no session state behind, so this only rolls
+    back a transaction left open by a cancelled task. asyncpg's own reset
+    would cost a round trip on every release.
+    """
+    if db.is_in_transaction():
+        await db.execute("ROLLBACK;")
+
+
+
+def _createPool():
+    return asyncpg.create_pool(POOL_DSN, min_size=POOL_MIN,
+                               max_size=POOL_MAX, reset=_reset)
+
+
+
+async def _getPool():
+    """Returns the pool, creating it with the POOL_* settings on first
+    use."""
+    global _pool, _poolLock
+    if _pool is None:
+        if _poolLock is None:
+            _poolLock = asyncio.Lock()
+        async with _poolLock:
+            if _pool is None:
+                _pool = await _createPool()
+    return _pool
+
+
+
+@asynccontextmanager
+async def transaction():
+    """Runs a block of calls as one transaction on one pooled connection.
+
+    Calls awaited inside the block by the same task use the same
+    connection, so the block commits as a whole or is rolled back if an
+    exception escapes it. Nested blocks join the outermost transaction.
+
+    Example:
+     async with transaction():
+         await reportMatch(id1, id2, t_id)
+         await reportMatch(id3, id4, t_id)
+
+    Yields:
+     the connection of the transaction
+    """
+    db = _connection.get()
+    if db is not None:
+        yield db
+        return
+
+    pool = await _getPool()
+    async with pool.acquire() as db:
+        async with db.transaction():
+            token = _connection.set(db)
+            try:
+                yield db
+            finally:
+                _connection.reset(token)
+
+
+
+@asynccontextmanager
+async def _db():
+    """Yields the connection of the open transaction, or else a pooled
+    connection."""
+    db = _connection.get()
+    if db is not None:
+        yield db
+        return
+
+    pool = await _getPool()
+    async with pool.acquire() as db:
+        yield db
+
+
+
+async def _execute(name, *args):
+    """Runs STATEMENTS[name]."""
+    async with _db() as db:
+        return await db.execute(STATEMENTS[name], *args)
+
+
+
+async def _fetch(name, *args):
+    """Runs STATEMENTS[name] and returns its rows as tuples."""
+    async with _db() as db:
+        return [tuple(row) for row in await db.fetch(STATEMENTS[name], *args)]
+
+
+
+async def _fetchval(name, *args):
+    """Runs STATEMENTS[name] and returns the first value of its first row."""
+    async with _db() as db:
+        return await db.fetchval(STATEMENTS[name], *args)
+
+
+
+async def _script(name):
+    """Runs SCRIPTS[name], its commands as one transaction."""
+    async with _db() as db:
+        await db.execute(SCRIPTS[name])
+
+
+
+async def deleteMatches():
+    """Remove all the match records from the database."""
+
+    await _script('matches_delete')
+
+
+
+async def deletePlayers():
+    """Remove all the player records from the database."""
+
+    await _execute('players_delete')
+
+
+
+async def deleteTournaments():
+    """Remove all the tournaments from the database. """
+
+    # Tournament 0 holds the matches reported without a tournament
+    await _execute('tournaments_delete')
+
+
+
+async def deleteTournament(t_id):
+    """Deletes one tournament, see tournament.deleteTournament()."""
+
+    await _execute('tournament_delete', t_id)
+
+
+
+async def archiveTournament(t_id):
+    """Moves a finished tournament out of the live tables, see
+    tournament.archiveTournament()."""
+
+    await _execute('tournament_archive', t_id)
+
+
+
+async def deleteRegisteredPlayers():
+    """Remove all the registered tournament players. """
+
+    await _script('registrations_delete')
+
+
+
+async def countPlayers():
+    """Returns the number of players currently registered."""
+
+    return await _fetchval('players_count')
+
+
+
+async def countTournamentPlayers(t_id):
+    """Returns the number of players registered in a tournament. """
+
+    return await _fetchval('tournament_players_count', t_id)
+
+
+
+async def createTournament(name):
+    """Creates a tournament and returns its id."""
+
+    return await _fetchval('tournament_create', name)
+
+
+
+async def registerPlayer(name):
+    """Adds a player to the tournament database and returns their id."""
+
+    return await _fetchval('player_register', name)
+
+
+
+async def registerPlayers(names):
+    """Adds many players with one statement and returns their ids, in the
+    order of names."""
+
+    return [row[0] for row in await _fetch('players_register', list(names))]
+
+
+
+async def enterTournament(t_id, p_id):
+    """Adds a player to a tournament."""
+
+    await _execute('player_enter', t_id, p_id)
+
+
+
+async def enterTournamentBulk(t_id, player_ids):
+    """Adds many players to a tournament with one statement, skipping those
+    already in it. Returns the ids of the players newly registered."""
+
+    rows = await _fetch('players_enter', t_id, list(player_ids))
+    return [row[0] for row in rows]
+
+
+
+async def playerStandings(t_id=None):
+    """Returns the standings as tournament.playerStandings() does: tuples
+    (t_id, p_id, name, wins, draws, matches, score, oms, byes) ranked by
+    wins, or (p_id, name, wins, matches) for every player if t_id is
+    None."""
+
+    if t_id is not None:
+        return await _fetch('standings', t_id)
+
+    rows = await _fetch('standings_all')
+    return [(row[1], row[2], row[3], row[5]) for row in rows]
+
+
+
+async def iterStandings(t_id=None, chunk=1000):
+    """Yields the rows of playerStandings(t_id) one at a time, see
+    tournament.iterStandings().
+
+    The rows are fetched chunk at a time from a cursor, in the open
+    transaction or else in one of its own on a pooled connection, which
+    stays checked out until the last row is read or the generator is
+    closed.
+    """
+
+    db = _connection.get()
+    if db is not None:
+        async for row in _standingsCursor(db, t_id, chunk):
+            yield row
+        return
+
+    pool = await _getPool()
+    async with pool.acquire() as db:
+        async with db.transaction():
+            async for row in _standingsCursor(db, t_id, chunk):
+                yield row
+
+
+
+async def _standingsCursor(db, t_id, chunk):
+    if t_id is not None:
+        cursor = db.cursor(STATEMENTS['standings'], t_id, prefetch=chunk)
+    else:
+        cursor = db.cursor(STATEMENTS['standings_all'], prefetch=chunk)
+    async for row in cursor:
+        if t_id is not None:
+            yield tuple(row)
+        else:
+            yield (row[1], row[2], row[3], row[5])
+
+
+
+async def playerStandingsPage(t_id, after=None, limit=50):
+    """Returns one page of a tournament's standings, starting after player
+    after, see tournament.playerStandingsPage()."""
+
+    if after is None:
+        return await _fetch('standings_first_page', t_id, limit)
+
+    return await _fetch('standings_page', t_id, after, limit)
+
+
+
+async def playerRatings(t_id=None):
+    """Returns tuples (p_id, name, rating, games), best rated first, of the
+    players in a tournament or of every player if t_id is None."""
+
+    if t_id is not None:
+        return await _fetch('ratings', t_id)
+
+    return await _fetch('ratings_all')
+
+
+
+async def tournamentMatches(t_id=None):
+    """Returns tuples (winner, loser, draw) of the matches of a tournament
+    in the order they were reported, loser is None for a bye."""
+
+    return await _fetch('tournament_matches', t_id)
+
+
+
+async def reportMatch(winner, loser=None, t_id=None, draw=False, bye=False):
+    """Records the outcome of a single match between two players."""
+    if loser is None:
+        bye = True
+
+    # Matches without a tournament are in tournament 0
+    if t_id is None:
+        t_id = 0
+    async with transaction() as db:
+        await db.execute(STATEMENTS['match_insert'], t_id, winner, loser,
+                         bool(draw), bye)
+        await db.execute(STATEMENTS['match_apply'], t_id)
+
+
+
+async def reportMatches(t_id, results):
+    """Records a whole round of results at once, see
+    tournament.reportMatches().
+
+    Raises:
+     ValueError: a player appears in more than one result or isn't
+                 registered in the tournament, or advanceRound() or
+                 startRound() has recorded the round and the two players
+                 weren't paired together
+    """
+    winners, losers, draws = [], [], []
+    seen = set()
+    for result in results:
+        winner, loser = result[0], result[1]
+        for p_id in (winner, loser):
+            if p_id in seen:
+                raise ValueError(
+                    "Player %s appears in more than one result." % p_id)
+            if p_id is not None:
+                seen.add(p_id)
+        winners.append(winner)
+        losers.append(loser)
+        draws.append(len(result) > 2 and bool(result[2]))
+
+    if not winners:
+        return
+
+    async with transaction() as db:
+        rows = await db.fetch(STATEMENTS['registered'], t_id, list(seen))
+        missing = seen - set(row[0] for row in rows)
+        if missing:
+            raise ValueError("Players %s aren't registered in tournament %s."
+                             % (sorted(missing), t_id))
+
+        # Once advanceRound or startRound has recorded the round, results
+        # must follow it
+        rows = await db.fetch(STATEMENTS['round_pairs'], t_id)
+        if rows:
+            pairs = set(frozenset(row) for row in rows)
+            for winner, loser in zip(winners, losers):
+                if frozenset([winner, loser]) not in pairs:
+                    raise ValueError("Players %s and %s weren't paired in "
+                                     "this round." % (winner, loser))
+
+        rows = await db.fetch(STATEMENTS['matches_insert'], t_id, winners,
+                              losers, draws)
+        ids = [row[0] for row in rows]
+        await db.execute(STATEMENTS['matches_apply'], t_id, ids)
+
+
+
+async def rebuildStandings(t_id=None):
+    """Recomputes the standings of a tournament, of every tournament if
+    None, from the matches table."""
+
+    await _execute('standings_rebuild', t_id)
+
+
+
+async def checkBye(t_id, p_id):
+    """Returns whether a player has had a bye in a tournament, False for a
+    player that isn't in it."""
+
+    return bool(await _fetchval('player_byes', t_id, p_id))
+
+
+
+async def checkMatches(t_id):
+    """Returns the most matches played by a player of a tournament."""
+
+    return await _fetchval('check_matches', t_id)
+
+
+
+async def _history(t_id):
+    """Returns (played, byes) of a tournament, see pairing.buildHistory().
+
+    Read from the matches on every call, there is no opponent index here;
+    hasPlayed(), hasBye() and opponentsOf() only read the matches of the
+    players they are asked about.
+    """
+    return pairing.buildHistory(await _fetch('match_history', t_id))
+
+
+
+async def hasPlayed(t_id, a, b):
+    """Returns whether two players have played each other in a tournament,
+    see tournament.hasPlayed()."""
+
+    return await _fetchval('match_played', t_id, a, b)
+
+
+
+async def hasBye(t_id, p_id):
+    """Returns whether a player has had a bye in a tournament, see
+    tournament.hasBye()."""
+
+    return await _fetchval('match_bye', t_id, p_id)
+
+
+
+async def opponentsOf(t_id, p_id):
+    """Returns a frozenset of the players someone has played in a
+    tournament, byes not included."""
+
+    rows = await _fetch('match_opponents', t_id, p_id)
+    return frozenset(row[0] for row in rows)
+
+
+
+async def swissPairings(t_id=None, by_rating=False):
+    """Pairs the next round, see tournament.swissPairings().
+
+    Nothing is written, see startRound() to record the round.
+
+    Returns:
+      A list of tuples (id1, name1, id2, name2).
+    """
+    pairs, bye, names = await _pairRound(t_id, by_rating)
+
+    return [(id1, names[id1], id2, names[id2]) for (id1, id2) in pairs]
+
+
+
+async def startRound(t_id, by_rating=False):
+    """Pairs the next round of a tournament like swissPairings() and records
+    it, in one transaction with the tournament locked, see
+    tournament.startRound().
+
+    Returns:
+      A list of tuples (id1, name1, id2, name2), the bye not included.
+
+    Raises:
+     ValueError: the tournament doesn't exist
+    """
+    async with transaction() as db:
+        if await db.fetchval(STATEMENTS['tournament_lock'], t_id) is None:
+            raise ValueError("Tournament %s does not exist." % t_id)
+
+        pairs, bye, names = await _pairRound(t_id, by_rating)
+
+        boards = list(range(1, len(pairs) + 1))
+        firsts = [id1 for (id1, id2) in pairs]
+        seconds = [id2 for (id1, id2) in pairs]
+        if bye is not None:
+            # The bye has no board or opponent, as advance_round() records
+            # it
+            boards.append(None)
+            firsts.append(bye)
+            seconds.append(None)
+
+        await db.execute(STATEMENTS['round_close_last'], t_id)
+        if bye is not None:
+            await reportMatch(bye, None, t_id)
+        await db.execute(STATEMENTS['pairings_insert'], t_id, boards, firsts,
+                         seconds)
+
+    return [(id1, names[id1], id2, names[id2]) for (id1, id2) in pairs]
+
+
+
+async def _pairRound(t_id, by_rating):
+    """Pairs the next round, see tournament._pairRound().
+
+    The pairing itself runs in the default executor, so large fields don't
+    hold up the other tasks of the event loop.
+
+    Returns:
+      A tuple (pairs, bye, names).
+    """
+    rows = await playerStandings(t_id)
+
+    # (p_id, name, score, matches), rows without a tournament only have wins
+    if t_id is not None:
+        players = [(row[1], row[2], row[6], row[5]) for row in rows]
+    else:
+        players = [(row[0], row[1], row[2], row[3]) for row in rows]
+
+    seeded = by_rating and not any(p[3] for p in players)
+    if seeded:
+        rank = dict((row[0], i)
+                    for i, row in enumerate(await playerRatings(t_id)))
+        players.sort(key=lambda p: rank[p[0]])
+
+    played, byes = await _history(t_id)
+
+    bye = None
+    if len(players) % 2 != 0:
+        bye = pairing.chooseBye([(p[0], p[2], p[3]) for p in players], byes)
+        players = [p for p in players if p[0] != bye]
+
+    names = dict((p[0], p[1]) for p in players)
+    loop = asyncio.get_running_loop()
+    if seeded:
+        pairs = await loop.run_in_executor(
+            None, pairing.pairByRating, [p[0] for p in players])
+    else:
+        pairs = await loop.run_in_executor(
+            None, pairing.pairPlayers, [(p[0], p[2]) for p in players],
+            played)
+
+    return pairs, bye, names
+
+
+
+async def advanceRound(t_id):
+    """Pairs the next round of a tournament and records it in one round
+    trip, see tournament.advanceRound().
+
+    Returns:
+      A list of tuples (id1, name1, id2, name2), the bye not included.
+    """
+
+    return await _fetch('advance_round', t_id)
+
+
+
+async def closeRound(t_id):
+    """Snapshots the standings of a tournament as the end of its last
+    round. Returns the round closed, None if no round has been paired."""
+
+    async with transaction() as db:
+        round = await db.fetchval(STATEMENTS['round_last'], t_id)
+        if round is not None:
+            await db.execute(STATEMENTS['round_close'], t_id, round)
+    return round
+
+
+
+async def standingsAt(t_id, round):
+    """Returns the standings of a tournament at the end of a closed round,
+    like playerStandings(t_id)."""
+
+    return await _fetch('standings_at', t_id, round)
+
+
+
+async def restoreRound(t_id, round):
+    """Rolls a tournament back to the end of a closed round."""
+
+    await _execute('round_restore', t_id, round)
@@ -0,0 +1,191 @@
+#!/usr/bin/env python3
+#
+# tournament_async_benchmark.py -- throughput of tournament_async.py
+#
+# Plays the same set of tournaments three ways and reports the calls per
+# second of each:
+#
+#   sync     tournament.py, one tournament after the other
+#   threads  tournament.py, a thread per tournament on its connection pool
+#   async    tournament_async.py, a task per tournament on its asyncpg pool
+#
+# Each round of a tournament is advanceRound, reportMatches and --reads
+# calls of playerStandings, the load of a tournament server where players
+# keep refreshing the standings. Both pools hold --connections connections.
+# Results go to stdout as JSON, a summary table to stderr.
+#
+# Usage: python3 tournament_async_benchmark.py [--tournaments N]
+#            [--players N] [--rounds N] [--reads N] [--connections N]
+#            [--dsn DSN] [--output FILE]
+#
+# WARNING: deletes every player, match and tournament in the database.
+#
+
+import argparse
+import asyncio
+import json
+import platform
+import random
+import sys
+import threading
+import timeit
+
+import tournament
+import tournament_async
+
+
+def results(pairs, rng):
+    """Returns random results for the pairs of a round."""
+    return [(id1, id2, rng.random() < 0.1) if rng.random() < 0.5
+            else (id2, id1) for (id1, name1, id2, name2) in pairs]
+
+
+
+def setUp(numTournaments, numPlayers):
+    """Deletes everything and registers numPlayers players in each of
+    numTournaments new tournaments.
+
+    Returns:
+      The list of tournament ids.
+    """
+    tournament.deleteMatches()
+    tournament.deleteRegisteredPlayers()
+    tournament.deleteTournaments()
+    tournament.deletePlayers()
+
+    tournaments = []
+    for i in range(numTournaments):
+        t_id = tournament.createTournament("Benchmark %d" % i)
+        ids = tournament.registerPlayers(
+            ["Player %d.%d" % (i, p) for p in range(numPlayers)])
+        tournament.enterTournamentBulk(t_id, ids)
+        tournaments.append(t_id)
+    return tournaments
+
+
+
+def playSync(t_id, rounds, reads, rng):
+    """Plays rounds of a tournament with tournament.py. Returns the number
+    of calls made."""
+    for round in range(rounds):
+        pairs = tournament.advanceRound(t_id)
+        tournament.reportMatches(t_id, results(pairs, rng))
+        for read in range(reads):
+            tournament.playerStandings(t_id)
+    return rounds * (2 + reads)
+
+
+
+async def playAsync(t_id, rounds, reads, rng):
+    """Plays rounds of a tournament with tournament_async.py. Returns the
+    number of calls made."""
+    for round in range(rounds):
+        pairs = await tournament_async.advanceRound(t_id)
+        await tournament_async.reportMatches(t_id, results(pairs, rng))
+        await asyncio.gather(*[tournament_async.playerStandings(t_id)
+                               for read in range(reads)])
+    return rounds * (2 + reads)
+
+
+
+def runSync(tournaments, args):
+    return sum(playSync(t_id, args.rounds, args.reads,
+                        random.Random(args.seed + t_id))
+               for t_id in tournaments)
+
+
+
+def runThreads(tournaments, args):
+    calls = []
+
+    def play(t_id):
+        calls.append(playSync(t_id, args.rounds, args.reads,
+                              random.Random(args.seed + t_id)))
+
+    threads = [threading.Thread(target=play, args=(t_id,))
+               for t_id in tournaments]
+    for thread in threads:
+        thread.start()
+    for thread in threads:
+        thread.join()
+    if len(calls) != len(threads):
+        raise RuntimeError("A benchmark thread failed.")
+    return sum(calls)
+
+
+
+def runAsync(tournaments, args):
+
+    async def play():
+        await tournament_async.configurePool(args.connections,
+                                             args.connections, args.dsn)
+        try:
+            calls = await asyncio.gather(*[
+                playAsync(t_id, args.rounds, args.reads,
+                          random.Random(args.seed + t_id))
+                for t_id in tournaments])
+        finally:
+            await tournament_async.closePool()
+        return sum(calls)
+
+    return asyncio.run(play())
+
+
+
+MODES = [('sync', runSync), ('threads', runThreads), ('async', runAsync)]
+
+
+
+def main(argv):
+    parser = argparse.ArgumentParser(
+        description="Compares the throughput of tournament_async.py with "
+                    "tournament.py.")
+    parser.add_argument('--tournaments', type=int, default=50)
+    parser.add_argument('--players', type=int, default=64)
+    parser.add_argument('--rounds', type=int, default=6)
+    parser.add_argument('--reads', type=int, default=10,
+                        help="playerStandings calls per round")
+    parser.add_argument('--connections', type=int, default=10)
+    parser.add_argument('--dsn', default="postgresql:///tournament",
+                        help="asyncpg connection string")
+    parser.add_argument('--output', default='-',
+                        help="file the JSON results are written to")
+    parser.add_argument('--seed', type=int, default=2016)
+    args = parser.parse_args(argv[1:])
+
+    tournament.configurePool(args.connections, args.connections)
+
+    modes = []
+    sys.stderr.write("%-8s %8s %10s %10s\n" % ("mode", "calls", "seconds",
+                                              "calls/s"))
+    for name, run in MODES:
+        tournaments = setUp(args.tournaments, args.players)
+        start = timeit.default_timer()
+        calls = run(tournaments, args)
+        seconds = timeit.default_timer() - start
+        modes.append({'mode': name, 'calls': calls, 'seconds': seconds,
+                      'calls_per_second': calls / seconds})
+        sys.stderr.write("%-8s %8d %10.3f %10.1f\n" % (
+            name, calls, seconds, calls / seconds))
+
+    tournament.closePool()
+    report = {
+        'python': platform.python_version(),
+        'tournaments': args.tournaments,
+        'players': args.players,
+        'rounds': args.rounds,
+        'reads': args.reads,
+        'connections': args.connections,
+        'seed': args.seed,
+        'modes': modes,
+    }
+    if args.output == '-':
+        json.dump(report, sys.stdout, indent=2, sort_keys=True)
+        sys.stdout.write("\n")
+    else:
+        with open(args.output, 'w') as output:
+            json.dump(report, output, indent=2, sort_keys=True)
+
+
+if __name__ == '__main__':
+    main(sys.argv)
@@ -0,0 +1,184 @@
+#!/usr/bin/env python
+#
+# tournament_benchmark.py -- times the tournament.py functions at scale
+#
+# Plays synthetic tournaments through the public functions of tournament.py
+# and records the latency and the number of queries of every call to
+# registerPlayer, reportMatch, playerStandings and swissPairings, along
+# with the statistics of each SQL statement and the hit rates of the
+# prepared statements from monitor.py. A summary
+# table goes to stderr and the results go to stdout (or --output) as JSON,
+# so runs can be compared to catch regressions.
+#
+# Usage: python tournament_benchmark.py [--rounds N] [--memory]
+#                                      [--output FILE] [players ...]
+#
+# WARNING: deletes every player, match and tournament in the database.
+#
+
+import argparse
+import json
+import platform
+import random
+import sys
+import timeit
+
+import monitor
+import tournament
+
+
+OPERATIONS = ('registerPlayer', 'reportMatch', 'playerStandings',
+              'swissPairings')
+
+
+class Recorder(object):
+    """Collects the latency and query count of each timed call."""
+
+    def __init__(self):
+        self.monitor = monitor.Monitor(slow=None)
+        self.times = dict((name, []) for name in OPERATIONS)
+        self.counts = dict((name, 0) for name in OPERATIONS)
+
+    def call(self, name, *args, **kwargs):
+        """Calls tournament.<name> and records how long it took."""
+        function = getattr(tournament, name)
+        queries = self.monitor.queries
+        start = timeit.default_timer()
+        result = function(*args, **kwargs)
+        self.times[name].append(timeit.default_timer() - start)
+        self.counts[name] += self.monitor.queries - queries
+        return result
+
+
+
+def percentile(times, p):
+    """Returns the p-th percentile of a sorted list, by nearest rank."""
+    if not times:
+        return None
+    rank = max(int(round(p / 100.0 * len(times))), 1)
+    return times[min(rank, len(times)) - 1]
+
+
+
+def summarize(times, queries):
+    """Returns the statistics of one operation, times in milliseconds."""
+    times = sorted(times)
+    calls = len(times)
+    return {
+        'calls': calls,
+        'queries': queries,
+        'queries_per_call': float(queries) / calls if calls else None,
+        'mean_ms': 1000 * sum(times) / calls if calls else None,
+        'p50_ms': 1000 * percentile(times, 50) if calls else None,
+        'p99_ms': 1000 * percentile(times, 99) if calls else None,
+        'max_ms': 1000 * times[-1] if calls else None,
+    }
+
+
+
+def reset():
+    """Deletes everything, leaving an empty database."""
+    tournament.deleteMatches()
+    tournament.deleteRegisteredPlayers()
+    tournament.deleteTournaments()
+    tournament.deletePlayers()
+
+
+
+def playTournament(numPlayers, rounds, rng):
+    """Registers numPlayers players and plays rounds Swiss rounds.
+
+    Returns:
+      A dict with the statistics of each operation over the whole
+      tournament and the timings of each round.
+    """
+    reset()
+    recorder = Recorder()
+    tournament.setMonitor(recorder.monitor)
+    try:
+        t_id = tournament.createTournament("Benchmark %d" % numPlayers)
+        ids = [recorder.call('registerPlayer', "Player %d" % i)
+               for i in range(numPlayers)]
+        tournament.enterTournamentBulk(t_id, ids)
+
+        perRound = []
+        for round in range(1, rounds + 1):
+            start = dict((name, len(recorder.times[name]))
+                         for name in OPERATIONS)
+            pairs = recorder.call('swissPairings', t_id)
+            for id1, name1, id2, name2 in pairs:
+                draw = rng.random() < 0.1
+                if draw or rng.random() < 0.5:
+                    recorder.call('reportMatch', id1, id2, t_id, draw)
+                else:
+                    recorder.call('reportMatch', id2, id1, t_id)
+            recorder.call('playerStandings', t_id)
+
+            stats = {'round': round}
+            for name in ('swissPairings', 'playerStandings', 'reportMatch'):
+                times = sorted(recorder.times[name][start[name]:])
+                stats[name + '_p50_ms'] = 1000 * percentile(times, 50)
+                stats[name + '_p99_ms'] = 1000 * percentile(times, 99)
+            perRound.append(stats)
+    finally:
+        tournament.setMonitor(None)
+
+    return {
+        'players': numPlayers,
+        'rounds': rounds,
+        'operations': dict((name, summarize(recorder.times[name],
+                                            recorder.counts[name]))
+                           for name in OPERATIONS),
+        'per_round': perRound,
+        'statements': recorder.monitor.report()['statements'],
+        'prepared': recorder.monitor.report()['prepared'],
+    }
+
+
+
+def main(argv):
+    parser = argparse.ArgumentParser(
+        description="Times the tournament.py functions at scale.")
+    parser.add_argument('players', type=int, nargs='*',
+                        default=[64, 1000, 10000, 50000])
+    parser.add_argument('--rounds', type=int, default=15)
+    parser.add_argument('--memory', action='store_true',
+                        help="run on the in-memory backend")
+    parser.add_argument('--output', default='-',
+                        help="file the JSON results are written to")
+    parser.add_argument('--seed', type=int, default=2016)
+    args = parser.parse_args(argv[1:])
+
+    if args.memory:
+        import memory
+        tournament.setBackend(memory.MemoryBackend())
+    rng = random.Random(args.seed)
+
+    results = []
+    sys.stderr.write("%8s %-16s %8s %8s %10s %10s\n" % (
+        "players", "operation", "calls", "q/call", "p50 ms", "p99 ms"))
+    for numPlayers in args.players:
+        result = playTournament(numPlayers, args.rounds, rng)
+        results.append(result)
+        for name in OPERATIONS:
+            stats = result['operations'][name]
+            sys.stderr.write("%8d %-16s %8d %8.2f %10.3f %10.3f\n" % (
+                numPlayers, name, stats['calls'], stats['queries_per_call'],
+                stats['p50_ms'], stats['p99_ms']))
+
+    report = {
+        'backend': 'memory' if args.memory else 'postgresql',
+        'python': platform.python_version(),
+        'seed': args.seed,
+        'results': results,
+    }
+    if args.output == '-':
+        json.dump(report, sys.stdout, indent=2, sort_keys=True)
+        sys.stdout.write("\n")
+    else:
+        with open(args.output, 'w') as output:
+            json.dump(report, output, indent=2, sort_keys=True)
+
+
+if __name__ == '__main__':
+    main(sys.argv)
@@ -3,6 +3,26 @@
 # Test cases for tournament.py
 
 from tournament import *
+import io
+import logging
+import struct
+import cache
+import export
+import monitor
+import pairing
+import simulate
+import tournament
+
+
+def skippedOnBackend(number, needs):
+    """Prints that a test is skipped and returns True when the functions
+    run on another backend than PostgreSQL."""
+    if tournament._backend is None:
+        return False
+    print "%d. Skipped, %s needs PostgreSQL, not %s." % (
+        number, needs, type(tournament._backend).__name__)
+    return True
+
 
 def testDeleteMatches():
     deleteMatches()
@@ -125,6 +145,605 @@ def testPairings():
     print "8. After one match, players with one win are paired."
 
 
+def testAdvanceRound():
+    deleteMatches()
+    deleteRegisteredPlayers()
+    deleteTournaments()
+    deletePlayers()
+    t_id = createTournament("Odd Open")
+    ids = [registerPlayer(name) for name in
+           ["Rarity", "Spike", "Big Mac", "Zecora", "Discord"]]
+    for p_id in ids:
+        enterTournament(t_id, p_id)
+    pairings = advanceRound(t_id)
+    if len(pairings) != 2:
+        raise ValueError(
+            "For five players, advanceRound should return two pairs.")
+    paired = set([p for (id1, n1, id2, n2) in pairings for p in (id1, id2)])
+    [bye1] = [p for p in ids if p not in paired]
+    for (id1, n1, id2, n2) in pairings:
+        reportMatch(id1, id2, t_id)
+    pairings = advanceRound(t_id)
+    paired = set([p for (id1, n1, id2, n2) in pairings for p in (id1, id2)])
+    [bye2] = [p for p in ids if p not in paired]
+    if bye1 == bye2:
+        raise ValueError("A player should not be given a second bye.")
+    for row in playerStandings(t_id):
+        if row[1] in (bye1, bye2) and row[8] != 1:
+            raise ValueError("A bye should be recorded in the standings.")
+    print "9. advanceRound gives one bye per player and pairs the rest."
+
+
+def testReportMatchesBatch():
+    deleteMatches()
+    deleteRegisteredPlayers()
+    deleteTournaments()
+    deletePlayers()
+    t_id = createTournament("Batch Cup")
+    ids = [registerPlayer(name) for name in
+           ["Starlight", "Trixie", "Gilda", "Sunburst"]]
+    for p_id in ids:
+        enterTournament(t_id, p_id)
+    pairings = advanceRound(t_id)
+    [(a, n1, b, n2), (c, n3, d, n4)] = pairings
+    for results in ([(a, b), (a, d)], [(a, c), (b, d)]):
+        try:
+            reportMatches(t_id, results)
+        except ValueError:
+            pass
+        else:
+            raise ValueError("reportMatches should reject duplicate or "
+                             "unpaired players.")
+    if checkMatches(t_id) != 0:
+        raise ValueError("A rejected batch should not record any match.")
+    reportMatches(t_id, [(a, b), (c, d, True)])
+    for row in playerStandings(t_id):
+        if row[5] != 1:
+            raise ValueError("Each player should have one match recorded.")
+        if row[1] == a and row[3] != 1 or row[1] == b and row[3] != 0:
+            raise ValueError("Each match winner should have one win recorded.")
+        if row[1] in (c, d) and row[4] != 1:
+            raise ValueError("Both players of a draw should have one draw.")
+    print "10. reportMatches records a round and rejects invalid results."
+
+
+def testBulkRegistration():
+    deleteMatches()
+    deleteRegisteredPlayers()
+    deleteTournaments()
+    deletePlayers()
+    t_id = createTournament("Open Event")
+    names = ["Player %d" % i for i in range(100)]
+    ids = registerPlayers(names)
+    if len(ids) != 100 or countPlayers() != 100:
+        raise ValueError("registerPlayers should register every player.")
+    standings = dict((row[0], row[1]) for row in playerStandings())
+    if [standings[p_id] for p_id in ids] != names:
+        raise ValueError("registerPlayers should return ids in name order.")
+    entered = enterTournamentBulk(t_id, ids[:60] + ids[:10])
+    entered += enterTournamentBulk(t_id, ids)
+    if sorted(entered) != sorted(ids) or countTournamentPlayers(t_id) != 100:
+        raise ValueError(
+            "enterTournamentBulk should register each player only once.")
+    print "11. Players can be registered and entered in bulk."
+
+
+def testNoRematches():
+    deleteMatches()
+    deleteRegisteredPlayers()
+    deleteTournaments()
+    deletePlayers()
+    for name in ["Sunset Shimmer", "Maud Pie", "Cheerilee", "Derpy"]:
+        registerPlayer(name)
+    played = set()
+    for round in range(3):
+        for (id1, name1, id2, name2) in swissPairings():
+            if frozenset([id1, id2]) in played:
+                raise ValueError("swissPairings should not pair a rematch "
+                                 "while other opponents are left.")
+            played.add(frozenset([id1, id2]))
+            reportMatch(id1, id2)
+    print "12. After three rounds of four players, nobody has played twice."
+
+
+def testRebuildStandings():
+    deleteMatches()
+    deleteRegisteredPlayers()
+    deleteTournaments()
+    deletePlayers()
+    t_id = createTournament("Rebuild Classic")
+    ids = registerPlayers(["Player %d" % i for i in range(9)])
+    enterTournamentBulk(t_id, ids)
+    for round in range(3):
+        pairings = advanceRound(t_id)
+        reportMatches(t_id, [(id1, id2, i % 3 == 0) for i, (id1, n1, id2, n2)
+                             in enumerate(pairings)])
+    standings = playerStandings(t_id)
+    rebuildStandings(t_id)
+    if playerStandings(t_id) != standings:
+        raise ValueError("rebuildStandings should reproduce the standings "
+                         "kept up to date by reportMatches.")
+    print "13. Rebuilding the standings from the matches gives the same result."
+
+
+def testSimulate():
+    deleteMatches()
+    deleteRegisteredPlayers()
+    deleteTournaments()
+    deletePlayers()
+    t_id = createTournament("Forecast Classic")
+    ids = registerPlayers(["Player %d" % i for i in range(11)])
+    enterTournamentBulk(t_id, ids)
+    pairings = advanceRound(t_id)
+    reportMatches(t_id, [(id1, id2) for (id1, n1, id2, n2) in pairings])
+    ratings = dict((p_id, 1400 + 20 * i) for i, p_id in enumerate(ids))
+    forecast = simulate.simulate(t_id, 3, samples=300, top=4,
+                                 ratings=ratings, processes=2, seed=7)
+    if len(forecast) != 11:
+        raise ValueError("Each player should have a forecast.")
+    if abs(sum(row[2] for row in forecast) - 4) > 1e-9:
+        raise ValueError("Exactly four players should finish in the top 4.")
+    if forecast != simulate.simulate(t_id, 3, samples=300, top=4,
+                                     ratings=ratings, processes=1, seed=7):
+        raise ValueError("The same seed should give the same forecast.")
+    if len(playerStandings(t_id)) != 11 or checkMatches(t_id) != 1:
+        raise ValueError("Simulating shouldn't change the tournament.")
+    print "14. Simulations are reproducible and leave the tournament unchanged."
+
+
+def testRatings():
+    deleteMatches()
+    deleteRegisteredPlayers()
+    deleteTournaments()
+    deletePlayers()
+    ids = registerPlayers(["Ann", "Bob", "Cid", "Dee", "Eve"])
+    [a, b, c, d, e] = ids
+    reportMatch(a, b)
+    reportMatch(c, d, draw=True)
+    ratings = dict((row[0], row[2:]) for row in playerRatings())
+    if ratings[a] != (1516, 1) or ratings[b] != (1484, 1):
+        raise ValueError("A win between equally rated players should move "
+                         "16 points.")
+    if ratings[c] != (1500, 1) or ratings[e] != (1500, 0):
+        raise ValueError("A draw between equally rated players shouldn't "
+                         "change their ratings.")
+
+    t_id = createTournament("Seeded Classic")
+    enterTournamentBulk(t_id, ids)
+    reportMatches(t_id, [(e, c)])
+    if [row[0] for row in playerRatings(t_id)] != [a, e, d, b, c]:
+        raise ValueError("playerRatings should list the players of a "
+                         "tournament by rating.")
+    deleteMatches()
+    reportMatch(a, b)
+    reportMatch(e, c)
+    reportMatch(e, d)
+    pairs = startRound(t_id, by_rating=True)
+    if set((p[0], p[2]) for p in pairs) != set([(e, d), (a, b)]):
+        raise ValueError("A rating seeded first round should pair the top "
+                         "half against the bottom half.")
+    if not checkBye(t_id, c):
+        raise ValueError("The lowest rated player should get the bye.")
+    print "15. Ratings are updated with each match and can seed a round."
+
+
+def testMonitor():
+    if skippedOnBackend(16, "counting statements"):
+        return
+    deleteMatches()
+    deleteRegisteredPlayers()
+    deleteTournaments()
+    deletePlayers()
+    records = []
+    handler = logging.Handler()
+    handler.emit = records.append
+    log = logging.getLogger('tournament.test')
+    log.addHandler(handler)
+    watch = monitor.Monitor(slow=0, log=log)
+    setMonitor(watch)
+    try:
+        registerPlayers(["Ann", "Bob", "Cid"])
+        swissPairings()
+        list(iterStandings(chunk=1))
+        # Closed after one row, its clean-up counts too
+        rows = iterStandings(chunk=1)
+        next(rows)
+        rows.close()
+    finally:
+        setMonitor(None)
+        log.removeHandler(handler)
+    countPlayers()
+    calls = watch.report()['calls']
+    if calls['swissPairings']['count'] != 1 or 'countPlayers' in calls or \
+            calls['iterStandings']['count'] != 2:
+        raise ValueError("Each call made while monitored should be counted.")
+    statements = watch.report()['statements']
+    if sum(s['count'] for s in statements.values()) != watch.queries or \
+            calls['registerPlayers']['queries'] + \
+            calls['swissPairings']['queries'] + \
+            calls['iterStandings']['queries'] != watch.queries:
+        raise ValueError("Every statement should be counted once, and "
+                         "against the call that ran it.")
+    if len(records) != watch.queries:
+        raise ValueError("With slow=0 every statement should be logged.")
+    print "16. The monitor records every statement and call."
+
+
+def testDeleteTournament():
+    deleteMatches()
+    deleteRegisteredPlayers()
+    deleteTournaments()
+    deletePlayers()
+    ids = registerPlayers(["Ann", "Bob", "Cid", "Dee", "Eve", "Fay"])
+    [a, b, c, d, e, f] = ids
+    t1 = createTournament("Spring Open")
+    t2 = createTournament("Summer Open")
+    enterTournamentBulk(t1, [a, b, c, d])
+    enterTournamentBulk(t2, [c, d, e])
+    reportMatches(t1, [(a, b), (c, d)])
+    reportMatches(t2, [(c, e)])
+    kept = playerStandings(t2)
+
+    deleteTournament(t1)
+    if playerStandings(t1) or countTournamentPlayers(t1) or \
+            tournamentMatches(t1):
+        raise ValueError("A deleted tournament should leave nothing behind.")
+    if playerStandings(t2) != kept or tournamentMatches(t2) != [(c, e, False)]:
+        raise ValueError("Deleting a tournament shouldn't change the others.")
+    if set(row[0] for row in playerStandings()) != set(ids):
+        raise ValueError("Players of a deleted tournament should still be "
+                         "listed.")
+
+    archiveTournament(t2)
+    if playerStandings(t2) or tournamentMatches(t2):
+        raise ValueError("An archived tournament should leave the live "
+                         "tables.")
+    if set(row[0] for row in playerStandings()) != set(ids):
+        raise ValueError("Players of an archived tournament should still be "
+                         "listed.")
+    deleteTournaments()
+    deletePlayers()
+    print "17. Tournaments can be deleted and archived one at a time."
+
+
+def testStandingsCache():
+    if skippedOnBackend(18, "the standings cache"):
+        return
+    deleteMatches()
+    deleteRegisteredPlayers()
+    deleteTournaments()
+    deletePlayers()
+    [a, b, c, d] = registerPlayers(["Ann", "Bob", "Cid", "Dee"])
+    t_id = createTournament("Cached Classic")
+    watch = monitor.Monitor(slow=None)
+    setCache(cache.StandingsCache())
+    setMonitor(watch)
+    try:
+        enterTournamentBulk(t_id, [a, b, c, d])
+        first = playerStandings(t_id)
+        expected = list(first)
+        # Changing a result mustn't change what later reads get
+        first.reverse()
+        queries = watch.queries
+        if playerStandings(t_id) != expected or checkMatches(t_id) != 0 or \
+                checkBye(t_id, a) or watch.queries != queries:
+            raise ValueError("Repeated standings reads should be served from "
+                             "the cache.")
+        reportMatch(a, b, t_id)
+        if playerStandings(t_id)[0][1] != a:
+            raise ValueError("Reporting a match should invalidate the cached "
+                             "standings.")
+        with transaction():
+            reportMatch(c, d, t_id)
+        if checkMatches(t_id) != 1 or \
+                [row[1] for row in playerStandings(t_id)][:2] != [c, a]:
+            raise ValueError("A committed transaction should invalidate the "
+                             "cached standings.")
+    finally:
+        setMonitor(None)
+        setCache(None)
+    print "18. Standings are cached until a result changes them."
+
+
+def testStandingsPages():
+    deleteMatches()
+    deleteRegisteredPlayers()
+    deleteTournaments()
+    deletePlayers()
+    ids = registerPlayers(["Player %d" % i for i in range(7)])
+    t_id = createTournament("Paged Classic")
+    enterTournamentBulk(t_id, ids[:6])
+    reportMatches(t_id, [(ids[0], ids[1]), (ids[2], ids[3], True),
+                         (ids[5], ids[4])])
+    if list(iterStandings(t_id, chunk=2)) != playerStandings(t_id) or \
+            list(iterStandings(chunk=4)) != playerStandings():
+        raise ValueError("iterStandings should yield the rows of "
+                         "playerStandings.")
+    pages = [playerStandingsPage(t_id, limit=4)]
+    while pages[-1]:
+        pages.append(playerStandingsPage(t_id, pages[-1][-1][1], 4))
+    if [len(page) for page in pages] != [4, 2, 0] or \
+            sum(pages, []) != playerStandings(t_id):
+        raise ValueError("Pages should follow each other through the "
+                         "standings.")
+    print "19. Standings can be streamed and read a page at a time."
+
+
+def testRoundSnapshots():
+    deleteMatches()
+    deleteRegisteredPlayers()
+    deleteTournaments()
+    deletePlayers()
+    ids = registerPlayers(["Ann", "Bob", "Cid", "Dee", "Eve"])
+    t_id = createTournament("Snapshot Classic")
+    enterTournamentBulk(t_id, ids)
+    history = []
+    for round in range(3):
+        pairs = advanceRound(t_id)
+        reportMatches(t_id, [(id1, id2) for (id1, name1, id2, name2) in pairs])
+        history.append(playerStandings(t_id))
+    if standingsAt(t_id, 3) != []:
+        raise ValueError("The last round shouldn't be closed before "
+                         "closeRound.")
+    if closeRound(t_id) != 3:
+        raise ValueError("closeRound should close the last round paired.")
+    if [standingsAt(t_id, round) for round in (1, 2, 3)] != history:
+        raise ValueError("standingsAt should return the standings at the end "
+                         "of each round.")
+    restoreRound(t_id, 1)
+    if playerStandings(t_id) != history[0] or standingsAt(t_id, 2) != [] or \
+            len(tournamentMatches(t_id)) != 3:
+        raise ValueError("Restoring a round should undo the later rounds.")
+    pairs = advanceRound(t_id)
+    if len(pairs) != 2 or standingsAt(t_id, 1) != history[0]:
+        raise ValueError("Play should continue from a restored round.")
+    print "20. Round snapshots keep past standings and can be restored."
+
+
+def testExportImport():
+    deleteMatches()
+    deleteRegisteredPlayers()
+    deleteTournaments()
+    deletePlayers()
+    ids = registerPlayers(["Ann", "Bob", "Cid", "Dee", "Eve"])
+    t_id = createTournament("Exported Classic")
+    enterTournamentBulk(t_id, ids)
+    for round in range(3):
+        pairs = advanceRound(t_id)
+        reportMatches(t_id, [(id1, id2, round == 1)
+                             for (id1, name1, id2, name2) in pairs])
+    data = exportTournament(t_id)
+    copy = importTournament(data)
+    if [row[2:] for row in playerStandings(copy)] != \
+            [row[2:] for row in playerStandings(t_id)] or \
+            [row[1:] for row in playerRatings(copy)] != \
+            [row[1:] for row in playerRatings(t_id)]:
+        raise ValueError("An imported tournament should have the standings "
+                         "and ratings of the exported one.")
+    if countPlayers() != 10 or len(tournamentMatches(copy)) != 9:
+        raise ValueError("Importing should register new players and insert "
+                         "every match.")
+    # A matches section with a byte too many, under a valid CRC
+    padded = io.BytesIO()
+    padded.write(struct.pack('<4sHH', export.MAGIC, export.VERSION, 0))
+    export._writeSection(padded, 'NAME', 0, export._packString("Padded"))
+    export._writeSection(padded, 'PLYR', 0)
+    export._writeSection(padded, 'MTCH', 0, '\0')
+    export._writeSection(padded, 'END.', 0)
+    for damaged in (data[:-3], data[:40] + chr(ord(data[40]) ^ 1) + data[41:],
+                    data[:4] + struct.pack('<H', 1) + data[6:],
+                    padded.getvalue()):
+        try:
+            importTournament(damaged)
+        except ValueError:
+            pass
+        else:
+            raise ValueError("Damaged or old data should be rejected.")
+    print "21. Tournaments can be exported and imported."
+
+
+def testPreparedStatements():
+    if skippedOnBackend(22, "preparing statements"):
+        return
+    deleteMatches()
+    deleteRegisteredPlayers()
+    deleteTournaments()
+    deletePlayers()
+    [a, b, c, d] = registerPlayers(["Ann", "Bob", "Cid", "Dee"])
+    t_id = createTournament("Prepared Open")
+    enterTournamentBulk(t_id, [a, b, c, d])
+    watch = monitor.Monitor(slow=None)
+    setMonitor(watch)
+    try:
+        for i in range(3):
+            playerStandings(t_id)
+        reportMatch(a, b, t_id)
+        reportMatch(c, d, t_id, True)
+        standings = playerStandings(t_id)
+    finally:
+        setMonitor(None)
+    if [row[1] for row in standings][:1] != [a] or checkMatches(t_id) != 1 \
+            or checkBye(t_id, a):
+        raise ValueError("Prepared statements should return what the "
+                         "queries did.")
+    prepared = watch.report()['prepared']
+    if watch.queries and (prepared['standings']['hits'] +
+                          prepared['standings']['misses'] != 4 or
+                          prepared['standings']['hits'] < 3 or
+                          prepared['match_insert']['hits'] < 1):
+        raise ValueError("Each connection should prepare a statement once "
+                         "and then reuse it.")
+    print "22. Hot statements are prepared once per connection."
+
+
+def testOpponentIndex():
+    deleteMatches()
+    deleteRegisteredPlayers()
+    deleteTournaments()
+    deletePlayers()
+    [a, b, c, d, e] = registerPlayers(["Ann", "Bob", "Cid", "Dee", "Eve"])
+    t_id = createTournament("Indexed Invitational")
+    enterTournamentBulk(t_id, [a, b, c, d, e])
+    if hasPlayed(t_id, a, b) or opponentsOf(t_id, a) or hasBye(t_id, a):
+        raise ValueError("Nobody should have played before the first round.")
+    reportMatches(t_id, [(a, b), (c, d, True), (e, None)])
+    if not hasPlayed(t_id, a, b) or not hasPlayed(t_id, d, c) or \
+            hasPlayed(t_id, a, c) or opponentsOf(t_id, c) != set([d]):
+        raise ValueError("Reported matches should be in the opponent index.")
+    if not hasBye(t_id, e) or not checkBye(t_id, e) or hasBye(t_id, a) or \
+            opponentsOf(t_id, e):
+        raise ValueError("A bye should be recorded without an opponent.")
+    with transaction():
+        reportMatch(a, c, t_id)
+    if opponentsOf(t_id, a) != set([b, c]):
+        raise ValueError("Matches reported in a transaction should be "
+                         "indexed once it commits.")
+    for id1, name1, id2, name2 in swissPairings(t_id):
+        if hasPlayed(t_id, id1, id2):
+            raise ValueError("Pairings should avoid rematches.")
+    deleteMatches()
+    if hasPlayed(t_id, a, b) or hasBye(t_id, e):
+        raise ValueError("Deleted matches should leave the opponent index.")
+    print "23. Opponents and byes are looked up from an index."
+
+
+def testLateRoundPairing():
+    # Four rounds into an eight player event, pairing each score group in
+    # turn leaves Ann and Cid, who have met, at the bottom, and swapping them
+    # into a single pair above doesn't help. A round without rematches still
+    # exists.
+    [ann, bob, cid, dee, eve, fay, gus, hal] = range(1, 9)
+    players = [(dee, 3), (eve, 3), (fay, 3), (bob, 2), (gus, 2), (hal, 2),
+               (ann, 1), (cid, 0)]
+    matches = [(ann, bob), (ann, cid), (ann, eve), (ann, hal), (bob, dee),
+               (bob, fay), (bob, gus), (cid, dee), (cid, gus), (cid, hal),
+               (dee, eve), (dee, fay), (eve, fay), (eve, hal), (fay, gus),
+               (gus, hal)]
+    played, byes = pairing.buildHistory(matches)
+    pairs = pairing.pairPlayers(players, played)
+    if sorted(p for pair in pairs for p in pair) != range(1, 9):
+        raise ValueError("Each player should be paired exactly once.")
+    for id1, id2 in pairs:
+        if id2 in played[id1]:
+            raise ValueError("pairPlayers should find a round without "
+                             "rematches when one exists.")
+    print "24. Late rounds are paired without rematches when possible."
+
+
+def testLargeRoundStandings():
+    deleteMatches()
+    deleteRegisteredPlayers()
+    deleteTournaments()
+    deletePlayers()
+    ids = registerPlayers(["Player %d" % i
+                           for i in range(2 * TIEBREAK_BATCH + 1)])
+    batched = createTournament("Batched Open")
+    single = createTournament("Single Open")
+    enterTournamentBulk(batched, ids)
+    enterTournamentBulk(single, ids)
+    for round in range(3):
+        pairings = advanceRound(batched)
+        results = [(id1, id2, i % 5 == 0) for i, (id1, n1, id2, n2)
+                   in enumerate(pairings)]
+        reportMatches(batched, results)
+        paired = set([p for (id1, id2, draw) in results for p in (id1, id2)])
+        for p_id in set(ids) - paired:
+            reportMatch(p_id, None, single)
+        for (id1, id2, draw) in results:
+            reportMatch(id1, id2, single, draw)
+    if [row[1:] for row in playerStandings(batched)] != \
+            [row[1:] for row in playerStandings(single)]:
+        raise ValueError("Standings of a round reported as one batch should "
+                         "match those of its matches reported one by one.")
+    print "25. Large rounds give the same standings as single matches."
+
+
+def testStartRound():
+    deleteMatches()
+    deleteRegisteredPlayers()
+    deleteTournaments()
+    deletePlayers()
+    players = registerPlayers(["Ann", "Bob", "Cid", "Dee", "Eve"])
+    t_id = createTournament("Preview Open")
+    enterTournamentBulk(t_id, players)
+    preview = swissPairings(t_id)
+    if swissPairings(t_id) != preview or tournamentMatches(t_id) or \
+            any(checkBye(t_id, p_id) for p_id in players):
+        raise ValueError("swissPairings shouldn't change anything.")
+    pairs = startRound(t_id)
+    if pairs != preview:
+        raise ValueError("startRound should pair like swissPairings.")
+    if [p_id for p_id in players if checkBye(t_id, p_id)] != \
+            [p_id for (p_id, loser, draw) in tournamentMatches(t_id)]:
+        raise ValueError("startRound should record one bye.")
+    [(id1, n1, id2, n2), (id3, n3, id4, n4)] = pairs
+    try:
+        reportMatches(t_id, [(id1, id3)])
+    except ValueError:
+        pass
+    else:
+        raise ValueError("Results should follow the round startRound "
+                         "recorded.")
+    reportMatches(t_id, [(id1, id2), (id3, id4)])
+    if closeRound(t_id) != 1:
+        raise ValueError("Only startRound should record a round.")
+    try:
+        startRound(t_id + 1)
+    except ValueError:
+        pass
+    else:
+        raise ValueError("startRound should reject an unknown tournament.")
+    if checkBye(None, id1) or checkBye(t_id + 1, id1):
+        raise ValueError("checkBye should be False outside a tournament.")
+    print "26. swissPairings previews a round and startRound records it."
+
+
+def testExportNames():
+    deleteMatches()
+    deleteRegisteredPlayers()
+    deleteTournaments()
+    deletePlayers()
+    names = ["Zo\xc3\xab \xc3\x96sterberg", "L" + "o" * 70000 + "ng", None,
+             "Ann"]
+    ids = registerPlayers(names)
+    t_id = createTournament("T\xc3\xa1bl\xc3\xa1s " + "Open " * 20000)
+    enterTournamentBulk(t_id, ids)
+    reportMatches(t_id, [(ids[0], ids[1]), (ids[2], ids[3], True)])
+    copy = importTournament(exportTournament(t_id))
+    if [row[2:] for row in playerStandings(copy)] != \
+            [row[2:] for row in playerStandings(t_id)] or \
+            sorted(row[1] for row in playerRatings(copy)) != \
+            sorted(names):
+        raise ValueError("Long, non-ASCII and missing names should survive "
+                         "an export and import unchanged.")
+    print "27. Exported names of any length and script are kept intact."
+
+
+def testAdvanceRoundRematches():
+    deleteMatches()
+    deleteRegisteredPlayers()
+    deleteTournaments()
+    deletePlayers()
+    ids = registerPlayers(["Ann", "Bob", "Cid", "Dee"])
+    t_id = createTournament("Adjacent Open")
+    enterTournamentBulk(t_id, ids)
+    first = advanceRound(t_id)
+    reportMatches(t_id, [(id1, id2) for (id1, n1, id2, n2) in first])
+    second = advanceRound(t_id)
+    reportMatches(t_id, [(id1, id2) for (id1, n1, id2, n2) in second])
+    # The leaders of the first round lead again and meet their first round
+    # opponents, the only pairs left are the ones swissPairings() gives
+    for (id1, n1, id2, n2) in swissPairings(t_id):
+        if hasPlayed(t_id, id1, id2):
+            raise ValueError("swissPairings should avoid the rematches "
+                             "advanceRound pairs.")
+    third = advanceRound(t_id)
+    if set(third) != set(first):
+        raise ValueError("advanceRound should pair adjacent standings, "
+                         "rematches included, not %s." % third)
+    print "28. advanceRound pairs adjacent standings, rematches included."
+
+
 if __name__ == '__main__':
     testDeleteMatches()
     testDelete()
@@ -134,4 +753,24 @@ if __name__ == '__main__':
     testStandingsBeforeMatches()
     testReportMatches()
     testPairings()
+    testAdvanceRound()
+    testReportMatchesBatch()
+    testBulkRegistration()
+    testNoRematches()
+    testRebuildStandings()
+    testSimulate()
+    testRatings()
+    testMonitor()
+    testDeleteTournament()
+    testStandingsCache()
+    testStandingsPages()
+    testRoundSnapshots()
+    testExportImport()
+    testPreparedStatements()
+    testOpponentIndex()
+    testLateRoundPairing()
+    testLargeRoundStandings()
+    testStartRound()
+    testExportNames()
+    testAdvanceRoundRematches()
     print "Success!  All tests pass!"
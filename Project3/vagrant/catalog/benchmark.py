@@ -0,0 +1,67 @@
+#!/usr/bin/env python
+#
+# benchmark.py -- requests per second of the catalog with worker threads
+#
+# Sends GET requests for the index, a user's profile and the JSON and XML
+# feeds straight to the Flask app from a number of threads, like a
+# multi-threaded mod_wsgi process, and prints the requests per second for
+# each thread count. Every thread uses the scoped session of its own
+# requests and the engine's connection pool.
+#
+# Usage: python benchmark.py [seconds] [threads ...]
+#
+
+import sys
+import threading
+import timeit
+
+from project import app, engine, session
+from database_setup import User, initDatabase
+
+
+def worker(paths, seconds, counts, errors):
+	''' Requests paths in turn for seconds and counts the responses '''
+	client = app.test_client()
+	done = 0
+	end = timeit.default_timer() + seconds
+	while timeit.default_timer() < end:
+		for path in paths:
+			response = client.get(path)
+			if response.status_code != 200:
+				errors.append((path, response.status_code))
+			done += 1
+	counts.append(done)
+
+
+def run(paths, seconds, threads):
+	''' Returns the requests per second of threads workers '''
+	counts, errors = [], []
+	workers = [threading.Thread(target=worker,
+		args=(paths, seconds, counts, errors)) for i in range(threads)]
+	start = timeit.default_timer()
+	for thread in workers:
+		thread.start()
+	for thread in workers:
+		thread.join()
+	elapsed = timeit.default_timer() - start
+	if errors:
+		raise RuntimeError("%d requests failed, first %r" % (len(errors),
+			errors[0]))
+	return sum(counts) / elapsed
+
+
+if __name__ == '__main__':
+	seconds = float(sys.argv[1]) if len(sys.argv) > 1 else 5
+	threads = [int(arg) for arg in sys.argv[2:]] or [1, 2, 4, 8, 16]
+	app.secret_key = 'benchmark'
+	initDatabase(engine)
+
+	user = session.query(User.id).first()
+	session.remove()
+	paths = ['/', '/JSON/', '/XML/']
+	if user is not None:
+		paths += ['/user/%d/' % user.id, '/user/%d/JSON/' % user.id]
+
+	print "%8s %12s" % ("threads", "requests/s")
+	for count in threads:
+		print "%8d %12.1f" % (count, run(paths, seconds, count))
@@ -1,14 +1,15 @@
-from sqlalchemy import create_engine
 from sqlalchemy.orm import sessionmaker
  
-from database_setup import Base, User, Goal, Comments
+from database_setup import Base, User, Goal, Comments, createEngine, \
+                           initDatabase
 #from flask.ext.sqlalchemy import SQLAlchemy
 from random import randint
 import datetime
 import random
 
 
-engine = create_engine('sqlite:///mygoals.db')
+engine = createEngine()
+initDatabase(engine)
 
 Base.metadata.bind = engine
  
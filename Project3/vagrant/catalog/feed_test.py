@@ -0,0 +1,156 @@
+#!/usr/bin/env python
+#
+# Test cases for the JSON and XML feeds of project.py
+#
+# Runs on a new SQLite database in a temporary directory, or on the one
+# MYGOALS_DATABASE_URL names. WARNING: every user, goal and comment in that
+# one is deleted.
+#
+
+import datetime
+import json
+import os
+import shutil
+import tempfile
+import xml.dom.minidom
+
+directory = tempfile.mkdtemp()
+os.environ.setdefault('MYGOALS_DATABASE_URL',
+                      'sqlite:///' + os.path.join(directory, 'feed_test.db'))
+
+from sqlalchemy import String, bindparam
+
+from project import app, engine, session
+from database_setup import User, Goal, Comments, initDatabase
+
+
+def reset():
+    ''' Empties the database and returns the id of a new user '''
+    initDatabase(engine)
+    session.query(Comments).delete()
+    session.query(Goal).delete()
+    session.query(User).delete()
+    user = User(username="Feed Tester", email="feed@example.com")
+    session.add(user)
+    session.commit()
+    user_id = user.id
+    session.remove()
+    return user_id
+
+
+def addGoals(user_id, timestamps):
+    ''' Adds a goal for each timestamp, stored as given, and returns their
+    ids in the order added '''
+    ids = []
+    for timestamp in timestamps:
+        # Bound as a string, so SQLite stores it like CURRENT_TIMESTAMP
+        # does, without microseconds
+        result = session.execute(Goal.__table__.insert().values(
+            title="Goal", isDone=0, isPrivate=0, user_id=user_id,
+            timestamp=bindparam('timestamp', timestamp, type_=String)))
+        ids.append(result.inserted_primary_key[0])
+    session.commit()
+    session.remove()
+    return ids
+
+
+def jsonPages(client, url):
+    ''' Returns the ids of every goal of a JSON feed, following the next
+    links, and the number of pages '''
+    ids, pages = [], 0
+    while url:
+        pages += 1
+        if pages > 100:
+            raise ValueError("The feed %s doesn't end." % url)
+        response = client.get(url)
+        page = json.loads(response.data)
+        # Gives the streamed response's connection back to the pool
+        response.close()
+        ids += [goal['id'] for goal in page['Goals']]
+        url = page['next']
+    return ids, pages
+
+
+def xmlPages(client, url):
+    ''' Returns the ids of every goal of an XML feed, following the next
+    links '''
+    ids, pages = [], 0
+    while url:
+        pages += 1
+        if pages > 100:
+            raise ValueError("The feed %s doesn't end." % url)
+        response = client.get(url)
+        document = xml.dom.minidom.parseString(response.data)
+        response.close()
+        ids += [int(node.firstChild.data)
+                for node in document.getElementsByTagName('goal_id')]
+        links = document.getElementsByTagName('next')
+        url = links[0].firstChild.data if links else None
+    return ids
+
+
+def checkPages(ids, expected):
+    if len(ids) != len(set(ids)):
+        raise ValueError("Goals %s were returned more than once."
+                         % sorted(set(i for i in ids if ids.count(i) > 1)))
+    if ids != expected:
+        raise ValueError("The feed returned %s, not %s." % (ids, expected))
+
+
+def testSameSecond():
+    user_id = reset()
+    ids = addGoals(user_id, ['2016-01-01 10:00:00'] * 5 +
+                   ['2016-01-01 09:59:59'] * 2)
+    client = app.test_client()
+    # Newest first, goals of the same second by id
+    expected = ids[4::-1] + ids[:4:-1]
+    feed, pages = jsonPages(client, '/JSON/?limit=2')
+    checkPages(feed, expected)
+    if pages != 4:
+        raise ValueError("7 goals should take 4 pages of 2, not %d." % pages)
+    checkPages(xmlPages(client, '/user/%d/XML/?limit=3' % user_id), expected)
+    print "1. Goals stored without microseconds are paged without repeats."
+
+
+def testMicroseconds():
+    user_id = reset()
+    start = datetime.datetime(2016, 1, 1, 10, 0, 0, 250000)
+    session.add(Goal(title="Goal", user_id=user_id, isDone=0, isPrivate=0,
+                     timestamp=start))
+    session.add_all([Goal(title="Goal", user_id=user_id, isDone=0,
+                          isPrivate=0) for i in range(4)])
+    session.commit()
+    ids = [goal.id for goal in session.query(Goal).order_by(
+        Goal.timestamp.desc(), Goal.id.desc())]
+    session.remove()
+    client = app.test_client()
+    for limit in (1, 2, 5):
+        checkPages(jsonPages(client, '/JSON/?limit=%d' % limit)[0], ids)
+    print "2. Goals with microseconds are paged without repeats."
+
+
+def testUndated():
+    user_id = reset()
+    dated = addGoals(user_id, ['2016-01-01 10:00:00', '2016-01-02 10:00:00'])
+    undated = addGoals(user_id, [None] * 3)
+    expected = dated[::-1] + undated[::-1]
+    client = app.test_client()
+    for limit in (1, 2, 3, 4):
+        checkPages(jsonPages(client, '/JSON/?limit=%d' % limit)[0], expected)
+    checkPages(jsonPages(client, '/JSON/export/')[0], expected)
+    if jsonPages(client, '/JSON/?since=2016-01-01')[0] != dated[::-1]:
+        raise ValueError("Goals without a timestamp aren't since any date.")
+    print "3. Goals without a timestamp come last and are paged by id."
+
+
+if __name__ == '__main__':
+    app.secret_key = 'feed_test'
+    try:
+        testSameSecond()
+        testMicroseconds()
+        testUndated()
+    finally:
+        session.remove()
+        engine.dispose()
+        shutil.rmtree(directory)
+    print "Success!  All tests pass!"
@@ -1,17 +1,19 @@
 #Flask Imports
 from flask import Flask, render_template, request, redirect,jsonify, \
-				  url_for, flash, make_response
+				  url_for, flash, make_response, abort, Response, \
+				  stream_with_context
 from flask import session as login_session
 
 #file upload
 from werkzeug import secure_filename
 
 #SQL ALchemy Imports
-from sqlalchemy import create_engine, asc, and_, or_, desc
-from sqlalchemy.orm import sessionmaker
+from sqlalchemy import asc, and_, or_, desc, func
+from sqlalchemy.orm import sessionmaker, scoped_session, aliased
 
 #Database import
-from database_setup import Base, User, Goal, Comments
+from database_setup import Base, User, Goal, Comments, createEngine, \
+			   initDatabase, DATABASE_URL
 
 #Python imports
 import random, string, json, requests, datetime, os, uuid
@@ -41,13 +43,44 @@ app.config['UPLOAD_FOLDER'] = UPLOAD_FOLDER
 app.config['MAX_CONTENT_LENGTH'] = 16 * 1024 * 1024 
 # Config SeaSurf
 csrf = SeaSurf(app)
+# Database, see database_setup.py, and its connection pool: connections
+# kept open, extra connections opened when they are all in use, seconds
+# before a connection is replaced, whether connections are tested before
+# each checkout, and milliseconds before a PostgreSQL statement is cancelled
+app.config['DATABASE_URL'] = DATABASE_URL
+app.config['DB_POOL_SIZE'] = 5
+app.config['DB_MAX_OVERFLOW'] = 10
+app.config['DB_POOL_RECYCLE'] = 3600
+app.config['DB_POOL_PRE_PING'] = True
+app.config['DB_STATEMENT_TIMEOUT'] = 30000
+# Settings file named by MYGOALS_SETTINGS, overriding the ones above
+app.config.from_envvar('MYGOALS_SETTINGS', silent=True)
 
 #Connect to Database and create database session
-engine = create_engine('sqlite:///mygoals.db')
+# Connections are shared between the worker threads through the pool
+engine = createEngine(app.config['DATABASE_URL'],
+	pool_size=app.config['DB_POOL_SIZE'],
+	max_overflow=app.config['DB_MAX_OVERFLOW'],
+	pool_recycle=app.config['DB_POOL_RECYCLE'],
+	pool_pre_ping=app.config['DB_POOL_PRE_PING'],
+	statement_timeout=app.config['DB_STATEMENT_TIMEOUT'])
 Base.metadata.bind = engine
 
 DBSession = sessionmaker(bind=engine)
-session = DBSession()
+# Every thread gets a session of its own, which is removed at the end of
+# each request, see removeSession()
+session = scoped_session(DBSession)
+
+@app.before_first_request
+def createTables():
+	''' Creates the tables missing from the configured database '''
+	initDatabase(engine)
+
+@app.teardown_appcontext
+def removeSession(exception=None):
+	''' Closes the request's session, rolling back anything it didn't
+	commit, and returns its connection to the pool '''
+	session.remove()
 
 # Local permission system methods
 def createUser(login_session):
@@ -72,6 +105,158 @@ def getUserInfo(user_id):
   user = session.query(User).filter_by(id = user_id).one()
   return user
 
+# Goals in a page of the JSON and XML feeds, ?limit= can ask for up to
+# FEED_MAX_LIMIT
+FEED_LIMIT = 100
+FEED_MAX_LIMIT = 1000
+# Goals read from the database and written to a feed at a time
+FEED_CHUNK = 500
+# Format of the timestamp in a feed cursor
+CURSOR_FORMAT = '%Y-%m-%dT%H:%M:%S.%f'
+
+def feedFlag(value):
+	''' Reads a 0 or 1 feed filter '''
+	if value not in ('0', '1'):
+		raise ValueError(value)
+	return int(value)
+
+class FeedPage(object):
+	''' The goals a feed request asks for, newest first, read from the
+	database FEED_CHUNK at a time as they are iterated.
+
+	Goals are paged by (timestamp, id): after is the cursor of the last
+	goal of the previous page, so a page costs the same however deep it
+	is. Goals without a timestamp come after the others, by id, and their
+	cursors have no timestamp. They can be filtered by user, isDone and
+	isPrivate (0 or 1) and by since and until dates (YYYY-MM-DD, both
+	included). A malformed argument gets a 400 response. With paged False
+	every goal is read.
+
+	Once the goals have all been iterated, nextPage is the url of the next
+	page, None if there is none. '''
+
+	def __init__(self, user_id = None, paged = True):
+		args = request.args
+		query = session.query(Goal)
+		self.limit = None
+		try:
+			if paged:
+				self.limit = int(args.get('limit', FEED_LIMIT))
+				if self.limit < 1:
+					raise ValueError(self.limit)
+				self.limit = min(self.limit, FEED_MAX_LIMIT)
+			if user_id is None and 'user' in args:
+				user_id = int(args['user'])
+			if user_id is not None:
+				query = query.filter(Goal.user_id == user_id)
+			if 'isDone' in args:
+				query = query.filter(Goal.isDone == feedFlag(args['isDone']))
+			if 'isPrivate' in args:
+				query = query.filter(
+					Goal.isPrivate == feedFlag(args['isPrivate']))
+			if 'since' in args:
+				since = datetime.datetime.strptime(args['since'], '%Y-%m-%d')
+				query = query.filter(Goal.timestamp >= since)
+			if 'until' in args:
+				until = datetime.datetime.strptime(args['until'], '%Y-%m-%d')
+				query = query.filter(
+					Goal.timestamp < until + datetime.timedelta(days = 1))
+			dated = query.filter(Goal.timestamp != None)
+			undated = query.filter(Goal.timestamp == None)
+			if 'after' in args:
+				timestamp, goal_id = args['after'].rsplit('_', 1)
+				goal_id = int(goal_id)
+				if timestamp:
+					timestamp = datetime.datetime.strptime(timestamp,
+						CURSOR_FORMAT)
+					# The goal's timestamp as stored, which compares with
+					# the others the way the feed is ordered whatever its
+					# precision. The cursor's only if the goal is gone.
+					anchor = aliased(Goal)
+					timestamp = func.coalesce(
+						session.query(anchor.timestamp)
+							.filter(anchor.id == goal_id).as_scalar(),
+						timestamp)
+					dated = dated.filter(or_(Goal.timestamp < timestamp,
+						and_(Goal.timestamp == timestamp,
+							Goal.id < goal_id)))
+				else:
+					dated = None
+					undated = undated.filter(Goal.id < goal_id)
+		except ValueError:
+			abort(400)
+
+		# Goals without a timestamp come last, newest id first
+		self.queries = []
+		if dated is not None:
+			self.queries.append(
+				dated.order_by(desc(Goal.timestamp), desc(Goal.id)))
+		self.queries.append(undated.order_by(desc(Goal.id)))
+		for i, query in enumerate(self.queries):
+			if self.limit is not None:
+				# One goal more than the page tells whether there is a next
+				# page
+				query = query.limit(self.limit + 1)
+			# stream_results keeps a PostgreSQL cursor on the server
+			self.queries[i] = query.execution_options(stream_results = True) \
+								   .yield_per(FEED_CHUNK)
+		self.endpoint = request.endpoint
+		self.args = dict(request.view_args)
+		self.args.update(args.items())
+		self.nextPage = None
+
+	def __iter__(self):
+		count = 0
+		last = None
+		for query in self.queries:
+			# The session of the request may have been removed by the time
+			# a streamed page is read, the stream's own is removed after it
+			goals = iter(query.with_session(session()))
+			try:
+				for goal in goals:
+					count += 1
+					if self.limit is not None and count > self.limit:
+						timestamp = ''
+						if last.timestamp is not None:
+							timestamp = last.timestamp.strftime(CURSOR_FORMAT)
+						self.args['after'] = '%s_%d' % (timestamp, last.id)
+						self.nextPage = url_for(self.endpoint,
+							_external = True, **self.args)
+						return
+					last = goal
+					yield goal
+			finally:
+				# A page that stops early closes its cursor now, not when
+				# the results are garbage collected
+				goals.close()
+
+def feedJSON(page):
+	''' Streams the goals of a feed page as JSON, a chunk at a time '''
+	def generate():
+		separator = ''
+		chunk = []
+		yield '{"Goals": ['
+		for goal in page:
+			chunk.append(json.dumps(goal.serialize))
+			if len(chunk) == FEED_CHUNK:
+				yield separator + ', '.join(chunk)
+				separator = ', '
+				chunk = []
+		if chunk:
+			yield separator + ', '.join(chunk)
+		yield '], "next": %s}' % json.dumps(page.nextPage)
+
+	# The session stays open until the last goal has been sent
+	return Response(stream_with_context(generate()),
+		mimetype = 'application/json')
+
+def feedXML(page):
+	''' Streams the goals of a feed page through the XML template '''
+	stream = app.jinja_env.get_template('userGoals.xml').stream(page = page)
+	# Sent about a hundred template pieces, a few goals, at a time
+	stream.enable_buffering(100)
+	return Response(stream_with_context(stream), mimetype = 'application/xml')
+
 # file upload method
 def allowed_file(filename):
 	''' Check if the file is allowed '''
@@ -472,37 +657,36 @@ def editProfile(user_id):
 		return render_template('editProfile.html', user = editedUser)
 
 #JSON APIs to view a User's  goals
+# The feeds are paged, filtered and streamed, see FeedPage
 @app.route('/JSON/')
 def allGoalsJSON():
 	''' JSON feed for all goals '''
-	goals = session.query(Goal).all()
-
-	return jsonify(Goals=[i.serialize for i in goals])
+	return feedJSON(FeedPage())
 
 @app.route('/user/<int:user_id>/JSON/')
 def userGoalsJSON(user_id):
 	''' JSON feed to show a user's goals '''
-	goals = session.query(Goal).filter_by(user_id = user_id).all()
-	return jsonify(Goals=[i.serialize for i in goals])
+	return feedJSON(FeedPage(user_id))
+
+@app.route('/JSON/export/')
+def exportGoalsJSON():
+	''' Every goal, or those the filters select, as one JSON document '''
+	return feedJSON(FeedPage(paged = False))
 
 @app.route('/XML/')
 def allGoalsXML():
 	''' XML feed for all goals '''
-	goals = session.query(Goal).all()
-
-	template = render_template('userGoals.xml', goals = goals)
-	response = make_response(template)
-	response.headers['Content-Type'] = 'application/xml'
-	return response
+	return feedXML(FeedPage())
 
 @app.route('/user/<int:user_id>/XML/')
 def userGoalsXML(user_id):
 	''' XML feed for a user's goals'''
-	goals = session.query(Goal).filter_by(user_id = user_id)
-	template = render_template('userGoals.xml', goals = goals)
-	response = make_response(template)
-	response.headers['Content-Type'] = 'application/xml'
-	return response
+	return feedXML(FeedPage(user_id))
+
+@app.route('/XML/export/')
+def exportGoalsXML():
+	''' Every goal, or those the filters select, as one XML document '''
+	return feedXML(FeedPage(paged = False))
     
 
 if __name__ == '__main__':
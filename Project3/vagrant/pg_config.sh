@@ -2,6 +2,7 @@ apt-get -qqy update
 apt-get -qqy install postgresql python-psycopg2
 apt-get -qqy install python-flask python-sqlalchemy
 apt-get -qqy install python-pip
+pip install 'SQLAlchemy>=1.2'
 pip install bleach
 pip install oauth2client
 pip install requests